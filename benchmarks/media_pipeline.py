@@ -0,0 +1,175 @@
+"""
+    Headless benchmark for the SIP -> browser media path.
+
+    A synthetic media clock stands in for PJSIP's conference bridge: every frame time it calls
+    SIPAudioBridge.onFrameReceived for each simulated call, from its own thread. Each call has N
+    SIPToBrowserAudioTrack consumers pulling through the queue layer on the asyncio loop, as aiortc would.
+    pjsua2 is replaced with benchmarks.pjsua2_standin, so no PJSIP build is needed (config.py still is).
+
+    Run from the repo root:
+        python -m benchmarks.media_pipeline --calls 1,2,4,8,16 --listeners 1 --duration 10
+"""
+import argparse
+import asyncio
+import logging
+import threading
+import time
+
+import numpy as np
+
+from benchmarks import pjsua2_standin
+pjsua2_standin.install()
+
+import pjsua2 as pj
+from hgn_sip.sip_media import get_audio_format
+from interslug.media_cookery.bridges import SIPAudioBridge, SIPToBrowserAudioTrack
+from interslug.media_cookery.dsp import AudioDSPStage
+from interslug.media_cookery.queuing import queue_registry
+
+class SyntheticMediaClock():
+    """
+        Single thread ticking once per frame time, handing every bridge a frame of tone.
+        Same shape as PJSIP, where one clock thread services every port in the conference bridge.
+    """
+    def __init__(self, bridges: list[SIPAudioBridge], audio_format: pj.MediaFormatAudio):
+        self.bridges = bridges
+        self.frame_sec = audio_format.frameTimeUsec * 0.000001
+        frame_samples = int(self.frame_sec * audio_format.clockRate)
+        # One second of 440Hz, pre-rendered so the clock thread only does what PJSIP's would
+        t = np.arange(audio_format.clockRate) / audio_format.clockRate
+        tone = (8000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+        self.frames = [tone[i:i + frame_samples].tobytes() for i in range(0, len(tone) - frame_samples + 1, frame_samples)]
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="bench-media-clock", daemon=True)
+        self.ticks = 0
+        self.late_ticks = 0  # Ticks that started more than a frame late, i.e. the clock thread itself fell behind
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        start = time.perf_counter()
+        while not self.stop_event.is_set():
+            due = start + self.ticks * self.frame_sec
+            now = time.perf_counter()
+            if due > now:
+                time.sleep(due - now)
+            elif now - due > self.frame_sec:
+                self.late_ticks += 1
+            buf = self.frames[self.ticks % len(self.frames)]
+            for bridge in self.bridges:
+                bridge.onFrameReceived(pj.MediaFrame(buf))
+            self.ticks += 1
+
+class ConsumerStats():
+    def __init__(self):
+        self.intervals: list[float] = []  # Seconds between successive recv() returns
+        self.ages: list[float] = []       # Queue age of each real (non-zero) frame
+
+async def consume(track: SIPToBrowserAudioTrack, stop_at: float, stats: ConsumerStats):
+    last = None
+    while time.perf_counter() < stop_at:
+        wait_before = track.total_wait
+        zero_before = track.zero_frames
+        await track.recv()
+        now = time.perf_counter()
+        if last is not None:
+            stats.intervals.append(now - last)
+        last = now
+        if track.zero_frames == zero_before:
+            stats.ages.append(track.total_wait - wait_before)
+
+def percentile_ms(values: list[float], pct: float) -> float:
+    return float(np.percentile(values, pct) * 1000) if values else 0.0
+
+async def run_scenario(calls: int, listeners: int, duration: float, clock_rate: int, dsp: bool = False) -> dict:
+    audio_format = get_audio_format(clock_rate)
+    bridges: list[SIPAudioBridge] = []
+    tracks: list[SIPToBrowserAudioTrack] = []
+    for c in range(calls):
+        bridge = SIPAudioBridge(call_id=f"bench-{calls}-{c}")
+        queue_registry.add_owner(bridge.call_id)  # As CallManager.add_call does
+        bridge.createPort(f"BenchPort-{c}", audio_format)
+        if dsp:
+            bridge.add_stage(AudioDSPStage(agc_target_dbfs=-18.0, on_level=lambda level: None))
+        for l in range(listeners):
+            track = SIPToBrowserAudioTrack(f"bench-{calls}-c{c}-l{l}", audio_format, bridge.call_id)
+            bridge.add_queue(track.queue)
+            track.open_gate(audio_format)
+            tracks.append(track)
+        bridges.append(bridge)
+
+    clock = SyntheticMediaClock(bridges, audio_format)
+    stats = [ConsumerStats() for _ in tracks]
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    clock.start()
+    await asyncio.gather(*(consume(track, wall_start + duration, stat) for track, stat in zip(tracks, stats)))
+    clock.stop()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    for bridge in bridges:
+        queue_registry.release_owner(bridge.call_id)
+
+    frame_sec = audio_format.frameTimeUsec * 0.000001
+    ages = [age for stat in stats for age in stat.ages]
+    jitter = [abs(interval - frame_sec) for stat in stats for interval in stat.intervals]
+    total_frames = sum(track.total_frames for track in tracks)
+    zero_frames = sum(track.zero_frames for track in tracks)
+    return {
+        "calls": calls,
+        "listeners": listeners,
+        "frames": total_frames,
+        "zero_frames": zero_frames,
+        "zero_pct": 100 * zero_frames / total_frames if total_frames else 0.0,
+        "malformed_frames": sum(track.malformed_frames for track in tracks),
+        "dropped_frames": sum(bridge.dropped_frames for bridge in bridges),
+        "age_p50_ms": percentile_ms(ages, 50),
+        "age_p95_ms": percentile_ms(ages, 95),
+        "age_max_ms": max(ages) * 1000 if ages else 0.0,
+        "jitter_p95_ms": percentile_ms(jitter, 95),
+        "jitter_max_ms": max(jitter) * 1000 if jitter else 0.0,
+        "late_ticks": clock.late_ticks,
+        "cpu_pct": 100 * cpu / wall,
+        "cpu_pct_per_call": 100 * cpu / wall / calls,
+        "dsp_us_per_frame": 1000000 * sum(bridge.stage_time for bridge in bridges) / max(1, sum(bridge.total_frames for bridge in bridges)),
+    }
+
+def is_degraded(result: dict, max_zero_pct: float, max_jitter_ms: float) -> bool:
+    return result["zero_pct"] > max_zero_pct or result["jitter_p95_ms"] > max_jitter_ms or result["malformed_frames"] > 0
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SIP -> browser media pipeline without a panel")
+    parser.add_argument("--calls", default="1,2,4,8,16", help="Comma separated concurrent call counts to try")
+    parser.add_argument("--listeners", type=int, default=1, help="Browser tracks per call")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--clock-rate", type=int, default=8000, help="Bridge clock rate, i.e. the panel's codec rate")
+    parser.add_argument("--max-zero-pct", type=float, default=1.0, help="Zero (silence fill) frame percentage counted as degraded")
+    parser.add_argument("--max-jitter-ms", type=float, default=5.0, help="p95 delivery jitter counted as degraded")
+    parser.add_argument("--dsp", action="store_true", help="Run the level/VAD/AGC stage on every bridge")
+    parser.add_argument("--verbose", action="store_true", help="Keep the pipeline's own debug logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    header = f"{'calls':>5} {'frames':>8} {'zero%':>6} {'malf':>5} {'drop':>6} {'age50':>7} {'age95':>7} {'ageMax':>7} {'jit95':>7} {'jitMax':>7} {'late':>5} {'cpu%':>6} {'cpu%/call':>9} {'dspUs':>6}"
+    print(header)
+    degraded_at = None
+    for calls in [int(c) for c in args.calls.split(",")]:
+        r = await run_scenario(calls, args.listeners, args.duration, args.clock_rate, args.dsp)
+        print(f"{r['calls']:>5} {r['frames']:>8} {r['zero_pct']:>6.2f} {r['malformed_frames']:>5} {r['dropped_frames']:>6} {r['age_p50_ms']:>7.2f} {r['age_p95_ms']:>7.2f} {r['age_max_ms']:>7.2f} {r['jitter_p95_ms']:>7.2f} {r['jitter_max_ms']:>7.2f} {r['late_ticks']:>5} {r['cpu_pct']:>6.1f} {r['cpu_pct_per_call']:>9.2f} {r['dsp_us_per_frame']:>6.1f}")
+        if degraded_at is None and is_degraded(r, args.max_zero_pct, args.max_jitter_ms):
+            degraded_at = calls
+
+    if degraded_at is None:
+        print("No degradation within the tested call counts")
+    else:
+        print(f"Audio degrades at {degraded_at} concurrent calls (zero>{args.max_zero_pct}% or jitter p95>{args.max_jitter_ms}ms or malformed frames)")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+"""
+    Just enough of pjsua2 for the media_cookery bridges to be driven without PJSIP.
+    Install it with install() before anything imports pjsua2.
+    The SWIG vectors are plain lists/bytes here, and ports don't connect to any conference bridge;
+    the benchmark calls onFrameReceived itself.
+"""
+import sys
+
+PJMEDIA_TYPE_AUDIO = 1
+PJMEDIA_FRAME_TYPE_AUDIO = 1
+
+class Error(Exception):
+    def __init__(self, reason: str = ""):
+        super().__init__(reason)
+        self.reason = reason
+
+class ByteVector(bytearray):
+    pass
+
+class MediaFormatAudio():
+    def __init__(self):
+        self.type = 0
+        self.clockRate = 0
+        self.channelCount = 0
+        self.bitsPerSample = 0
+        self.frameTimeUsec = 0
+
+class MediaFrame():
+    def __init__(self, buf: bytes = b"", frame_type: int = PJMEDIA_FRAME_TYPE_AUDIO):
+        self.type = frame_type
+        self.buf = buf
+        self.size = len(buf)
+
+class StreamInfo():
+    def __init__(self, codec_name: str = "PCMU", codec_clock_rate: int = 8000):
+        self.codecName = codec_name
+        self.codecClockRate = codec_clock_rate
+
+class AudioMedia():
+    def startTransmit(self, sink: 'AudioMedia'):
+        pass
+    def stopTransmit(self, sink: 'AudioMedia'):
+        pass
+
+class AudioMediaPort(AudioMedia):
+    def createPort(self, name: str, fmt: MediaFormatAudio):
+        self.port_name = name
+        self.port_format = fmt
+    def onFrameReceived(self, frame: MediaFrame):
+        pass
+    def onFrameRequested(self, frame: MediaFrame):
+        pass
+
+class Endpoint():
+    _instance: 'Endpoint' = None
+    @classmethod
+    def instance(cls) -> 'Endpoint':
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+    def libIsThreadRegistered(self) -> bool:
+        return True
+    def libRegisterThread(self, name: str):
+        pass
+
+def __getattr__(name: str):
+    # Anything else only turns up in annotations, a placeholder type is fine
+    if name.startswith("__"):
+        raise AttributeError(name)
+    placeholder = type(name, (), {})
+    setattr(sys.modules[__name__], name, placeholder)
+    return placeholder
+
+def install():
+    module = sys.modules[__name__]
+    if "pjsua2" in sys.modules and sys.modules["pjsua2"] is not module:
+        raise RuntimeError("pjsua2 has already been imported, install the stand-in before importing interslug")
+    sys.modules["pjsua2"] = module
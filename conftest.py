@@ -0,0 +1,10 @@
+"""
+    pytest setup, for running the tests from the repo root: python -m pytest tests
+    Like the benchmarks, without a PJSIP build pjsua2 is benchmarks.pjsua2_standin, and a config.py
+    (from config.py.sample) has to be on the path for anything that reads config.
+"""
+try:
+    import pjsua2
+except ImportError:
+    from benchmarks import pjsua2_standin
+    pjsua2_standin.install()
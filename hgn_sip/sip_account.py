@@ -1,38 +1,79 @@
+from collections import OrderedDict
+import threading
 import pjsua2 as pj
 from logging_config import get_logger
+from config import SIP_BUDDY_CACHE_SIZE
 from .sip_buddy import SIPBuddy
 from .sip_call import SIPCall, get_call_param
+from .sip_callback_executor import CallbackExecutor
 from .sip_callbacks import SIPCallCallback, SIPInstantMessageStatusStateCallback
 
+# The bare "sip:user@host:port" of a URI, so "Panel" <sip:1001@10.0.0.5>;tag=x and sip:1001@10.0.0.5 match
+def normalise_uri(uri: str) -> str:
+    if "<" in uri:
+        uri = uri[uri.index("<") + 1:]
+        uri = uri.split(">", 1)[0]
+    uri = uri.split(";", 1)[0].split("?", 1)[0].strip()
+    scheme, sep, rest = uri.partition(":")
+    if not sep:
+        return uri.lower()
+    user, at, host = rest.rpartition("@")
+    host = host.lower()
+    if scheme.lower() == "sip" and host.endswith(":5060"):
+        host = host[:-len(":5060")]  # The default port, some panels leave it out
+    return f"{scheme.lower()}:{user}{at}{host}"
+
 class SIPAccount(pj.Account):
-    def __init__(self, ep):
+    def __init__(self, ep, buddy_cache_size: int = SIP_BUDDY_CACHE_SIZE):
         super().__init__()
         self.logger = get_logger("sip_account")
-        # Maintain list of Call/Buddies otherwise they'll get munched by GC and drop
-        self.calls:list[SIPCall] = []
-        self.buddies:list[SIPBuddy] = []
+        # Maintain Call/Buddies otherwise they'll get munched by GC and drop
+        # Calls by PJSUA call id, and by normalised remote URI (most recent call to that URI)
+        self.calls: dict[int, SIPCall] = {}
+        self.calls_by_uri: dict[str, SIPCall] = {}
+        # Buddies by normalised URI, least recently used first. Past buddy_cache_size the oldest is dropped, PJSUA2 deletes it with the object
+        self.buddies: OrderedDict[str, SIPBuddy] = OrderedDict()
+        self.buddy_cache_size = buddy_cache_size
+        # Calls come and go on PJSIP's thread, the callback workers and the web thread
+        self.registry_lock = threading.Lock()
         self.ep: pj.Endpoint = ep
         self.onCallCallbacks: list[SIPCallCallback] = []
         self.onInstantMessageCallbacks: list[SIPInstantMessageStatusStateCallback] = []
+        self.callback_executor = CallbackExecutor(ep)
         
-    # Delete call from stored list based on call_id.
+    # Store a call once it has its PJSUA call id (incoming straight away, outgoing once makeCall's given it one)
+    def add_call(self, call: SIPCall, remote_uri: str):
+        if call.call_info is not None and call.call_info.stateText == "DISCONNECTED":
+            # Already over (and deleted) before it could be stored
+            return
+        # Set before it's findable, delete_call can run as soon as the lock's released
+        call.remote_uri = remote_uri
+        with self.registry_lock:
+            self.calls[call.call_id] = call
+            self.calls_by_uri[normalise_uri(remote_uri)] = call
+        self.logger.debug(f"Call stored. call_id={call.call_id}, remote_uri={remote_uri}, calls={len(self.calls)}")
+
+    # Delete call from stored calls based on call_id.
     # Called after the call hangs up...
     def delete_call(self, call_id):
-        for call in self.calls:
-            if call.call_id == call_id:
-                self.calls.remove(call)
+        with self.registry_lock:
+            call = self.calls.pop(call_id, None)
+            if call is None:
+                return
+            uri_key = normalise_uri(call.remote_uri)
+            # A newer call to the same URI may have replaced it
+            if self.calls_by_uri.get(uri_key) is call:
+                del self.calls_by_uri[uri_key]
     
     # Find active call for a given URI (Buddy)
     def find_call(self, remote_uri):
-        self.logger.info(f"searching for call. remote_uri={remote_uri}")
-        for call in self.calls:
-            ci: pj.CallInfo = call.getInfo()
-            self.logger.debug(f"Checking call for match. call_id={ci.callIdString}, remote_uri={ci.remoteUri}")
-            if ci.remoteUri == remote_uri:
-                self.logger.info(f"call match. call_id={ci.callIdString}, remote_uri={ci.remoteUri}")
-                return call
-        self.logger.info(f"no buddy match. remote_uri={remote_uri}")
-        return None
+        with self.registry_lock:
+            call = self.calls_by_uri.get(normalise_uri(remote_uri))
+        if call is None:
+            self.logger.info(f"no call match. remote_uri={remote_uri}")
+            return None
+        self.logger.info(f"call match. call_id={call.call_id}, remote_uri={remote_uri}")
+        return call
     
     # Register buddy for a given URI. This will then allow us to send it an IM, etc.
     def create_buddy(self, remote_uri):
@@ -41,19 +82,23 @@ class SIPAccount(pj.Account):
         buddy_cfg.uri = remote_uri
         buddy = SIPBuddy(self)
         buddy.createBuddy(buddy_cfg)
-        self.buddies.append(buddy)
+        with self.registry_lock:
+            self.buddies[normalise_uri(remote_uri)] = buddy
+            while len(self.buddies) > self.buddy_cache_size:
+                evicted_uri, _ = self.buddies.popitem(last=False)
+                self.logger.debug(f"Evicting least recently used buddy. uri={evicted_uri}")
         return buddy
 
     # Return buddy by URI if exist
     def find_buddy(self, remote_uri):
-        self.logger.info(f"searching for buddy. remote_uri={remote_uri}")
-        for buddy in self.buddies:
-            bi: pj.BuddyInfo = buddy.getInfo()
-            if bi.uri == remote_uri:
-                self.logger.info(f"buddy found. remote_uri={remote_uri}")
-                return buddy
-        self.logger.info(f"no buddy match. remote_uri={remote_uri}")
-        return None
+        uri_key = normalise_uri(remote_uri)
+        with self.registry_lock:
+            buddy = self.buddies.get(uri_key)
+            if buddy is not None:
+                self.buddies.move_to_end(uri_key)
+        if buddy is None:
+            self.logger.info(f"no buddy match. remote_uri={remote_uri}")
+        return buddy
     
     # Return buddy if exist otherwise create and return
     def find_or_create_buddy(self, remote_uri) -> SIPBuddy:
@@ -67,7 +112,7 @@ class SIPAccount(pj.Account):
         ai: pj.AccountInfo = self.getInfo()
         self.logger.info(f"Destroying SIPAccount. uri={ai.uri}")
         self.logger.info("Ending active calls")
-        for call in self.calls:
+        for call in list(self.calls.values()):
             # Check if call's not hungup and then hangup
             try:
                 ci: pj.CallInfo = call.getInfo()
@@ -76,14 +121,13 @@ class SIPAccount(pj.Account):
                     call.hangup(get_call_param(pj.PJSIP_SC_REQUEST_TERMINATED))
             except pj.Error as e:
                 self.logger.error(f"Error ending call {call.call_id}. Error={e.reason}")                
-            if call in self.calls:
-                self.calls.remove(call)
+            self.delete_call(call.call_id)
         self.logger.info("Unregistering Buddies")
-        for buddy in self.buddies:
-            bi: pj.BuddyInfo = buddy.getInfo()
-            pj.Buddy
-            self.logger.info(f"Unregistering Buddy. uri={bi.uri}")
-            self.buddies.remove(buddy)
+        for uri in list(self.buddies):
+            self.logger.info(f"Unregistering Buddy. uri={uri}")
+            del self.buddies[uri]
+        self.logger.info("Finishing queued call callbacks")
+        self.callback_executor.stop()
         self.logger.info("Shutting down SIPAccount")
         self.shutdown()
     
@@ -122,7 +166,7 @@ class SIPAccount(pj.Account):
     def onIncomingCall(self, param: pj.OnIncomingCallParam):
         self.logger.info(f"Account receiving incoming call. callid={param.callId}")
         call = SIPCall(self, call_id = param.callId, callbacks = self.onCallCallbacks)
-        ci: pj.CallInfo = call.getInfo()
+        ci = call.get_info()
         buddy = self.find_or_create_buddy(ci.remoteUri)
         self.logger.info(f"Incoming call detected and created. callId={param.callId}, remoteUri={ci.remoteUri}, accId={ci.accId}, callIdString={ci.callIdString}")
-        self.calls.append(call)
\ No newline at end of file
+        self.add_call(call, ci.remoteUri)
\ No newline at end of file
@@ -1,7 +1,9 @@
 import pjsua2 as pj
 from logging_config import get_logger
 from .sip_buddy import SIPBuddy
-from .sip_callbacks import SIPCallCallback
+from .sip_callbacks import SIPCallCallback, SIPCallCallbackTable
+from .sip_call_info import CallInfoSnapshot
+from .sip_media import get_audio_format, get_codec_clock_rate
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .sip_account import SIPAccount
@@ -32,24 +34,26 @@ class SIPCall(pj.Call):
         pj.Call.__init__(self, acc, call_id)
         self.acc: SIPAccount = acc
         self.connected = False
+        self.disconnected = False  # Set in PJSIP's DISCONNECTED callback, before any callback for it runs. PJSUA reuses the id after
         self.msg_sent = False
-        self.call_id = call_id
-        self.call_info: pj.CallInfo = None
+        self.call_id = call_id  # PJSUA's id. Outgoing calls get theirs in make_call
+        self.remote_uri: str = None
+        self.call_info: CallInfoSnapshot = None  # As of the last event, or get_info()
         self.onCallStateCallBacks = callbacks
         self.callbacks = callbacks
+        self.callback_table = SIPCallCallbackTable(callbacks)
         self.is_outgoing = True if call_id == pj.PJSUA_INVALID_ID else False
         self.ports = []
     
-    def emit(self, event:str):
+    def emit(self, event:str, ci: CallInfoSnapshot):
         self.logger.debug(f"CallEvent: event={event}")
-        ci = self.get_info()
-        # Events: call_state, end_call
-        cbs = [cb for cb in self.callbacks if cb.event == event]
-        for cb in cbs:
-            if event == "call_state" and (cb.on_state_text == ci.stateText or cb.on_state_text == "ANY"):
-                cb.execute(call = self, call_info = ci)
-            if event == "end_call":
-                cb.execute(call = self, call_info = ci)
+        # Events: call_state, call_media_state, end_call
+        for cb in self.callback_table.get(event, ci.stateText):
+            # Handed the event's CallInfo, the call will have moved on by the time most of them run
+            if cb.inline:
+                self.acc.callback_executor.run_inline(cb, self, ci)
+            else:
+                self.acc.callback_executor.submit(ci.callIdString, cb, self, ci)
 
     def end_call(self):
         self.logger.info("Hanging up call")
@@ -62,7 +66,7 @@ class SIPCall(pj.Call):
         self.logger.debug(f"format info. clockRate={port_format.clockRate}, channelCount={port_format.channelCount}, frameTimeUsec={port_format.frameTimeUsec}, bitsPerSample={port_format.bitsPerSample}, type={port_format.type}")
 
     def dump_audio_media_info(self):
-        ci: pj.CallInfo = self.get_info()
+        ci = self.get_info()
         call_media_info_list: list[pj.CallMediaInfo] = ci.media
         for call_media_info in call_media_info_list:
             self.logger.debug(f"media found type={call_media_info.type}, idx={call_media_info.index}, status={call_media_info.status}, direction={call_media_info.dir}, type_str={get_call_media_type_string(call_media_info.type)}, status_str={get_call_media_status_string(call_media_info.status)}, direction_str={get_call_media_direction_string(call_media_info.dir)}")
@@ -70,13 +74,33 @@ class SIPCall(pj.Call):
                 audio_media: pj.AudioMedia = self.getAudioMedia(call_media_info.index)
                 self.dump_audio_media_details(audio_media)
     
-    def get_call_audio_media(self) -> pj.AudioMedia:
-        ci = self.get_info()
+    def get_call_audio_media(self, ci: CallInfoSnapshot = None) -> pj.AudioMedia:
+        ci = ci or self.get_info()
         cmil = ci.media
         for cmi in cmil:
             if cmi.type == pj.PJMEDIA_TYPE_AUDIO:
                 return self.getAudioMedia(cmi.index)
-    
+
+    def has_active_audio(self, ci: CallInfoSnapshot = None) -> bool:
+        ci = ci or self.get_info()
+        return any(cmi.type == pj.PJMEDIA_TYPE_AUDIO and cmi.status == pj.PJSUA_CALL_MEDIA_ACTIVE for cmi in ci.media)
+
+    def get_call_audio_format(self, ci: CallInfoSnapshot = None, fallback: bool = True) -> pj.MediaFormatAudio:
+        # Format for ports attached to this call, matching the negotiated codec's rate
+        # so the conference bridge isn't resampling every frame up to something the panel never sent.
+        # Before media's up there's no codec to go on: the default format, or None with fallback=False
+        ci = ci or self.get_info()
+        for cmi in ci.media:
+            if cmi.type == pj.PJMEDIA_TYPE_AUDIO:
+                try:
+                    si: pj.StreamInfo = self.getStreamInfo(cmi.index)
+                    clock_rate = get_codec_clock_rate(si)
+                    self.logger.debug(f"Negotiated audio codec. codec={si.codecName}, clockRate={clock_rate}")
+                    return get_audio_format(clock_rate)
+                except pj.Error as e:
+                    self.logger.error(f"Unable to get stream info, using default format. error={e.reason}")
+        return get_audio_format() if fallback else None
+
     def make_call(self, remote_uri):
         cs = pj.CallSetting(True)
         cs.audioCount = 1
@@ -84,9 +108,12 @@ class SIPCall(pj.Call):
         params = pj.CallOpParam(True)
         params.opt = cs
         self.makeCall(remote_uri, params)
+        self.call_id = self.getId()
+        self.acc.add_call(self, remote_uri)
 
-    def get_info(self) -> pj.CallInfo:
-        ci: pj.CallInfo = self.getInfo()
+    # The one trip into PJSIP for the call's info. Events take it once and pass it along
+    def get_info(self) -> CallInfoSnapshot:
+        ci = CallInfoSnapshot(self.getInfo())
         self.call_info = ci
         return ci
 
@@ -94,9 +121,12 @@ class SIPCall(pj.Call):
         # When call state changes, this runs. Depending on the state, do different things.
         # param has nothing useful, so just get info straight away.
         ci = self.get_info()
+        if ci.stateText == "DISCONNECTED":
+            # Callbacks still queued from earlier events check this, so they don't touch a torn down call
+            self.disconnected = True
 
         # Trigger call_state callbacks
-        self.emit("call_state")
+        self.emit("call_state", ci)
 
         self.logger.debug(f"Call state change. state={ci.state} stateText={ci.stateText} lastReason={ci.lastReason} accId={ci.accId} callIdString={ci.callIdString} localUri={ci.localUri} remoteUri={ci.remoteUri} lastReason={ci.lastReason}")
         if ci.stateText == "INCOMING":
@@ -113,19 +143,19 @@ class SIPCall(pj.Call):
             self.connected = True
 
         if ci.stateText == "DISCONNECTED":
-            for port in self.ports:
-                try:
-                    port = None
-                except Exception as e:
-                    self.logger.error(f"Unable to detach custom port, error={e}")
             self.logger.debug("Call disconnected")
+            # Let consumers detach anything they hung off the call's media
+            self.emit("end_call", ci)
+            if len(self.ports) > 0:
+                # Drop what's left so the ports are destroyed along with the call
+                self.logger.debug(f"Releasing custom ports. count={len(self.ports)}")
+                self.ports.clear()
             self.acc.delete_call(self.call_id)
         
     # How the fk does Media Work in this
     def onCallMediaState(self, prm: pj.OnCallMediaStateParam):
         self.logger.info("on call media state")
-        ci: pj.CallInfo = self.get_info()
-        mi: pj.CallMediaInfo = ci.media
+        self.emit("call_media_state", self.get_info())
 
     # Dont think sending IMs in calls is even a thing?
     def onInstantMessageStatus(self, param: pj.OnInstantMessageStatusParam):
@@ -0,0 +1,42 @@
+import pjsua2 as pj
+
+# Copied straight across from pj.CallInfo
+CALL_INFO_FIELDS = ("id", "accId", "callIdString", "role", "localUri", "localContact", "remoteUri", "remoteContact",
+                    "state", "stateText", "lastStatusCode", "lastReason", "remAudioCount", "remVideoCount")
+
+class CallMediaInfoSnapshot():
+    """ The parts of a pj.CallMediaInfo anything here looks at """
+    __slots__ = ("index", "type", "dir", "status")
+
+    def __init__(self, cmi: pj.CallMediaInfo):
+        object.__setattr__(self, "index", cmi.index)
+        object.__setattr__(self, "type", cmi.type)
+        object.__setattr__(self, "dir", cmi.dir)
+        object.__setattr__(self, "status", cmi.status)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+class CallInfoSnapshot():
+    """
+        A call's pj.CallInfo, read out of PJSUA2 once when an event comes in. Every callback, the CallManager
+        and the websocket messages for the event share it, so none of them goes back into PJSIP for it.
+        Same attribute names as pj.CallInfo, except connectDuration and totalDuration are float seconds rather
+        than TimeVals. Read-only, as it's shared across threads.
+    """
+    __slots__ = CALL_INFO_FIELDS + ("connectDuration", "totalDuration", "media")
+
+    def __init__(self, ci: pj.CallInfo):
+        for field in CALL_INFO_FIELDS:
+            object.__setattr__(self, field, getattr(ci, field))
+        connect_duration: pj.TimeVal = ci.connectDuration
+        total_duration: pj.TimeVal = ci.totalDuration
+        object.__setattr__(self, "connectDuration", connect_duration.sec + connect_duration.msec / 1000)
+        object.__setattr__(self, "totalDuration", total_duration.sec + total_duration.msec / 1000)
+        object.__setattr__(self, "media", tuple(CallMediaInfoSnapshot(cmi) for cmi in ci.media))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __repr__(self):
+        return f"CallInfoSnapshot(callIdString={self.callIdString}, stateText={self.stateText}, lastReason={self.lastReason})"
@@ -0,0 +1,124 @@
+from collections import deque
+import queue
+import threading
+import time
+
+import pjsua2 as pj
+from logging_config import get_logger
+from .sip_threads import ensure_thread_registered
+from config import SIP_CALLBACK_THREADS
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .sip_call import SIPCall
+    from .sip_callbacks import SIPCallCallback
+    from .sip_call_info import CallInfoSnapshot
+
+class CallbackExecutor():
+    """
+        Runs SIPCallCallbacks on worker threads rather than inside PJSUA2's callback, so a slow one
+        (an IM, the CallManager...) doesn't hold up SIP timers and media.
+        Each call's callbacks run one at a time in the order they were submitted, different calls' run in parallel.
+        A call with callbacks waiting is put on the ready queue once. A worker runs its next callback and, if there's
+        more, puts it at the back of the queue again, so a busy call can't starve the others.
+        Workers register themselves with the Endpoint, callbacks can use PJSUA2 as usual.
+        Callbacks marked inline still run in PJSUA2's callback (see run_inline), timed the same way.
+    """
+    def __init__(self, ep: pj.Endpoint, num_threads: int = SIP_CALLBACK_THREADS):
+        self.logger = get_logger("sip_callback_executor")
+        self.ep = ep
+        self.lock = threading.Lock()
+        self.pending: dict[str, deque[tuple]] = {}  # Call ID -> callbacks waiting, the head is the one running. Only while it has some
+        self.ready: queue.SimpleQueue = queue.SimpleQueue()  # Call IDs with callbacks and no worker on them. None stops a worker
+        self.stats: dict[str, list] = {}  # Callback name -> [runs, failures, queued total, queued max, run total, run max, inline]
+        self.max_depth = 0
+        self.threads = [threading.Thread(target=self._work, name=f"sip-callbacks-{i}", daemon=True) for i in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, call_id: str, callback: 'SIPCallCallback', call: 'SIPCall', call_info: 'CallInfoSnapshot'):
+        """ From PJSUA2's callback. Never waits """
+        job = (callback, call, call_info, time.perf_counter())
+        with self.lock:
+            jobs = self.pending.get(call_id)
+            if jobs is not None:
+                # A worker's already on this call, it'll get to this one
+                jobs.append(job)
+                self.max_depth = max(self.max_depth, len(jobs))
+                return
+            self.pending[call_id] = deque([job])
+        self.ready.put(call_id)
+
+    def run_inline(self, callback: 'SIPCallCallback', call: 'SIPCall', call_info: 'CallInfoSnapshot'):
+        self._execute(callback, call, call_info, time.perf_counter(), inline=True)
+
+    def _work(self):
+        ensure_thread_registered(self.ep)
+        while True:
+            call_id = self.ready.get()
+            if call_id is None:
+                return
+            with self.lock:
+                callback, call, call_info, queued_at = self.pending[call_id][0]
+            self._execute(callback, call, call_info, queued_at)
+            with self.lock:
+                jobs = self.pending[call_id]
+                jobs.popleft()
+                if not jobs:
+                    del self.pending[call_id]
+                    continue
+            self.ready.put(call_id)
+
+    def _execute(self, callback: 'SIPCallCallback', call: 'SIPCall', call_info: 'CallInfoSnapshot', queued_at: float, inline: bool = False):
+        started = time.perf_counter()
+        failed = False
+        try:
+            callback.execute(call = call, call_info = call_info)
+        except pj.Error as e:
+            failed = True
+            self.logger.error(f"Callback failed. callback={callback.name}, call_id={call_info.callIdString}, error={e.reason}")
+        except Exception as e:
+            failed = True
+            self.logger.exception(f"Callback failed. callback={callback.name}, call_id={call_info.callIdString}, error={e}")
+        finished = time.perf_counter()
+        with self.lock:
+            stats = self.stats.setdefault(callback.name, [0, 0, 0.0, 0.0, 0.0, 0.0, inline])
+            stats[0] += 1
+            stats[1] += failed
+            stats[2] += started - queued_at
+            stats[3] = max(stats[3], started - queued_at)
+            stats[4] += finished - started
+            stats[5] = max(stats[5], finished - started)
+
+    def stop(self, timeout: float = 5):
+        """ Lets the workers finish what's queued (for up to timeout), then stops them """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.pending:
+                    break
+            time.sleep(0.01)
+        for _ in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "threads": len(self.threads),
+                "calls_pending": len(self.pending),
+                "queued": sum(len(jobs) for jobs in self.pending.values()),
+                "max_call_depth": self.max_depth,
+                "callbacks": {
+                    name: {
+                        "inline": inline,
+                        "runs": runs,
+                        "failures": failures,
+                        "avg_queued_ms": 1000 * queued_total / runs if runs else None,
+                        "max_queued_ms": 1000 * queued_max,
+                        "avg_run_ms": 1000 * run_total / runs if runs else None,
+                        "max_run_ms": 1000 * run_max,
+                    }
+                    for name, (runs, failures, queued_total, queued_max, run_total, run_max, inline) in self.stats.items()
+                },
+            }
@@ -3,6 +3,10 @@ if TYPE_CHECKING:
     import pjsua2 as pj
     from .sip_call import SIPCall
     from .sip_account import SIPAccount
+    from .sip_call_info import CallInfoSnapshot
+
+CALL_EVENTS = ("call_state", "call_media_state", "end_call")
+CALL_STATE_TEXTS = ("NULL", "CALLING", "INCOMING", "EARLY", "CONNECTING", "CONFIRMED", "DISCONNECTED")
 
 # A callback object which will be executed when a target call state is achieved, with the provided parameters.
 
@@ -15,15 +19,36 @@ class SIPCallStateCallback():
         call_account: 'SIPAccount' = call.acc
         self.callback_fn(call, call_account, call_info)
 
+# Runs on the account's CallbackExecutor, in order with the call's other callbacks.
+# inline=True runs it inside PJSUA2's callback instead, only for things that can't wait (e.g. releasing media before PJSIP destroys it)
 class SIPCallCallback():
-    def __init__(self, event: str, cb_fn, on_state_text: str = None):
+    def __init__(self, event: str, cb_fn, on_state_text: str = None, inline: bool = False):
         self.event = event
         self.callback_fn = cb_fn
         self.on_state_text = on_state_text
-    def execute(self, call: 'SIPCall', call_info: 'pj.CallInfo'):
+        self.inline = inline
+        self.name = getattr(cb_fn, "__name__", repr(cb_fn))
+    def execute(self, call: 'SIPCall', call_info: 'CallInfoSnapshot'):
         call_account: 'SIPAccount' = call.acc
         self.callback_fn(call, call_account, call_info)
 
+# Which SIPCallCallbacks run for each (event, state), worked out up front rather than filtering the list on every event
+class SIPCallCallbackTable():
+    def __init__(self, callbacks: list[SIPCallCallback]):
+        self.callbacks = list(callbacks)
+        self.table: dict[tuple[str, str], tuple[SIPCallCallback, ...]] = {}
+        for event in CALL_EVENTS:
+            for state_text in CALL_STATE_TEXTS:
+                self.table[(event, state_text)] = self._match(event, state_text)
+    def _match(self, event: str, state_text: str) -> tuple[SIPCallCallback, ...]:
+        return tuple(cb for cb in self.callbacks if cb.event == event and (event != "call_state" or cb.on_state_text in (state_text, "ANY")))
+    def get(self, event: str, state_text: str) -> tuple[SIPCallCallback, ...]:
+        cbs = self.table.get((event, state_text))
+        if cbs is None:
+            # A state PJSIP's added since
+            cbs = self.table[(event, state_text)] = self._match(event, state_text)
+        return cbs
+
 
 # Really I'll just use this to validate that the IM i send has been accepted in its response
 class SIPInstantMessageStatusStateCallback():
@@ -1,8 +1,9 @@
 import pjsua2 as pj
 import threading
-from config import PJSUA_LOG_LEVEL
+from config import PJSUA_LOG_LEVEL, SIP_CONF_CLOCK_RATE, SIP_THREAD_COUNT, SIP_MAIN_THREAD_ONLY, SIP_EVENT_POLL_MS
 from logging_config import get_logger
 from .sip_account import SIPAccount
+from .sip_threads import ensure_thread_registered, reset_thread_registrations
 
 class SIPHandler:
     def __init__(self, bind_ip: str, bind_port: int):
@@ -31,6 +32,21 @@ class SIPHandler:
         self.logger.debug(f"Attaching LogConfig to EpConfig")
         ep_config.logConfig = log_config
 
+        # Run the conference bridge at the panels' codec rate, otherwise every port gets resampled to/from 16kHz
+        self.logger.debug(f"Setting conference bridge clock rate. clockRate={SIP_CONF_CLOCK_RATE}")
+        ep_config.medConfig.clockRate = SIP_CONF_CLOCK_RATE
+        ep_config.medConfig.sndClockRate = SIP_CONF_CLOCK_RATE
+
+        # PJSIP's own worker threads. With none, or with callbacks kept to the creating thread, events are
+        # only handled when handle_events_until polls libHandleEvents
+        self.logger.debug(f"Setting threading. threadCnt={SIP_THREAD_COUNT}, mainThreadOnly={SIP_MAIN_THREAD_ONLY}")
+        ep_config.uaConfig.threadCnt = SIP_THREAD_COUNT
+        ep_config.uaConfig.mainThreadOnly = SIP_MAIN_THREAD_ONLY
+        self.polls_events = SIP_MAIN_THREAD_ONLY or SIP_THREAD_COUNT == 0
+        self.event_poll_ms = SIP_EVENT_POLL_MS
+        self.polls = 0
+        self.events_handled = 0
+
         # Configure Transport Config
         self.logger.debug(f"Setting Transport Config boundAddress:port. boundAddress={self.bind_ip}, port={self.bind_port}")
         transport_config.port = self.bind_port
@@ -61,8 +77,29 @@ class SIPHandler:
         # Start the Endpoint now it's configured.
         self.logger.debug(f"Starting Endpoint")
         self.endpoint.libStart()
-        self.endpoint.libRegisterThread("thread-siphandler")
+        ensure_thread_registered(self.endpoint)
         self.logger.info("SIP handler started")
+
+    def handle_events_until(self, stop: threading.Event):
+        """ Run on the thread that created the endpoint. Polls PJSIP's events if it's set up to need it, otherwise just waits """
+        if not self.polls_events:
+            stop.wait()
+            return
+        self.logger.info(f"Polling SIP events. poll_ms={self.event_poll_ms}")
+        while not stop.is_set():
+            # Returns as soon as there's something to handle, so poll_ms only sets how long an idle wait is
+            self.events_handled += max(0, self.endpoint.libHandleEvents(self.event_poll_ms))
+            self.polls += 1
+
+    def get_stats(self) -> dict:
+        return {
+            "thread_count": self.ep_config.uaConfig.threadCnt,
+            "main_thread_only": self.ep_config.uaConfig.mainThreadOnly,
+            "polls_events": self.polls_events,
+            "event_poll_ms": self.event_poll_ms,
+            "polls": self.polls,
+            "events_handled": self.events_handled,
+        }
     
     def register_account(self, sip_handle: str):
         # Create Account's RTP config and mark it's IP's
@@ -101,9 +138,10 @@ class SIPHandler:
     def stop(self):
         self.logger.info("Stopping SIPHandler")
         # Register thread because the Endpoint's running in another one and will shit the bed if main touches it
-        self.endpoint.libRegisterThread("main-thread")
+        ensure_thread_registered(self.endpoint)
         self.logger.info("Destroying Account")
         self.account.destroy()
         self.logger.info("Destorying Endpoint")
         self.endpoint.libDestroy()
+        reset_thread_registrations()
         self.logger.info("SIP handler stopped.")
\ No newline at end of file
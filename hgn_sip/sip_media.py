@@ -3,11 +3,30 @@ from logging_config import get_logger
 
 port_logger = get_logger("dummy-audio-media-port")
 
-def get_audio_format() -> pj.MediaFormatAudio:
+DEFAULT_CLOCK_RATE = 48000
+FRAME_TIME_USEC = 20000
+
+# Codecs where the rate PJMEDIA decodes at isn't what the SDP/stream info reports
+# G.722 is the classic one, it says 8000 for "historical reasons" but is actually 16000
+CODEC_CLOCK_RATE_OVERRIDES = {
+    "G722": 16000,
+}
+
+def get_audio_format(clock_rate: int = DEFAULT_CLOCK_RATE) -> pj.MediaFormatAudio:
     af = pj.MediaFormatAudio()
     af.type = pj.PJMEDIA_TYPE_AUDIO
-    af.clockRate = 48000
+    af.clockRate = clock_rate
     af.channelCount = 1
     af.bitsPerSample = 16
-    af.frameTimeUsec = 20000
-    return af
\ No newline at end of file
+    af.frameTimeUsec = FRAME_TIME_USEC
+    return af
+
+def get_codec_clock_rate(stream_info: pj.StreamInfo) -> int:
+    """ Return the PCM clock rate of the negotiated codec for a call's audio stream """
+    codec_name = stream_info.codecName.upper()
+    if codec_name in CODEC_CLOCK_RATE_OVERRIDES:
+        return CODEC_CLOCK_RATE_OVERRIDES[codec_name]
+    if stream_info.codecClockRate > 0:
+        return stream_info.codecClockRate
+    port_logger.debug(f"No clock rate on stream info, using default. codec={codec_name}, default={DEFAULT_CLOCK_RATE}")
+    return DEFAULT_CLOCK_RATE
@@ -0,0 +1,40 @@
+import threading
+
+import pjsua2 as pj
+from logging_config import get_logger
+
+logger = get_logger("sip_threads")
+
+# PJSUA2 has to know about every thread that calls into it. Checking with libIsThreadRegistered is a trip into
+# PJSIP each time, so once a thread's registered it's remembered here and later checks are a thread-local lookup.
+# The generation goes up when the library's destroyed, as registrations don't outlive it.
+_local = threading.local()
+_lock = threading.Lock()
+_generation = 0
+_registered_threads: set[str] = set()
+
+def ensure_thread_registered(ep: pj.Endpoint = None) -> None:
+    """ Register the calling thread with PJSUA2, if this library instance hasn't seen it yet """
+    if getattr(_local, "generation", None) == _generation:
+        return
+    ep = ep or pj.Endpoint.instance()
+    name = threading.current_thread().name
+    if not ep.libIsThreadRegistered():
+        logger.debug(f"Registering thread with PJSUA2. thread_name={name}")
+        ep.libRegisterThread(name)
+    with _lock:
+        _registered_threads.add(name)
+    _local.generation = _generation
+
+def reset_thread_registrations() -> None:
+    """ The library's been destroyed, threads have to register again with the next one """
+    global _generation
+    with _lock:
+        _generation += 1
+        _registered_threads.clear()
+
+def get_stats() -> dict:
+    with _lock:
+        return {
+            "registered_threads": sorted(_registered_threads),
+        }
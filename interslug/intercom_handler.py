@@ -1,26 +1,28 @@
 from typing import TYPE_CHECKING
 
-from interslug.state.call_backs import cb_on_endcall_remove_from_call_manager, cs_cb_on_callstate_call_manager_update
+from interslug.state.call_backs import cb_on_endcall_release_call_media, cb_on_endcall_remove_from_call_manager, cs_cb_on_callstate_call_manager_update, cb_on_media_state_prepare_call_media
 if TYPE_CHECKING:
     from hgn_sip.sip_account import SIPAccount
     from hgn_sip.sip_handler import SIPHandler
+    from hgn_sip.sip_call_info import CallInfoSnapshot
 
-from pjsua2 import CallInfo, OnInstantMessageStatusParam, SipRxData
+from pjsua2 import OnInstantMessageStatusParam, SipRxData
 from logging_config import get_logger
 from hgn_sip.sip_call import SIPCall
 from hgn_sip.sip_handler import SIPHandler
+from hgn_sip.sip_threads import ensure_thread_registered
 from hgn_sip.sip_callbacks import SIPCallStateCallback, SIPInstantMessageStatusStateCallback, SIPCallCallback
 from intercom_sender import UnlockButtonPushXML
 from interslug.wall_panel import WallPanel, get_wall_panel_building
-from config import WALL_PANELS
+from interslug.media_cookery.prompts import prompt_cache
+from config import WALL_PANELS, SIP_CONF_CLOCK_RATE
 from service_helper import stop_event
 
-import time 
 
 # Callback which is triggered when a SIPCall is Connected
 # This will send a SIP MESSAGE to the RemoteURI (wallpanel prob) containing the Unlock XML
 # as though you had just pressed "Unlock" on the Intercom
-def cs_cb_send_unlock_on_connected(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfo'):
+def cs_cb_send_unlock_on_connected(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfoSnapshot'):
     logger = get_logger("cs_cb_send_unlock_on_connected")
     logger.info("Callback has been triggered")
 
@@ -57,11 +59,10 @@ def trigger_send_unlock_to_wallpanel(target_panel, sip_account: 'SIPAccount'):
             logger.info(f"Destination panel found. ip={panel.ip}, name={panel.name}, sip_handle={panel.sip_handle}, sip_uri={panel.sip_uri}")
             dest_wall_panel = panel
     
-    sip_account.ep.libRegisterThread("web-thread") # ThreadSaFeTy
+    ensure_thread_registered(sip_account.ep) # ThreadSaFeTy
 
     new_call = SIPCall(acc=sip_account, callbacks=sip_account.onCallCallbacks)
-    new_call.make_call(dest_wall_panel.sip_uri)
-    sip_account.calls.append(new_call)
+    new_call.make_call(dest_wall_panel.sip_uri)  # Stores itself on the account once it has an id
 
 # Callbacks to run when an IM Delivery Status is received to SIPAccount
 on_im_status_callbacks = [
@@ -71,6 +72,8 @@ call_callbacks = [
     SIPCallCallback("call_state", cs_cb_on_callstate_call_manager_update, on_state_text="ANY"),
     SIPCallCallback("call_state", cs_cb_send_unlock_on_connected, on_state_text="CONFIRMED"),
     # SIPCallCallback("call_state", cb_on_endcall_remove_from_call_manager, on_state_text="DISCONNECTED"),
+    SIPCallCallback("call_media_state", cb_on_media_state_prepare_call_media),
+    SIPCallCallback("end_call", cb_on_endcall_release_call_media, inline=True),
     SIPCallCallback("end_call", cb_on_endcall_remove_from_call_manager),
 
 ]
@@ -85,8 +88,9 @@ class IntercomSIPHandler():
         self.sip_handler.register_account(self.sip_identifier)
         self.sip_handler.account.onCallCallbacks = call_callbacks
         self.sip_handler.account.onInstantMessageCallbacks = on_im_status_callbacks
-        while not stop_event.is_set():
-            time.sleep(1)
+        # Decode prompts now rather than on the first call. Panels talk at the bridge rate, so that's the likely format
+        prompt_cache.preload(SIP_CONF_CLOCK_RATE)
+        self.sip_handler.handle_events_until(stop_event)
         self.stop()
 
     def stop(self):
@@ -5,22 +5,29 @@ import pjsua2 as pj
 import asyncio
 
 from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
 from av.audio.frame import AudioFrame
 
-from hgn_sip.sip_media import get_audio_format
+from hgn_sip.sip_media import FRAME_TIME_USEC
+from hgn_sip.sip_threads import ensure_thread_registered
 from logging_config import get_logger
-from .queuing import Q_LIST_TYPE_SIP_TO_BROWSER, get_from_queue, add_frame_to_queue, get_queue_by_id, get_queue_list_by_type
+from config import WEBRTC_AUDIO_CLOCK_RATE, UPLINK_MAX_BUFFERED_FRAMES
+from .queuing import Q_LIST_TYPE_SIP_TO_BROWSER, Queue, get_from_queue, add_frame_to_queue, queue_registry
 from .frames import ReturnFrame, create_zero_frame
+from .resampling import PolyphaseResampler
+from .dsp import AudioStage
+from .ring_buffer import AudioRingBuffer
 
-get_queue_list_by_type(Q_LIST_TYPE_SIP_TO_BROWSER)
-### NEED TO MANAGE QUEUES SOMEWHERE GLOBALLY
-### "FRAMEQUEUES"
+from typing import TYPE_CHECKING, Callable
+if TYPE_CHECKING:
+    from interslug.state.call_state import CallState
 
 class SIPAudioBridge(pj.AudioMediaPort):
     """ 
-        Audio Bridge to connect to SIP audio stream. This will receive frames from it and add them to the relevant queue for consumption
+        Audio Bridge to connect to SIP audio stream. This will receive frames from it and add them to each listener's queue for consumption
+        Only attached to the call while something is listening (see CallState.add_listener)
         INPUT: Frame from direct SIP Audio Stream
-        OUTPUT: Frame to SIP->Browser Queue
+        OUTPUT: Frame to SIP->Browser Queue(s)
     """
     def __init__(self, call_id: str):
         super().__init__()
@@ -28,58 +35,163 @@ class SIPAudioBridge(pj.AudioMediaPort):
         self.name: str
         self.call_id = call_id
         self.format: pj.MediaFormatAudio
-        self.queue = get_queue_by_id(get_queue_list_by_type(Q_LIST_TYPE_SIP_TO_BROWSER),self.call_id)
+        # One queue per listener. Replaced rather than mutated, so the media thread can iterate it without a lock
+        self.queues: list[Queue] = []
+        self.stages: list[AudioStage] = []  # Run in order on each frame before it's fanned out
+        self.call_audio_media: pj.AudioMedia = None
         self.total_frames = 0
         self.dropped_frames = 0
+        self.stage_time = 0.0  # Seconds spent in stages, to keep an eye on the frame budget
 
     def createPort(self, port_name, audio_format: pj.MediaFormatAudio):
         self.logger.debug(f"Registering port name={port_name}")
         self.port_name = port_name
         self.format = audio_format
         super().createPort(port_name, audio_format)
+
+    def add_queue(self, queue: Queue):
+        if queue not in self.queues:
+            self.queues = self.queues + [queue]
+
+    def remove_queue(self, queue: Queue):
+        self.queues = [q for q in self.queues if q is not queue]
+
+    def add_stage(self, stage: AudioStage, first: bool = False):
+        self.stages = [stage] + self.stages if first else self.stages + [stage]
+
+    def remove_stage(self, stage: AudioStage):
+        self.stages = [s for s in self.stages if s is not stage]
+
+    def attach(self, call_audio_media: pj.AudioMedia):
+        """ Start receiving the call's audio """
+        self.logger.debug(f"Attaching to call audio. call_id={self.call_id}")
+        call_audio_media.startTransmit(self)
+        self.call_audio_media = call_audio_media
+
     def kill(self):
-        inf: pj.ConfPortInfo = self.getPortInfo()
-        self.__disown__
+        """ Stop receiving the call's audio. The port itself is destroyed once the last reference to it is dropped """
+        self.logger.debug(f"Detaching from call audio. call_id={self.call_id}, total={self.total_frames}, dropped={self.dropped_frames}")
+        self.queues = []
+        if self.call_audio_media is not None:
+            try:
+                self.call_audio_media.stopTransmit(self)
+            except pj.Error as e:
+                # Call media may already be gone if the call disconnected first
+                self.logger.debug(f"Unable to stop transmit, error={e.reason}")
+            self.call_audio_media = None
     
     def onFrameReceived(self, frame: pj.MediaFrame):
         """Forward SIP audio to the browser."""
+        queues = self.queues
+        if not queues and not self.stages:
+            return
         audio_data = np.frombuffer(bytes(frame.buf), dtype=np.int16) # Convert PJSIP Buffer object to an NP array of signed 16b ints
         self.total_frames += 1
-        try:
-            add_frame_to_queue(audio_data, self.queue)
-            # self.logger.debug(f"queued frame. total={self.total_frames}, dropped={self.dropped_frames}")
-            # self.queue.put_nowait(audio_data) # add to the queue
-        except asyncio.QueueFull:
-            self.dropped_frames += 1
-            pass
-
-class SIPToBrowserAudioTrack(MediaStreamTrack): 
+        if self.stages:
+            started = time.perf_counter()
+            for stage in self.stages:
+                audio_data = stage.process(audio_data)
+            self.stage_time += time.perf_counter() - started
+        for queue in queues:
+            try:
+                add_frame_to_queue(audio_data, queue)
+            except asyncio.QueueFull:
+                self.dropped_frames += 1
+
+class PacedAudioTrack(MediaStreamTrack):
+    """
+        Base for tracks going out to aiortc. Frames are emitted in real time at out_clock_rate,
+        with pts counted in output samples.
+    """
+    kind = "audio"
+    def __init__(self):
+        super().__init__()
+        # Frames go out to aiortc at this rate. Conversion happens here, once, rather than in the conference bridge
+        self.out_clock_rate = WEBRTC_AUDIO_CLOCK_RATE
+        self.frametime_sec = FRAME_TIME_USEC * 0.000001
+
+    def _build_frame(self, out_audio_data: np.ndarray) -> AudioFrame:
+        self._last_out_samples = len(out_audio_data)
+        frame = AudioFrame(format="s16", layout="mono", samples=len(out_audio_data))
+        for p in frame.planes:
+            p.update(out_audio_data)
+        frame.pts = self._timestamp # Presentation Timestamp in time_base units
+        frame.sample_rate = self.out_clock_rate
+        frame.time_base = fractions.Fraction(1, self.out_clock_rate) # Time base is 1/samplerathed of a second. e.g. 1/48000 = 0.0000208s
+        return frame
+
+    def _silence(self) -> np.ndarray:
+        return np.zeros(int(self.frametime_sec * self.out_clock_rate), dtype=np.int16)
+
+    async def _wait_for_next_frame(self):
+        # Timing logic to make sure frame is emitted at correct interval (see frametime_sec)
+        # Timestamps are in output samples, as that's what the pts is measured in
+        if hasattr(self, "_timestamp"):
+            self._timestamp += self._last_out_samples
+            wait = self._start + (self._timestamp / self.out_clock_rate) - time.time()
+            await asyncio.sleep(wait)
+        else:
+            self._start = time.time()
+            self._timestamp = 0
+
+class SIPToBrowserAudioTrack(PacedAudioTrack): 
     """
         AudioStreamTrack for use with WebRTC. Takes frames from the queue and outputs them
         Timing must be maintained to maintain realtimeness.
+        The track starts gated, emitting silence without touching the queue, until open_gate is called.
+        That lets it be added to a peer connection (and negotiated) before anyone has answered.
         INPUT: Frames from SIP->Browser Queue
         OUTPUT: Frames to WebRTC
     """
-    kind = "audio"
-    def __init__(self, stream_queue_id: str):
+    def __init__(self, stream_queue_id: str, audio_format: pj.MediaFormatAudio = None, call_id: str = None):
         super().__init__()
         self.stream_queue_id = stream_queue_id
         self.logger = get_logger(f'dummy-AudioStreamTrack[{self.id}]')
-        self.format = get_audio_format()
-        self.frametime_sec = self.format.frameTimeUsec * 0.000001
-        self.queue = get_queue_by_id(get_queue_list_by_type(Q_LIST_TYPE_SIP_TO_BROWSER),stream_queue_id)
+        # Format of the frames coming off the queue (the SIPAudioBridge's format). May not be known until the call's media is up
+        self.format: pj.MediaFormatAudio = None
+        self.resampler: PolyphaseResampler = None
+        if audio_format is not None:
+            self.set_audio_format(audio_format)
+        # Queue is owned by the call, so it's released with it (see CallManager.remove_call)
+        self.queue = queue_registry.create_queue(Q_LIST_TYPE_SIP_TO_BROWSER, stream_queue_id, owner_id=call_id)
+        self.gate_open = False
+        self.gate_opened_at: float = None
+        self.first_audio_latency: float = None # Seconds from the answer request to the first real frame going out
+        self.on_first_audio = None # Optional fn(latency_sec) called once when the first real frame goes out
         self.total_frames = 0
         self.zero_frames = 0
         self.malformed_frames = 0
         self.avg_frame_age = 0
         self.total_wait = 0
 
+    def set_audio_format(self, audio_format: pj.MediaFormatAudio):
+        self.format = audio_format
+        self.frametime_sec = self.format.frameTimeUsec * 0.000001
+        self.resampler = PolyphaseResampler(self.format.clockRate, self.out_clock_rate)
+
+    def open_gate(self, audio_format: pj.MediaFormatAudio = None, requested_at: float = None):
+        """
+            Start passing through frames from the queue.
+            requested_at is when the answer was requested, and is what first audio latency is measured from.
+        """
+        if audio_format is not None:
+            self.set_audio_format(audio_format)
+        if self.format is None:
+            raise ValueError("Audio format must be set before the gate is opened")
+        self.gate_opened_at = requested_at if requested_at is not None else time.time()
+        self.gate_open = True
+
     def get_stats(self):
-        return f"total_frames={self.total_frames}, zero_frames={self.zero_frames}, avg_frame_age={self.avg_frame_age}s, total_wait={self.total_wait}s"
+        return f"total_frames={self.total_frames}, zero_frames={self.zero_frames}, avg_frame_age={self.avg_frame_age}s, total_wait={self.total_wait}s, first_audio_latency={self.first_audio_latency}s"
     def update_stats(self, frame: ReturnFrame):
         self.total_frames += 1
         if frame.is_zero_frame:
             self.zero_frames += 1
+        elif self.first_audio_latency is None:
+            self.first_audio_latency = time.time() - self.gate_opened_at
+            self.logger.debug(f"First audio frame out. latency={self.first_audio_latency}s")
+            if self.on_first_audio is not None:
+                self.on_first_audio(self.first_audio_latency)
         self.total_wait += frame.age_in_sec
         self.avg_frame_age = self.total_wait / self.total_frames
 
@@ -91,18 +203,15 @@ class SIPToBrowserAudioTrack(MediaStreamTrack):
             Receive a frame from the Sip-> Browser Queue (and remove it)
             then return it back after timing and transformation.
         """
+        await self._wait_for_next_frame()
+
+        if not self.gate_open:
+            # Not answered yet, keep the sender ticking over with silence
+            return self._build_frame(self._silence())
+
         # Expected number of samples in the Frame. This should be the frame length (in seconds) multiplied by the clockrate
         # e.g. 8000hz with 0.02s frametime --> expect 160 samples
         expected_samples = int(self.frametime_sec * self.format.clockRate)
-        
-        # Timing logic to make sure frame is emitted at correct interval (see frametime_sec)
-        if hasattr(self, "_timestamp"):
-            self._timestamp += expected_samples
-            wait = self._start + (self._timestamp / self.format.clockRate) - time.time()
-            await asyncio.sleep(wait)
-        else:
-            self._start = time.time()
-            self._timestamp = 0
             
         # Audio data is retrieved from the queue up to a maximum age, older Frames are dropped.
         # a "zero" frame is returned if Queue ends up empty.
@@ -114,11 +223,112 @@ class SIPToBrowserAudioTrack(MediaStreamTrack):
             audio_frame = create_zero_frame(expected_samples)
             
         self.update_stats(audio_frame)
-        frame = AudioFrame(format="s16", layout="mono", samples=expected_samples)
-        for p in frame.planes:
-            p.update(audio_frame.audio_data)
-        frame.pts = self._timestamp # Presentation Timestamp in time_base units
-        frame.sample_rate = self.format.clockRate 
-        frame.time_base = fractions.Fraction(1, self.format.clockRate) # Time base is 1/samplerathed of a second. e.g. 1/8000 = 0.000125s
         # self.logger.debug(f"received frame. total={self.total_frames}, zero_frames={self.zero_frames}")
-        return frame
+        return self._build_frame(self.resampler.process(audio_frame.audio_data))
+
+
+class BrowserToSIPAudioBridge(pj.AudioMediaPort):
+    """
+        Audio Bridge to send a browser's microphone into a SIP call.
+        Frames are pulled from the WebRTC track on the asyncio loop, downmixed and resampled to the call's format,
+        then written to a ring buffer. PJSIP's media thread drains the ring in onFrameRequested.
+        INPUT: Frames from the browser's MediaStreamTrack
+        OUTPUT: Frames to the SIP Call's AudioMedia
+    """
+    def __init__(self, queue_id: str, track: MediaStreamTrack):
+        super().__init__()
+        self.logger = get_logger(f"browser-to-sip-audio-bridge[{queue_id}]")
+        self.queue_id = queue_id
+        self.track = track
+        self.format: pj.MediaFormatAudio = None
+        self.frame_samples = 0
+        self.ring: AudioRingBuffer = None
+        self.resampler: PolyphaseResampler = None # Created once the browser's rate is known
+        self.out_buffer: np.ndarray = None
+        self.call_audio_media: pj.AudioMedia = None
+        self.pull_task: asyncio.Task = None
+        self.tap: Callable[[np.ndarray], None] = None  # Gets a copy of every frame sent to SIP, e.g. CallRecorder
+        self.received_frames = 0
+        self.total_frames = 0
+        self.underrun_frames = 0
+
+    def get_stats(self):
+        overrun_samples = self.ring.overrun_samples if self.ring is not None else 0
+        buffered_samples = self.ring.available if self.ring is not None else 0
+        return f"received_frames={self.received_frames}, total_frames={self.total_frames}, underrun_frames={self.underrun_frames}, overrun_samples={overrun_samples}, buffered_samples={buffered_samples}"
+
+    def start(self, call_state: 'CallState'):
+        """ Register the port in the call's format, connect it to the call and start pulling from the browser's track """
+        ensure_thread_registered()
+        self.format = call_state.get_audio_format()
+        self.frame_samples = int(self.format.frameTimeUsec * 0.000001 * self.format.clockRate)
+        # Ring is capped so a stalled SIP side can't build up more than a few frames of delay
+        self.ring = AudioRingBuffer(self.frame_samples * UPLINK_MAX_BUFFERED_FRAMES)
+        self.out_buffer = np.zeros(self.frame_samples, dtype=np.int16)
+
+        self.logger.debug(f"Registering port. clockRate={self.format.clockRate}")
+        self.createPort(f"BrowserUplink-{self.queue_id}", self.format)
+        call_audio_media = call_state.sip_call.get_call_audio_media()
+        self.startTransmit(call_audio_media)
+        self.call_audio_media = call_audio_media
+        if call_state.recorder is not None:
+            call_state.recorder.attach_uplink(self)
+        self.pull_task = asyncio.create_task(self._pull_frames())
+
+    def kill(self):
+        self.logger.debug(f"Stopping uplink. {self.get_stats()}")
+        self.tap = None
+        if self.pull_task is not None:
+            self.pull_task.cancel()
+            self.pull_task = None
+        if self.call_audio_media is not None:
+            try:
+                ensure_thread_registered()
+                self.stopTransmit(self.call_audio_media)
+            except pj.Error as e:
+                self.logger.error(f"Unable to stop transmit, error={e.reason}")
+            self.call_audio_media = None
+        if self.ring is not None:
+            self.ring.clear()
+
+    async def _pull_frames(self):
+        while True:
+            try:
+                frame: AudioFrame = await self.track.recv()
+            except MediaStreamError:
+                self.logger.debug("Browser track ended")
+                return
+            self.received_frames += 1
+            self.ring.write(self._convert_frame(frame))
+
+    def _convert_frame(self, frame: AudioFrame) -> np.ndarray:
+        # Browser audio (Opus) comes in as 48kHz packed stereo, the call wants mono at its codec rate
+        channels = len(frame.layout.channels)
+        data = frame.to_ndarray()
+        if data.dtype.kind == "f":
+            data = data * 32767
+        if frame.format.is_planar:
+            mono = data.mean(axis=0) if channels > 1 else data[0]
+        else:
+            mono = data.reshape(-1, channels).mean(axis=1) if channels > 1 else data.reshape(-1)
+        mono = np.clip(mono, -32768, 32767).astype(np.int16)
+
+        if self.resampler is None or self.resampler.in_rate != frame.sample_rate:
+            self.logger.debug(f"Creating uplink resampler. in_rate={frame.sample_rate}, out_rate={self.format.clockRate}")
+            self.resampler = PolyphaseResampler(frame.sample_rate, self.format.clockRate)
+        return self.resampler.process(mono)
+
+    def onFrameRequested(self, frame: pj.MediaFrame):
+        """Feed browser audio to SIP."""
+        self.total_frames += 1
+        if self.ring.read_into(self.out_buffer) < self.frame_samples:
+            self.underrun_frames += 1
+        tap = self.tap
+        if tap is not None:
+            tap(self.out_buffer)
+        frame.type = pj.PJMEDIA_FRAME_TYPE_AUDIO
+        frame.buf = pj.ByteVector(self.out_buffer.tobytes())
+        frame.size = self.frame_samples * 2
+
+        if self.total_frames % 500 == 0:
+            self.logger.debug(self.get_stats())
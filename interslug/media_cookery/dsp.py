@@ -0,0 +1,152 @@
+from dataclasses import dataclass
+import math
+from typing import Callable
+
+import numpy as np
+
+from hgn_sip.sip_media import FRAME_TIME_USEC
+
+DBFS_FLOOR = -96.0  # Roughly the bottom of 16 bit PCM, used for digital silence
+INT16_FULL_SCALE = 32768.0
+
+def to_dbfs(value: float) -> float:
+    """ Convert a linear int16 amplitude to dBFS """
+    if value <= 0:
+        return DBFS_FLOOR
+    return max(DBFS_FLOOR, 20 * math.log10(value / INT16_FULL_SCALE))
+
+@dataclass
+class AudioLevel():
+    """ Level/VAD snapshot for one report interval """
+    rms_dbfs: float
+    peak_dbfs: float
+    gain_db: float
+    voice: bool
+
+class AudioStage():
+    """
+        One step of an SIPAudioBridge's processing chain. Gets each frame as int16 samples on
+        PJSIP's media thread and returns the frame to pass on, so it has to fit in the frame time.
+    """
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        return samples
+
+class EnergyVAD():
+    """
+        Energy based voice activity detector.
+        A frame is voice if it's a margin above the tracked noise floor. The floor follows quieter frames
+        down quickly and only creeps up, so steady background hum doesn't end up counted as speech.
+        Hangover keeps the gaps between words from flickering to silence.
+    """
+    def __init__(self, margin_db: float = 10.0, min_voice_dbfs: float = -50.0, hangover_frames: int = 15, floor_rise_db: float = 0.05):
+        self.margin_db = margin_db
+        self.min_voice_dbfs = min_voice_dbfs
+        self.hangover_frames = hangover_frames
+        self.floor_rise_db = floor_rise_db  # Per frame, 2.5dB/s at 20ms frames
+        self.noise_floor_dbfs = -60.0
+        self.hangover = 0
+        self.active = False  # This frame on its own was over the threshold, ignoring hangover
+
+    def update(self, rms_dbfs: float) -> bool:
+        if rms_dbfs < self.noise_floor_dbfs:
+            self.noise_floor_dbfs = 0.7 * self.noise_floor_dbfs + 0.3 * rms_dbfs
+        else:
+            self.noise_floor_dbfs += min(self.floor_rise_db, rms_dbfs - self.noise_floor_dbfs)
+
+        self.active = rms_dbfs > max(self.noise_floor_dbfs + self.margin_db, self.min_voice_dbfs)
+        if self.active:
+            self.hangover = self.hangover_frames
+            return True
+        if self.hangover > 0:
+            self.hangover -= 1
+            return True
+        return False
+
+class AutomaticGainControl():
+    """
+        Moves the gain towards a target speech level, only adapting while there's voice so noise
+        between words isn't pumped up. Gain comes down faster than it goes up.
+        A peak limiter sits on top: if the gain would push the frame over the ceiling it's cut
+        straight away for that frame, increases are ramped across the frame to avoid zipper noise.
+    """
+    def __init__(self, target_dbfs: float = -18.0, max_gain_db: float = 20.0, min_gain_db: float = -10.0,
+                 increase_db_per_frame: float = 0.2, decrease_db_per_frame: float = 1.5, ceiling_dbfs: float = -1.0):
+        self.target_dbfs = target_dbfs
+        self.max_gain_db = max_gain_db
+        self.min_gain_db = min_gain_db
+        self.increase_db_per_frame = increase_db_per_frame
+        self.decrease_db_per_frame = decrease_db_per_frame
+        self.ceiling = INT16_FULL_SCALE * 10 ** (ceiling_dbfs / 20)
+        self.gain_db = 0.0        # What the AGC wants
+        self.applied_gain = 1.0   # Linear gain at the end of the last frame, after limiting
+        self.limited_frames = 0
+
+    def process(self, samples: np.ndarray, rms_dbfs: float, peak: float, adapt: bool) -> np.ndarray:
+        """ samples is float32, and is scaled in place """
+        if adapt:
+            error = self.target_dbfs - (rms_dbfs + self.gain_db)
+            step = min(error, self.increase_db_per_frame) if error > 0 else max(error, -self.decrease_db_per_frame)
+            self.gain_db = min(self.max_gain_db, max(self.min_gain_db, self.gain_db + step))
+
+        gain = 10 ** (self.gain_db / 20)
+        if peak * gain > self.ceiling:
+            gain = self.ceiling / peak
+            self.limited_frames += 1
+
+        if gain < self.applied_gain or len(samples) < 2:
+            # Cut immediately, a ramp down would let the start of the frame through over the ceiling
+            samples *= gain
+        else:
+            samples *= np.linspace(self.applied_gain, gain, len(samples), dtype=np.float32)
+        self.applied_gain = gain
+        return samples
+
+class AudioDSPStage(AudioStage):
+    """
+        Level metering, VAD and (optionally) AGC for one call's audio, in a single vectorised pass per frame.
+        Every report interval, or straight away when voice starts/stops, on_level is called with the
+        loudest frame of the interval. That runs on PJSIP's media thread, so it should only hand off.
+    """
+    def __init__(self, agc_target_dbfs: float = None, report_interval_ms: int = 100, on_level: Callable[[AudioLevel], None] = None):
+        self.vad = EnergyVAD()
+        self.agc = AutomaticGainControl(target_dbfs=agc_target_dbfs) if agc_target_dbfs is not None else None
+        self.on_level = on_level
+        self.report_every = max(1, report_interval_ms * 1000 // FRAME_TIME_USEC)
+        self.frames = 0
+        self.voice = False
+        self._interval_rms = 0.0
+        self._interval_peak = 0.0
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        if len(samples) == 0:
+            return samples
+        x = samples.astype(np.float32)  # Float first, abs() of -32768 overflows int16
+        peak = float(np.max(np.abs(x)))
+        rms = math.sqrt(float(np.dot(x, x)) / len(x))
+        rms_dbfs = to_dbfs(rms)
+        voice = self.vad.update(rms_dbfs)
+
+        if self.agc is not None:
+            # Only adapt on frames that are voice themselves, hangover frames may be the silence after it
+            self.agc.process(x, rms_dbfs, peak, self.vad.active)
+            samples = np.clip(np.rint(x), -32768, 32767).astype(np.int16)
+
+        self._report(rms, peak, voice)
+        return samples
+
+    def _report(self, rms: float, peak: float, voice: bool):
+        self.frames += 1
+        self._interval_rms = max(self._interval_rms, rms)
+        self._interval_peak = max(self._interval_peak, peak)
+        if self.frames % self.report_every != 0 and voice == self.voice:
+            return
+        self.voice = voice
+        if self.on_level is not None:
+            self.on_level(AudioLevel(
+                rms_dbfs=round(to_dbfs(self._interval_rms), 1),
+                peak_dbfs=round(to_dbfs(self._interval_peak), 1),
+                gain_db=round(self.agc.gain_db, 1) if self.agc is not None else 0.0,
+                voice=voice,
+            ))
+        self._interval_rms = 0.0
+        self._interval_peak = 0.0
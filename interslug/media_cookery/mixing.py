@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pjsua2 as pj
+
+from logging_config import get_logger
+from .bridges import PacedAudioTrack
+from .frames import ReturnFrame
+from .queuing import Q_LIST_TYPE_SIP_TO_BROWSER, Queue, get_from_queue, queue_registry
+from .resampling import PolyphaseResampler
+
+def mix_frames(frames: list[np.ndarray], gains: list[float], samples: int) -> np.ndarray:
+    """
+        Sum int16 frames with a gain per frame, saturating at the int16 limits rather than wrapping.
+        Frames are trimmed/padded to `samples` so one short frame can't throw the whole mix out.
+    """
+    stacked = np.zeros((len(frames), samples), dtype=np.float32)
+    for row, frame in zip(stacked, frames):
+        n = min(samples, len(frame))
+        row[:n] = frame[:n]
+    mixed = np.asarray(gains, dtype=np.float32) @ stacked
+    return np.clip(np.rint(mixed), -32768, 32767).astype(np.int16)
+
+@dataclass
+class MixSource():
+    """ One call feeding a MixedAudioTrack. Registered with the call's SIPAudioBridge like any other listener """
+    call_id: str
+    stream_queue_id: str
+    queue: Queue
+    resampler: PolyphaseResampler
+    expected_samples: int
+    gain: float = 1.0
+    zero_frames: int = 0
+
+class MixedAudioTrack(PacedAudioTrack):
+    """
+        A single outbound track carrying any number of calls, so a browser listening to several panels
+        only needs one sender and one encoder.
+        Each source has its own queue (fed by that call's SIPAudioBridge) and resampler, as calls can
+        have different codecs. Every frame time one frame is taken from each source and they're mixed.
+        INPUT: Frames from one SIP->Browser Queue per call
+        OUTPUT: Mixed frames to WebRTC
+    """
+    def __init__(self, websocket_id: str):
+        super().__init__()
+        self.websocket_id = websocket_id
+        self.logger = get_logger(f"mixed-audio-track[{websocket_id}]")
+        # Replaced rather than mutated, calls can be dropped from PJSIP's thread while recv is iterating
+        self.sources: dict[str, MixSource] = {}
+        self.total_frames = 0
+        self.malformed_frames = 0
+
+    def add_source(self, call_id: str, audio_format: pj.MediaFormatAudio, gain: float = 1.0) -> MixSource:
+        stream_queue_id = f"c-{call_id}_ws-{self.websocket_id}_mix"
+        self.logger.debug(f"Adding source. call_id={call_id}, clockRate={audio_format.clockRate}, gain={gain}")
+        source = MixSource(
+            call_id=call_id,
+            stream_queue_id=stream_queue_id,
+            queue=queue_registry.create_queue(Q_LIST_TYPE_SIP_TO_BROWSER, stream_queue_id, owner_id=call_id),
+            resampler=PolyphaseResampler(audio_format.clockRate, self.out_clock_rate),
+            expected_samples=int(audio_format.frameTimeUsec * 0.000001 * audio_format.clockRate),
+            gain=gain,
+        )
+        self.sources = {**self.sources, call_id: source}
+        return source
+
+    def remove_source(self, call_id: str) -> MixSource:
+        source = self.sources.get(call_id)
+        if source is not None:
+            self.logger.debug(f"Removing source. call_id={call_id}, zero_frames={source.zero_frames}")
+            self.sources = {id: s for id, s in self.sources.items() if id != call_id}
+        return source
+
+    def set_gain(self, call_id: str, gain: float):
+        source = self.sources.get(call_id)
+        if source is not None:
+            source.gain = gain
+
+    async def _read_source(self, source: MixSource) -> np.ndarray:
+        audio_frame: ReturnFrame = await get_from_queue(source.queue, self.frametime_sec * 5, source.expected_samples)
+        if len(audio_frame.audio_data) != source.expected_samples:
+            self.malformed_frames += 1
+            audio_frame.is_zero_frame = True
+        if audio_frame.is_zero_frame:
+            source.zero_frames += 1
+            # Still run silence through, so the resampler's history stays continuous
+            return source.resampler.process(np.zeros(source.expected_samples, dtype=np.int16))
+        return source.resampler.process(audio_frame.audio_data)
+
+    async def recv(self):
+        await self._wait_for_next_frame()
+        self.total_frames += 1
+
+        sources = list(self.sources.values())
+        if not sources:
+            return self._build_frame(self._silence())
+
+        out_samples = int(self.frametime_sec * self.out_clock_rate)
+        frames = [await self._read_source(source) for source in sources]
+        return self._build_frame(mix_frames(frames, [source.gain for source in sources], out_samples))
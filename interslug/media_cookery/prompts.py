@@ -0,0 +1,192 @@
+from math import gcd
+import os
+import threading
+
+import av
+import numpy as np
+import pjsua2 as pj
+
+from logging_config import get_logger
+from config import PROMPT_DIR, PROMPT_CACHE_DIR
+
+logger = get_logger("prompt-cache")
+
+class PromptCache():
+    """
+        Prompts decoded once into raw mono int16 PCM at a given clock rate, kept on disk next to the
+        sources and memory-mapped. Playing a prompt is then just reading from the map, no decoding,
+        and the OS shares/pages the PCM rather than every call holding its own copy.
+        An entry is rebuilt when the source file's mtime or size changes.
+        For playing, the PCM is also cut once into ready-made frames (get_frames), shared by every call.
+    """
+    def __init__(self, source_dir: str = PROMPT_DIR, cache_dir: str = PROMPT_CACHE_DIR, max_loop_frames: int = 3000):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.max_loop_frames = max_loop_frames
+        self.lock = threading.Lock()
+        # (name, clock_rate) -> (source mtime_ns, source size, PCM)
+        self.entries: dict[tuple[str, int], tuple[int, int, np.memmap]] = {}
+        # (name, clock_rate, frame_samples, loop) -> (PCM they were cut from, frames)
+        self.frames: dict[tuple[str, int, int, bool], tuple[np.ndarray, tuple[pj.ByteVector, ...]]] = {}
+        self.decodes = 0
+
+    def has_prompt(self, name: str) -> bool:
+        """ Whether name is a prompt file in source_dir. For names from outside, before anything's decoded """
+        return isinstance(name, str) and name == os.path.basename(name) and os.path.isfile(os.path.join(self.source_dir, name))
+
+    def get(self, name: str, clock_rate: int) -> np.ndarray:
+        """ Return the prompt's samples at clock_rate, decoding it if the cache is missing or stale """
+        name = os.path.basename(name)  # Prompts only come from source_dir
+        source_path = os.path.join(self.source_dir, name)
+        st = os.stat(source_path)
+        key = (name, clock_rate)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                return entry[2]
+
+            cache_path = os.path.join(self.cache_dir, f"{name}.{clock_rate}.pcm")
+            if not self._cache_file_valid(cache_path, st):
+                self._decode_to_file(source_path, cache_path, clock_rate, st)
+            pcm = np.memmap(cache_path, dtype=np.int16, mode="r") if os.path.getsize(cache_path) > 0 else np.zeros(0, dtype=np.int16)
+            self.entries[key] = (st.st_mtime_ns, st.st_size, pcm)
+            return pcm
+
+    def get_frames(self, name: str, clock_rate: int, frame_samples: int, loop: bool = False) -> tuple[pj.ByteVector, ...]:
+        """ Return the prompt cut into frames of frame_samples, ready to hand to PJSIP as they are """
+        pcm = self.get(name, clock_rate)
+        key = (os.path.basename(name), clock_rate, frame_samples, loop)
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is not None and entry[0] is pcm:
+                return entry[1]
+        frames = self._cut_frames(pcm, frame_samples, loop)
+        with self.lock:
+            self.frames[key] = (pcm, frames)
+        return frames
+
+    def _cut_frames(self, pcm: np.ndarray, frame_samples: int, loop: bool) -> tuple[pj.ByteVector, ...]:
+        if len(pcm) == 0:
+            return ()
+        if not loop:
+            # The last frame's padded with silence
+            stream = np.concatenate((pcm, np.zeros(-len(pcm) % frame_samples, dtype=np.int16)))
+        else:
+            # Played round and round, the frame over the end carries on into the start. Enough passes are cut for
+            # the frames to line up with the start again, so there's no gap or repeat wherever it wraps
+            passes = frame_samples // gcd(len(pcm), frame_samples)
+            if passes * len(pcm) // frame_samples <= self.max_loop_frames:
+                stream = np.resize(pcm, passes * len(pcm))
+            else:
+                # Too long to cut that many times over. Still no gap, the next pass restarts, repeating under a frame
+                stream = np.resize(pcm, len(pcm) + (-len(pcm) % frame_samples))
+        return tuple(pj.ByteVector(stream[i:i + frame_samples].tobytes()) for i in range(0, len(stream), frame_samples))
+
+    def preload(self, clock_rate: int, names: list[str] = None):
+        """ Decode prompts ahead of the first call that needs them. Every file in source_dir by default """
+        if names is None:
+            if not os.path.isdir(self.source_dir):
+                return
+            names = [name for name in os.listdir(self.source_dir) if os.path.isfile(os.path.join(self.source_dir, name))]
+        for name in names:
+            try:
+                self.get(name, clock_rate)
+            except (OSError, av.FFmpegError) as e:
+                logger.error(f"Unable to load prompt. name={name}, error={e}")
+
+    def _cache_file_valid(self, cache_path: str, source_stat: os.stat_result) -> bool:
+        # The cache file's mtime is stamped with the source's when it's written (see _decode_to_file)
+        try:
+            return os.stat(cache_path).st_mtime_ns == source_stat.st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def _decode_to_file(self, source_path: str, cache_path: str, clock_rate: int, source_stat: os.stat_result):
+        logger.debug(f"Decoding prompt. source={source_path}, clockRate={clock_rate}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=clock_rate)
+        tmp_path = f"{cache_path}.tmp"
+        try:
+            with av.open(source_path) as container, open(tmp_path, "wb") as out:
+                for frame in container.decode(audio=0):
+                    for resampled in resampler.resample(frame):
+                        out.write(resampled.to_ndarray().tobytes())
+                for resampled in resampler.resample(None):
+                    out.write(resampled.to_ndarray().tobytes())
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.utime(tmp_path, ns=(source_stat.st_mtime_ns, source_stat.st_mtime_ns))
+        # Swap in whole, so nothing ever maps a half written file
+        os.replace(tmp_path, cache_path)
+        self.decodes += 1
+
+    def get_stats(self) -> dict:
+        return {
+            "prompts": len(self.entries),
+            "frame_sets": len(self.frames),
+            "decodes": self.decodes,
+        }
+
+prompt_cache = PromptCache()
+
+class PromptPlayer(pj.AudioMediaPort):
+    """
+        Plays cached prompts into a call. PJSIP's media thread is handed the PromptCache's ready-cut frames
+        one after another, so playing a prompt allocates nothing and decodes nothing.
+        INPUT: Prompt frames from the PromptCache, in the call's format
+        OUTPUT: Frames to the SIP Call's AudioMedia
+    """
+    def __init__(self, audio_format: pj.MediaFormatAudio):
+        super().__init__()
+        self.logger = get_logger("prompt-player")
+        self.format = audio_format
+        self.frame_samples = int(audio_format.frameTimeUsec * 0.000001 * audio_format.clockRate)
+        self.silence = pj.ByteVector(bytes(self.frame_samples * 2))
+        # [frames, next frame, loop]. Replaced whole by play/stop, so the media thread never sees half of a change
+        self._playing: list = None
+        self.call_audio_media: pj.AudioMedia = None
+        self.plays = 0
+
+    def attach(self, call_audio_media: pj.AudioMedia):
+        self.call_audio_media = call_audio_media
+        self.startTransmit(call_audio_media)
+
+    def kill(self):
+        self.stop()
+        if self.call_audio_media is not None:
+            try:
+                self.stopTransmit(self.call_audio_media)
+            except pj.Error as e:
+                self.logger.debug(f"Unable to stop transmit, error={e.reason}")
+            self.call_audio_media = None
+
+    def play(self, frames: tuple[pj.ByteVector, ...], loop: bool = False):
+        """ frames from PromptCache.get_frames, cut at this player's frame_samples (and loop) """
+        self.plays += 1
+        self._playing = [frames, 0, loop] if len(frames) > 0 else None
+
+    def stop(self):
+        self._playing = None
+
+    def is_playing(self) -> bool:
+        return self._playing is not None
+
+    def onFrameRequested(self, frame: pj.MediaFrame):
+        frame.type = pj.PJMEDIA_FRAME_TYPE_AUDIO
+        frame.size = self.frame_samples * 2
+        playing = self._playing
+        if playing is None:
+            frame.buf = self.silence
+            return
+
+        frames, index, loop = playing
+        frame.buf = frames[index]
+        index += 1
+        if index == len(frames):
+            if loop:
+                index = 0
+            elif self._playing is playing:
+                self._playing = None
+        playing[1] = index
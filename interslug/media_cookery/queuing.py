@@ -1,8 +1,10 @@
 import asyncio
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import threading
 import time
 from .frames import QueuedFrame, ReturnFrame, create_zero_frame
 from logging_config import get_logger
+from config import QUEUE_IDLE_TTL_SEC
 
 
 @dataclass 
@@ -12,46 +14,117 @@ class Queue():
     """
     id_str: str
     queue: asyncio.Queue
-
-@dataclass
-class QueueListType():
-    type_name: str
-    queues: list[Queue]
+    owner_id: str = None  # Call the queue belongs to, it's released along with it
+    last_used: float = field(default_factory=time.time)
+    frame_bytes: int = 0  # Size of the last frame through, for memory estimates
 
 
 logger = get_logger("queue-helpers")
 
-MASTER_QUEUE_LIST: list[QueueListType] = []
-
 Q_LIST_TYPE_SIP_TO_BROWSER = "Q_LIST_SIP_TO_BROWSER"
-Q_LIST_TYPE_BROWSER_TO_SIP = "Q_LIST_BROWSER_TO_SIP"
-
-def get_queue_list_by_type(type_name: str) -> QueueListType:
-    global MASTER_QUEUE_LIST
-    for qlt in MASTER_QUEUE_LIST:
-        if qlt.type_name == type_name:
-            return qlt
-    logger.debug(f"Creating Queue List {type_name}")
-    qlt = QueueListType(type_name, [])
-    MASTER_QUEUE_LIST.append(qlt)
-    return qlt
-
-def get_queue_by_id(queue_list: QueueListType, id_str: str) -> Queue:
-    for queue in queue_list.queues:
-        if queue.id_str == id_str:
+
+class QueueRegistry():
+    """
+        Frame queues indexed by list type, then queue id.
+        Queues are created explicitly, belong to a call (owner_id) and are released with it.
+        Anything left idle for longer than the TTL is evicted, checked whenever a queue is created, unless its call
+        is still up (add_owner until release_owner): a held or silent call's queues are idle but still in use.
+    """
+    def __init__(self, idle_ttl_sec: float = QUEUE_IDLE_TTL_SEC, max_queue_size: int = 5):
+        self.queues: dict[str, dict[str, Queue]] = {}
+        self.owners: set[str] = set()  # Calls that are up, their queues go with release_owner rather than eviction
+        self.lock = threading.Lock()  # Created on the asyncio loop, released from the PJSIP thread
+        self.idle_ttl_sec = idle_ttl_sec
+        self.max_queue_size = max_queue_size
+        self.last_eviction = time.time()
+        self.created = 0
+        self.released = 0
+        self.evicted = 0
+
+    def create_queue(self, type_name: str, id_str: str, owner_id: str = None) -> Queue:
+        """ Create a queue, or return the existing one with this id """
+        self._maybe_evict_idle()
+        with self.lock:
+            queues = self.queues.setdefault(type_name, {})
+            if id_str in queues:
+                return queues[id_str]
+            logger.debug(f"Creating Queue id_str={id_str} in queue_list={type_name}, owner_id={owner_id}")
+            queue = Queue(id_str, asyncio.Queue(maxsize=self.max_queue_size), owner_id)
+            queues[id_str] = queue
+            self.created += 1
             return queue
-        
-    logger.debug(f"Creating Queue id_str={id_str} in queue_list={queue_list.type_name}")
-    queue = Queue(id_str, asyncio.Queue(maxsize=5))
-    queue_list.queues.append(queue)
-    return queue
+
+    def get_queue(self, type_name: str, id_str: str) -> Queue:
+        """ Return a queue by id, or None. Never creates """
+        return self.queues.get(type_name, {}).get(id_str)
+
+    def release_queue(self, type_name: str, id_str: str) -> None:
+        with self.lock:
+            if self.queues.get(type_name, {}).pop(id_str, None) is not None:
+                logger.debug(f"Released Queue id_str={id_str} in queue_list={type_name}")
+                self.released += 1
+
+    def add_owner(self, owner_id: str) -> None:
+        """ A call's up, its queues are kept however idle until release_owner """
+        with self.lock:
+            self.owners.add(owner_id)
+
+    def release_owner(self, owner_id: str) -> int:
+        """ Release every queue belonging to a call """
+        count = 0
+        with self.lock:
+            self.owners.discard(owner_id)
+            for queues in self.queues.values():
+                for id_str in [id_str for id_str, queue in queues.items() if queue.owner_id == owner_id]:
+                    del queues[id_str]
+                    count += 1
+            self.released += count
+        if count > 0:
+            logger.debug(f"Released queues for owner. owner_id={owner_id}, count={count}")
+        return count
+
+    def evict_idle(self) -> int:
+        cutoff = time.time() - self.idle_ttl_sec
+        count = 0
+        with self.lock:
+            for queues in self.queues.values():
+                for id_str in [id_str for id_str, queue in queues.items() if queue.last_used < cutoff and queue.owner_id not in self.owners]:
+                    del queues[id_str]
+                    count += 1
+            self.evicted += count
+            self.last_eviction = time.time()
+        if count > 0:
+            logger.debug(f"Evicted idle queues. count={count}, ttl={self.idle_ttl_sec}s")
+        return count
+
+    def _maybe_evict_idle(self):
+        if time.time() - self.last_eviction > self.idle_ttl_sec / 2:
+            self.evict_idle()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            all_queues = [queue for queues in self.queues.values() for queue in queues.values()]
+            live = {type_name: len(queues) for type_name, queues in self.queues.items()}
+        queued_frames = sum(queue.queue.qsize() for queue in all_queues)
+        return {
+            "live": live,
+            "owners": len(self.owners),
+            "queued_frames": queued_frames,
+            "queued_bytes": sum(queue.queue.qsize() * queue.frame_bytes for queue in all_queues),
+            "created": self.created,
+            "released": self.released,
+            "evicted": self.evicted,
+        }
+
+queue_registry = QueueRegistry()
 
 def add_frame_to_queue(audio_data, queue: Queue):
     """
         Add a Frame to a given queue with a timestamp to track age
     """
     obj = QueuedFrame(audio_data, len(audio_data), time.time())
-    
+    queue.last_used = obj.timestamp_added
+    queue.frame_bytes = audio_data.nbytes
     queue.queue.put_nowait(obj)
 async def get_from_queue(queue: Queue, max_age: float, expected_sample_size: int):
     """
@@ -60,6 +133,7 @@ async def get_from_queue(queue: Queue, max_age: float, expected_sample_size: int
     """
     logger = get_logger("get_from_queue")
     now = time.time()
+    queue.last_used = now
     while not queue.queue.empty():
         frame: QueuedFrame = await queue.queue.get()
         return_frame = ReturnFrame(frame.audio_data, frame.samples, frame.timestamp_added)
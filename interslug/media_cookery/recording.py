@@ -0,0 +1,224 @@
+import os
+import re
+import threading
+import time
+import wave
+
+import av
+import numpy as np
+
+from logging_config import get_logger
+from config import RECORDING_DIR, RECORDING_FORMAT, RECORDING_SEGMENT_SEC, RECORDING_MAX_BYTES, RECORDING_MAX_AGE_SEC
+from .dsp import AudioStage
+from .ring_buffer import AudioRingBuffer
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .bridges import BrowserToSIPAudioBridge
+
+logger = get_logger("call-recorder")
+
+RECORDING_EXTENSIONS = {
+    "wav": ".wav",
+    "ogg": ".ogg",
+}
+
+class WavSegmentWriter():
+    """
+        Stereo 16 bit WAV. The frame count is set up front for a full segment, so the header
+        only gets patched on close if the segment ends early and writes stay sequential.
+    """
+    def __init__(self, path: str, clock_rate: int, segment_samples: int):
+        self.file = wave.open(path, "wb")
+        self.file.setnchannels(2)
+        self.file.setsampwidth(2)
+        self.file.setframerate(clock_rate)
+        self.file.setnframes(segment_samples)
+
+    def write(self, interleaved: np.ndarray):
+        self.file.writeframesraw(interleaved.tobytes())
+
+    def close(self):
+        self.file.close()
+
+class OggOpusSegmentWriter():
+    """ Stereo Opus in an Ogg container, encoded with PyAV (already here for aiortc) """
+    def __init__(self, path: str, clock_rate: int, segment_samples: int):
+        self.clock_rate = clock_rate
+        self.container = av.open(path, "w", format="ogg")
+        self.stream = self.container.add_stream("libopus", rate=clock_rate, layout="stereo")
+        self.pts = 0
+
+    def write(self, interleaved: np.ndarray):
+        frame = av.AudioFrame.from_ndarray(interleaved.reshape(1, -1), format="s16", layout="stereo")
+        frame.sample_rate = self.clock_rate
+        frame.pts = self.pts
+        self.pts += len(interleaved) // 2
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+
+    def close(self):
+        for packet in self.stream.encode(None):
+            self.container.mux(packet)
+        self.container.close()
+
+SEGMENT_WRITERS = {
+    "wav": WavSegmentWriter,
+    "ogg": OggOpusSegmentWriter,
+}
+
+def enforce_retention(directory: str, max_bytes: int = RECORDING_MAX_BYTES, max_age_sec: float = RECORDING_MAX_AGE_SEC) -> int:
+    """ Delete recordings older than max_age_sec, then the oldest until the total is under max_bytes. Returns files deleted """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if os.path.splitext(name)[1] not in RECORDING_EXTENSIONS.values():
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue  # Another recorder got to it first
+            files.append((st.st_mtime, st.st_size, path))
+    files.sort()
+
+    cutoff = time.time() - max_age_sec if max_age_sec else None
+    total = sum(size for _, size, _ in files)
+    deleted = 0
+    for mtime, size, path in files:
+        if not ((cutoff is not None and mtime < cutoff) or (max_bytes and total > max_bytes)):
+            break
+        try:
+            os.remove(path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    if deleted > 0:
+        logger.debug(f"Retention removed recordings. deleted={deleted}, remaining_bytes={total}")
+    return deleted
+
+class RecorderTap(AudioStage):
+    """ SIPAudioBridge stage that copies the panel's audio into the recorder's ring and passes it on untouched """
+    def __init__(self, ring: AudioRingBuffer):
+        self.ring = ring
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        self.ring.write(samples)
+        return samples
+
+class CallRecorder():
+    """
+        Records a call as stereo, panel on the left and the browser's uplink on the right.
+        The media threads only copy into ring buffers. A writer thread drains them every drain_interval_sec
+        and streams fixed length segments to disk, so memory use is the same however long the call runs.
+        If the disk stalls for longer than buffer_sec the oldest audio is dropped, the media threads never wait.
+        Both taps run off PJSIP's conference clock, so the downlink is used as the timeline and the uplink
+        is read against it (silence where there's no uplink).
+    """
+    def __init__(self, call_id: str, clock_rate: int, directory: str = RECORDING_DIR, file_format: str = RECORDING_FORMAT,
+                 segment_sec: float = RECORDING_SEGMENT_SEC, buffer_sec: float = 5.0, drain_interval_sec: float = 0.25):
+        if file_format not in SEGMENT_WRITERS:
+            raise ValueError(f"Unknown recording format {file_format}, expected one of {list(SEGMENT_WRITERS)}")
+        self.call_id = call_id
+        self.clock_rate = clock_rate
+        self.file_format = file_format
+        self.root = directory
+        self.directory = os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", call_id))
+        self.segment_samples = int(segment_sec * clock_rate)
+        self.drain_interval_sec = drain_interval_sec
+
+        buffer_samples = int(buffer_sec * clock_rate)
+        self.downlink = AudioRingBuffer(buffer_samples)
+        self.uplink = AudioRingBuffer(buffer_samples)
+        self.downlink_tap = RecorderTap(self.downlink)
+        self.uplink_source: 'BrowserToSIPAudioBridge' = None
+        # Drain buffers, allocated once
+        self._down = np.zeros(buffer_samples, dtype=np.int16)
+        self._up = np.zeros(buffer_samples, dtype=np.int16)
+        self._interleaved = np.zeros(buffer_samples * 2, dtype=np.int16)
+
+        self.writer = None
+        self.segment_written = 0
+        self.segments = 0
+        self.samples_written = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"recorder-{call_id}", daemon=True)
+
+    def start(self):
+        logger.debug(f"Starting recording. call_id={self.call_id}, format={self.file_format}, directory={self.directory}")
+        self.thread.start()
+
+    def stop(self):
+        """ Returns straight away. The writer thread flushes what's buffered and closes the segment itself """
+        self.detach_uplink()
+        self.stop_event.set()
+
+    def attach_uplink(self, bridge: 'BrowserToSIPAudioBridge'):
+        # One uplink at a time, the latest browser to start talking takes over the right channel
+        self.detach_uplink()
+        bridge.tap = self.uplink.write
+        self.uplink_source = bridge
+
+    def detach_uplink(self, bridge: 'BrowserToSIPAudioBridge' = None):
+        if self.uplink_source is None or (bridge is not None and bridge is not self.uplink_source):
+            return
+        self.uplink_source.tap = None
+        self.uplink_source = None
+
+    def get_stats(self) -> dict:
+        return {
+            "segments": self.segments,
+            "seconds_written": self.samples_written / self.clock_rate,
+            "dropped_samples": self.downlink.overrun_samples,
+        }
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            stopping = self.stop_event.wait(self.drain_interval_sec)
+            try:
+                self._drain()
+            except Exception as e:
+                logger.error(f"Recording write failed, stopping. call_id={self.call_id}, error={e}")
+                stopping = True
+            if stopping:
+                break
+        self._close_segment()
+        logger.debug(f"Recording finished. call_id={self.call_id}, {self.get_stats()}")
+
+    def _drain(self):
+        n = self.downlink.available
+        if n == 0:
+            return
+        self.downlink.read_into(self._down[:n])
+        self.uplink.read_into(self._up[:n])
+        interleaved = self._interleaved[:n * 2]
+        interleaved[0::2] = self._down[:n]
+        interleaved[1::2] = self._up[:n]
+
+        offset = 0
+        while offset < n:
+            if self.writer is None:
+                self._open_segment()
+            take = min(n - offset, self.segment_samples - self.segment_written)
+            self.writer.write(interleaved[offset * 2:(offset + take) * 2])
+            self.segment_written += take
+            self.samples_written += take
+            offset += take
+            if self.segment_written >= self.segment_samples:
+                self._close_segment()
+
+    def _open_segment(self):
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}_{self.segments:04d}{RECORDING_EXTENSIONS[self.file_format]}"
+        path = os.path.join(self.directory, name)
+        self.writer = SEGMENT_WRITERS[self.file_format](path, self.clock_rate, self.segment_samples)
+        self.segment_written = 0
+        self.segments += 1
+
+    def _close_segment(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        enforce_retention(self.root)
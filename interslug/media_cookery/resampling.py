@@ -0,0 +1,76 @@
+from math import gcd
+
+import numpy as np
+
+class PolyphaseResampler():
+    """
+        Rational (L/M) polyphase resampler for mono int16 PCM.
+        The prototype lowpass is split into L phases so each output sample is a single dot product
+        against the input history, and a whole frame is done in one vectorised pass.
+        State (input history + output phase) carries across calls, so frames can be fed one at a time.
+        INPUT: int16 samples at in_rate
+        OUTPUT: int16 samples at out_rate
+    """
+    def __init__(self, in_rate: int, out_rate: int, taps_per_phase: int = 16, kaiser_beta: float = 8.0):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.passthrough = in_rate == out_rate
+
+        divisor = gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.taps_per_phase = taps_per_phase
+        # The lowpass needs taps_per_phase taps per cycle of whichever side's narrower, so a big decimation
+        # (48k -> 8k) gets a long enough filter to actually stop what would alias, not just up's worth.
+        # Padded to a whole number of phases
+        self.num_taps = -(-taps_per_phase * max(self.up, self.down) // self.up) * self.up
+        self.phase_len = self.num_taps // self.up
+
+        # Position of the next output sample, in units of 1/up input samples, relative to the next input block
+        self._phase = 0
+        self._history = np.zeros(self.phase_len - 1, dtype=np.float32)
+        self._bank = self._build_filter_bank(kaiser_beta)
+        # Offsets into [history + block] for each tap, newest sample first
+        self._tap_offsets = (self.phase_len - 1) - np.arange(self.phase_len)
+
+    def _build_filter_bank(self, kaiser_beta: float) -> np.ndarray:
+        # Windowed-sinc lowpass at the upsampled rate, cut off below the lower of the two Nyquists
+        num_taps = self.num_taps
+        cutoff = 0.5 / max(self.up, self.down) * 0.9
+        n = np.arange(num_taps) - (num_taps - 1) / 2
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(num_taps, kaiser_beta)
+        # Zero stuffing divides the level by `up`, so claw it back here
+        prototype *= self.up / prototype.sum()
+        # bank[phase, k] = prototype[phase + k * up]
+        return prototype.reshape(self.phase_len, self.up).T.astype(np.float32)
+
+    def output_samples_for(self, input_samples: int) -> int:
+        """ Number of samples the next call to process() will return for a block of input_samples """
+        total = input_samples * self.up
+        if self._phase >= total:
+            return 0
+        return -(-(total - self._phase) // self.down)
+
+    def reset(self):
+        self._phase = 0
+        self._history[:] = 0
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        if self.passthrough:
+            return samples
+
+        block = np.concatenate((self._history, samples.astype(np.float32)))
+        total = len(samples) * self.up
+
+        positions = np.arange(self._phase, total, self.down)
+        self._phase += len(positions) * self.down - total
+        self._history = block[len(block) - (self.phase_len - 1):]
+
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int16)
+
+        base = positions // self.up
+        phases = positions % self.up
+        windows = block[base[:, None] + self._tap_offsets[None, :]]
+        out = np.einsum("ij,ij->i", windows, self._bank[phases])
+        return np.clip(np.rint(out), -32768, 32767).astype(np.int16)
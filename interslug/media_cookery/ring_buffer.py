@@ -0,0 +1,59 @@
+import threading
+
+import numpy as np
+
+class AudioRingBuffer():
+    """
+        Fixed size ring of int16 samples which can be written on one thread and read on another
+        (e.g. the asyncio loop writing, PJSIP's media thread reading).
+        Storage is allocated once. If the writer gets ahead the oldest samples are dropped, so
+        the buffered latency can never exceed the capacity.
+    """
+    def __init__(self, capacity_samples: int):
+        self.capacity = capacity_samples
+        self.buffer = np.zeros(capacity_samples, dtype=np.int16)
+        self.lock = threading.Lock()
+        self.read_pos = 0
+        self.available = 0
+        self.overrun_samples = 0   # Dropped because the reader fell behind
+        self.underrun_samples = 0  # Padded with silence because the writer fell behind
+
+    def write(self, samples: np.ndarray):
+        with self.lock:
+            n = len(samples)
+            if n > self.capacity:
+                self.overrun_samples += n - self.capacity
+                samples = samples[n - self.capacity:]
+                n = self.capacity
+
+            # Make room by dropping the oldest samples
+            overflow = self.available + n - self.capacity
+            if overflow > 0:
+                self.read_pos = (self.read_pos + overflow) % self.capacity
+                self.available -= overflow
+                self.overrun_samples += overflow
+
+            write_pos = (self.read_pos + self.available) % self.capacity
+            first = min(n, self.capacity - write_pos)
+            self.buffer[write_pos:write_pos + first] = samples[:first]
+            self.buffer[:n - first] = samples[first:]
+            self.available += n
+
+    def read_into(self, out: np.ndarray) -> int:
+        """ Fill `out` from the ring, padding with silence on underrun. Returns the number of real samples read """
+        with self.lock:
+            n = min(len(out), self.available)
+            first = min(n, self.capacity - self.read_pos)
+            out[:first] = self.buffer[self.read_pos:self.read_pos + first]
+            out[first:n] = self.buffer[:n - first]
+            self.read_pos = (self.read_pos + n) % self.capacity
+            self.available -= n
+            if n < len(out):
+                out[n:] = 0
+                self.underrun_samples += len(out) - n
+            return n
+
+    def clear(self):
+        with self.lock:
+            self.read_pos = 0
+            self.available = 0
@@ -1,51 +1,91 @@
 import asyncio
-from dataclasses import dataclass
+import time
 import uuid
 from pyee import EventEmitter
 from websockets.asyncio.server import ServerConnection
-from aiortc import RTCPeerConnection, RTCSessionDescription, RTCDataChannel, MediaStreamTrack, RTCIceCandidate
+from aiortc import RTCConfiguration, RTCIceServer, RTCPeerConnection, RTCSessionDescription, RTCDataChannel, MediaStreamTrack, RTCIceCandidate
+from aiortc.sdp import candidate_from_sdp
 from interslug.messages.message_builder import message_to_str
 from logging_config import get_logger
+from config import RTC_ICE_SERVERS
 
-@dataclass
-class IncomingRTCIceCandidate():
-    candidate: str
-    sdpMid: str
-    sdpMLineIndex: int
-    usernameFragment: str
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from interslug.state.message_emitter import BrowserOutbox
 
-def component_str_to_int(component: str):
-    """ WebRTC uses the strings properly. somehow, aiortc is ints?? """
-    if component == "rtp":
-        return 1
-    if component == "rtcp":
-        return 2
+NEGOTIATION_DEBOUNCE_SEC = 0.05 # Track changes within this window go out as one offer
+
+def parse_ice_candidate(cd: dict) -> RTCIceCandidate:
+    """ Browser RTCIceCandidate.toJSON() -> aiortc candidate. The candidate line is SDP, with or without its "candidate:" prefix """
+    line: str = cd["candidate"]
+    if line.startswith("candidate:"):
+        line = line[len("candidate:"):]
+    candidate = candidate_from_sdp(line)
+    candidate.sdpMid = cd.get("sdpMid")
+    candidate.sdpMLineIndex = cd.get("sdpMLineIndex")
+    return candidate
 
 
 class RTCHandler():
-    def __init__(self, ws_connection: ServerConnection):
+    def __init__(self, ws_connection: ServerConnection, outbox: 'BrowserOutbox' = None):
         self.ws_connection = ws_connection
+        self.outbox = outbox  # Signalling goes out through the browser's outbox, which never drops it
         self.id = f"rtc_{uuid.uuid4()}"
         self.ws_id = ws_connection.id
         self.logger = get_logger(f"rtc-handler-{self.id}")
         
         self.logger.debug("initialising RTCPeerConnection")
-        self.pc = RTCPeerConnection()
+        self.pc = RTCPeerConnection(RTCConfiguration(iceServers=[RTCIceServer(url) for url in RTC_ICE_SERVERS]))
         self.add_default_listeners()
 
         self.emitter = EventEmitter()
+        self.loop = asyncio.get_running_loop()  # Created on the websocket handler, which is where the pc lives
 
         # Flags for state
         self.ready_to_transmit = False
-        self.negotiation_needed = False # LocalDescription has changed. New/Removed track, etc.
-        self.watch_negotiation = False # 
+        self.negotiation_needed = False # LocalDescription has changed. New/Removed track, etc. Cleared once an offer is sent
+        self.negotiation_handle: asyncio.TimerHandle = None # Pending debounced offer
+        self.negotiation_task: asyncio.Task = None # Offer currently being created/sent
+        self.offers_sent = 0
+
+        # Trickle ICE. Candidates that beat the remote description are held until it's set
+        self.pending_candidates: list[RTCIceCandidate] = []
+        self.pending_end_of_candidates = False
+        self.remote_candidates = 0
+        # Setup timing, measured from the first offer/answer exchange starting
+        self.setup_started_at: float = None
+        self.gathering_time: float = None       # Seconds aiortc spent gathering local candidates (setLocalDescription)
+        self.ice_connected_time: float = None   # Seconds to the first connected candidate pair
+        self.connected_time: float = None       # Seconds to DTLS up, i.e. media can flow
+
+    def request_negotiation(self):
+        """
+            Flag that the local description has changed. Safe from any thread.
+            Requests are debounced, so several track changes close together go out as one offer.
+        """
+        self.negotiation_needed = True
+        self.loop.call_soon_threadsafe(self._schedule_negotiation)
+
+    def _schedule_negotiation(self):
+        if self.negotiation_handle is not None or self.pc.connectionState == "closed":
+            return
+        self.negotiation_handle = self.loop.call_later(NEGOTIATION_DEBOUNCE_SEC, self._start_negotiation)
+
+    def _start_negotiation(self):
+        self.negotiation_handle = None
+        if not self.negotiation_needed:
+            return
+        if self.pc.signalingState != "stable" or (self.negotiation_task is not None and not self.negotiation_task.done()):
+            # Mid offer/answer already. on_signalingstatechange picks it up once that settles
+            self.logger.debug(f"Deferring negotiation. signalingState={self.pc.signalingState}")
+            return
+        self.negotiation_task = asyncio.create_task(self.update_local_description())
 
-    async def _watch_for_negotiation(self):
-        while self.watch_negotiation: 
-            if self.negotiation_needed:
-                self.pc.emit("negotiationneeded")
-                self.negotiation_needed = False
-            await asyncio.sleep(0.1)
+    def cancel_negotiation(self):
+        if self.negotiation_handle is not None:
+            self.negotiation_handle.cancel()
+            self.negotiation_handle = None
+        self.negotiation_needed = False
 
     async def on_track(self, track: MediaStreamTrack):
         self.logger.debug(f"Event Trigger [on_Track]. ")
@@ -64,22 +104,28 @@ class RTCHandler():
 
     async def on_connectionstatechange(self):
         new_state = self.pc.connectionState
-        self.watch_negotiation = False
         self.logger.debug(f"Event Trigger [on_ConnectionStateChange]. connectionState={new_state}")
         self.check_can_transmit()
-        if new_state == "connecting" or new_state == "connected" or new_state == "new":
-            self.logger.debug("enabling negotitation watch")
-            self.watch_negotiation = True
-            asyncio.create_task(self._watch_for_negotiation())
+        if new_state == "connected" and self.connected_time is None and self.setup_started_at is not None:
+            self.connected_time = time.time() - self.setup_started_at
+            self.logger.debug(f"Connected. {self.get_stats()}")
+            self.emitter.emit("connected", self)
+        if new_state == "closed" or new_state == "failed":
+            self.cancel_negotiation()
+
+    async def on_iceconnectionstatechange(self):
+        new_state = self.pc.iceConnectionState
+        self.logger.debug(f"Event Trigger [on_IceConnectionStateChange]. iceConnectionState={new_state}")
+        if new_state == "completed" and self.ice_connected_time is None and self.setup_started_at is not None:
+            self.ice_connected_time = time.time() - self.setup_started_at
 
     async def on_signalingstatechange(self):
         new_state = self.pc.signalingState
         self.logger.debug(f"Event Trigger [on_SignalingStateChange]. signalingState={new_state}")
         self.check_can_transmit()
-
-    async def on_negotiationneeded(self):
-        self.logger.debug(f"Event Trigger [on_NegotiationNeeded].")
-        await self.update_local_description()
+        if new_state == "stable" and self.negotiation_needed:
+            # Changes came in while the last offer/answer was in flight
+            self._schedule_negotiation()
 
     def add_default_listeners(self):
         async def on_track(track: MediaStreamTrack):
@@ -94,54 +140,106 @@ class RTCHandler():
             await self.on_connectionstatechange()
         async def on_signalingstatechange():
             await self.on_signalingstatechange()
-        async def on_negotiationneeded():
-            await self.on_negotiationneeded()
+        async def on_iceconnectionstatechange():
+            await self.on_iceconnectionstatechange()
         self.pc.add_listener("connectionstatechange", on_connectionstatechange)
         self.pc.add_listener("signalingstatechange", on_signalingstatechange)
-        self.pc.add_listener("negotiationneeded", on_negotiationneeded)
         self.pc.add_listener("datachannel", on_datachannel)
         self.pc.add_listener("track", on_track)
         self.pc.add_listener("icecandidate", on_icecandidate)
         self.pc.add_listener("icegatheringstatechange", on_icegatheringstatechange)
+        self.pc.add_listener("iceconnectionstatechange", on_iceconnectionstatechange)
 
     
     async def process_offer_and_form_answer(self, message: dict):
+        if self.setup_started_at is None:
+            self.setup_started_at = time.time()
         self.logger.debug("Calling setRemoteDescription()")
         await self.pc.setRemoteDescription(RTCSessionDescription(message["sdp"], "offer"))
+        await self._flush_pending_candidates()
         self.logger.debug("Calling createAnswer()")
         answer = await self.pc.createAnswer()
-        self.pc.connectionState
         self.logger.debug("Calling setLocalDescription()")
-        await self.pc.setLocalDescription(answer)
+        await self._set_local_description(answer)
 
         return {"sdp": self.pc.localDescription.sdp, "type": "answer"}
+
+    async def _set_local_description(self, description: RTCSessionDescription):
+        # aiortc gathers every local candidate in here and puts them (and end-of-candidates) in the SDP,
+        # it has no local trickle. Keeping iceServers short/empty is what keeps this quick on the LAN
+        started = time.time()
+        await self.pc.setLocalDescription(description)
+        if self.gathering_time is None:
+            self.gathering_time = time.time() - started
+            self.logger.debug(f"Local candidates gathered. seconds={self.gathering_time}")
     
     async def add_ice_candidate(self, message: dict):
-        cd_dict = message["candidate"]
-        cd_dict["component"] = component_str_to_int(cd_dict["component"])
-        candidate = RTCIceCandidate(**cd_dict)
+        """ A trickled candidate from the browser. A null/empty candidate means end-of-candidates """
+        cd_dict = message.get("candidate")
+        if not cd_dict or not cd_dict.get("candidate"):
+            self.logger.debug("Remote end-of-candidates")
+            if self.pc.remoteDescription is None:
+                self.pending_end_of_candidates = True
+            else:
+                await self.pc.addIceCandidate(None)
+            return
+
+        candidate = parse_ice_candidate(cd_dict)
+        self.remote_candidates += 1
+        if self.pc.remoteDescription is None:
+            self.logger.debug(f"Holding ICE Candidate until remote description is set. candidate={candidate}")
+            self.pending_candidates.append(candidate)
+            return
         self.logger.debug(f"Adding ICE Candidate. candidate={candidate}")
-    
-        # await self.pc.addIceCandidate(candidate)
+        await self.pc.addIceCandidate(candidate)
+
+    async def _flush_pending_candidates(self):
+        pending, self.pending_candidates = self.pending_candidates, []
+        for candidate in pending:
+            await self.pc.addIceCandidate(candidate)
+        if self.pending_end_of_candidates:
+            self.pending_end_of_candidates = False
+            await self.pc.addIceCandidate(None)
+
+    def get_stats(self) -> dict:
+        return {
+            "remote_candidates": self.remote_candidates,
+            "gathering_sec": self.gathering_time,
+            "ice_connected_sec": self.ice_connected_time,
+            "connected_sec": self.connected_time,
+            "offers_sent": self.offers_sent,
+        }
     
     async def add_track(self, audio_track):
         self.logger.debug("Attempting to add AudioTrack")
         self.pc.addTrack(audio_track)
-        self.logger.debug("Returning new offer/answer")
-        await self.update_local_description()
+        self.request_negotiation()
     
     async def update_local_description(self):
         try:
+            # Cleared before the awaits, so changes made while the offer is in flight get their own
+            self.negotiation_needed = False
+            if self.setup_started_at is None:
+                self.setup_started_at = time.time()
             offer = await self.pc.createOffer()
-            await self.pc.setLocalDescription(offer)
+            await self._set_local_description(offer)
             ld = {"sdp": self.pc.localDescription.sdp, "type": "offer"}
-            await self.ws_connection.send(message_to_str(ld, "RTC"))
-            self.negotiation_needed = False
+            await self.send_message(ld)
+            self.offers_sent += 1
+            self.logger.debug(f"Sent offer. offers_sent={self.offers_sent}")
         except Exception as e:
             self.logger.debug(e)
     
+    async def send_message(self, message: dict):
+        body = message_to_str(message, "RTC")
+        if self.outbox is not None:
+            self.outbox.put(body.encode("utf-8"))
+        else:
+            await self.ws_connection.send(body)
+
     async def update_remote_description(self, message):
         await self.pc.setRemoteDescription(RTCSessionDescription(message["sdp"], "answer"))
+        await self._flush_pending_candidates()
 
     def check_can_transmit(self):
         senders = self.pc.getSenders()
@@ -156,12 +254,28 @@ class RTCHandler():
             self.ready_to_transmit = False
         self.logger.debug(f"check_can_transmit: ready_to_transmit={self.ready_to_transmit}, senders={len(senders)}, receivers={len(receivers)}, connectionState={self.pc.connectionState}, signalingState={self.pc.signalingState}")
     
-    def kill_audio_sender(self):
+    async def close(self):
+        """ Tear down the peer connection, its tracks and every listener. The handler's finished with after this """
+        self.logger.debug(f"Closing. {self.get_stats()}")
+        self.cancel_negotiation()
+        if self.negotiation_task is not None and not self.negotiation_task.done():
+            self.negotiation_task.cancel()
+        for sender in self.pc.getSenders():
+            if sender.track:
+                sender.track.stop()
+        await self.pc.close()  # Stops the receivers' tracks and the transports
+        self.pc.remove_all_listeners()
+        self.emitter.remove_all_listeners()
+        self.pending_candidates = []
+        self.outbox = None
+
+    def kill_audio_sender(self, track: MediaStreamTrack = None):
+        # Kill the sender for a specific track, or all of them if not given
         self.logger.debug("killing audio senders")
-        senders = [sender for sender in self.pc.getSenders() if sender.track]
+        senders = [sender for sender in self.pc.getSenders() if sender.track and (track is None or sender.track is track)]
         for sender in senders:
             self.logger.debug(f"Replacing track in sender")
             sender.track.stop()
             sender.replaceTrack(None)
-        # Flag for renegotiation
-        self.negotiation_needed = True
\ No newline at end of file
+        if senders:
+            self.request_negotiation()
\ No newline at end of file
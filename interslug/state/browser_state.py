@@ -1,6 +1,7 @@
 from typing import TYPE_CHECKING
 
 from interslug.media_cookery.bridges import BrowserToSIPAudioBridge
+from interslug.state.message_emitter import BrowserOutbox
 from logging_config import get_logger
 
 
@@ -9,21 +10,25 @@ if TYPE_CHECKING:
     from interslug.rtc_handler import RTCHandler
     from aiortc import MediaStreamTrack
     from interslug.state.call_state import CallState
+    from interslug.media_cookery.mixing import MixedAudioTrack
 
 class BrowserState:
     """
         Represents a current Browser State.
         Contains:
-        - The websocket
+        - The websocket, and the outbox everything sent to it goes through
         - The Current CallState
         - The RTC Handler
+        - The MixedAudioTrack, if it's listening to calls without answering them
     """
     def __init__(self, websocket: 'ServerConnection'):
         self.logger = get_logger("BrowserState")
         self.websocket = websocket  # WebSocket connection object
+        self.outbox = BrowserOutbox(websocket)
         self.current_call_id: str = None  # Call ID if browser is in a call
         self.current_call: 'CallState' = None
         self.rtc_handler: 'RTCHandler' = None
+        self.mixed_track: 'MixedAudioTrack' = None  # Created on first listen_calls, then kept so changing calls needs no renegotiation
         self.listeners = {}
     def get_current_call_id(self) -> str:
         if self.current_call is not None and self.current_call.call_id:
@@ -32,9 +37,19 @@ class BrowserState:
         for id in self.listeners:
             listener = self.listeners[id]
             listener.kill()
-            listener = None
+        self.listeners.clear()
         self.current_call = None
         self.current_call_id = None
+    async def close(self):
+        """ Browser's gone, release everything it holds. The CallManager has already taken it out of its calls """
+        self.outbox.close()
+        self.deregister_current_call()
+        if self.mixed_track is not None:
+            self.mixed_track.stop()
+            self.mixed_track = None
+        if self.rtc_handler is not None:
+            rtc_handler, self.rtc_handler = self.rtc_handler, None
+            await rtc_handler.close()
     def assign_new_rtc_handler(self, rtc_handler: 'RTCHandler'):
         self.rtc_handler = rtc_handler
         
@@ -45,7 +60,16 @@ class BrowserState:
         # Browser's RTC has shared the track with RTC
         # Now I have it, in browser state.
         # I need to attach it to a media bridge, then link it to the Call
+        if track.kind != "audio":
+            return
+        if self.current_call is None:
+            self.logger.error("Audio track received but browser isn't in a call, ignoring")
+            return
         queue_id = f"audio_{self.current_call.call_id}"
+        if queue_id in self.listeners:
+            # Renegotiation can hand over a new track for the same call, swap it in
+            self.listeners.pop(queue_id).kill()
         self.logger.debug("Attaching audio track to new bridge")
         track_listener = BrowserToSIPAudioBridge(queue_id, track)
+        track_listener.start(self.current_call)
         self.listeners[queue_id] = track_listener
\ No newline at end of file
@@ -0,0 +1,116 @@
+import asyncio
+from collections import deque
+import time
+
+from typing import Any, Callable
+
+from logging_config import get_logger
+
+class CallActor():
+    """
+        One call's mailbox. Everything that has to happen to the call in order and involves the browsers
+        (pre-warming, answering, hanging up, tearing down) is a job in here, run one at a time on the loop.
+        Jobs can be plain functions or coroutine functions, a job awaiting a renegotiation holds up only
+        the rest of this call's jobs.
+        post() is safe from any thread and never waits, so PJSIP's threads hand work over without blocking
+        on the browsers. call() is for the loop, and waits for the job's result.
+        There's only a task while there are jobs, so a finished call's actor just goes idle.
+        Without a loop (SIP running with no web side) jobs run straight away on the caller's thread.
+    """
+    def __init__(self, call_id: str, loop: asyncio.AbstractEventLoop):
+        self.call_id = call_id
+        self.logger = get_logger(f"CallActor[{call_id}]")
+        self.loop = loop
+        self.mailbox: deque[tuple] = deque()  # (job, args, future or None, posted at)
+        self.task: asyncio.Task = None
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.busy_total = 0.0
+        self.job_max = 0.0
+
+    def post(self, job: Callable, *args) -> None:
+        """ Any thread. Queue job(*args) behind everything already posted, without waiting for it """
+        if self.loop is None:
+            self._run_inline(job, args)
+            return
+        item = (job, args, None, time.perf_counter())
+        if self._on_loop():
+            self._put(item)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError:
+            self.logger.error(f"Loop closed, dropping job. job={getattr(job, '__name__', job)}")
+
+    async def call(self, job: Callable, *args) -> Any:
+        """ Loop only. Queue job(*args) and wait for it to run, raising whatever it raised """
+        if self.loop is None:
+            result = job(*args)
+            return await result if asyncio.iscoroutine(result) else result
+        future = self.loop.create_future()
+        self._put((job, args, future, time.perf_counter()))
+        return await future
+
+    def _on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _run_inline(self, job: Callable, args: tuple) -> None:
+        try:
+            result = job(*args)
+            if asyncio.iscoroutine(result):
+                result.close()
+                self.logger.error(f"No loop to run coroutine job on. job={getattr(job, '__name__', job)}")
+        except Exception as e:
+            self.failed += 1
+            self.logger.error(f"Job failed. job={getattr(job, '__name__', job)}, error={e}")
+
+    def _put(self, item: tuple) -> None:
+        self.mailbox.append(item)
+        self.max_depth = max(self.max_depth, len(self.mailbox))
+        if self.task is None or self.task.done():
+            self.task = self.loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self.mailbox:
+            job, args, future, posted_at = self.mailbox.popleft()
+            if future is not None and future.cancelled():
+                continue
+            started = time.perf_counter()
+            waited = started - posted_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            try:
+                result = job(*args)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            except Exception as e:
+                self.failed += 1
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                else:
+                    self.logger.error(f"Job failed. job={getattr(job, '__name__', job)}, error={e}")
+            else:
+                if future is not None and not future.done():
+                    future.set_result(result)
+            took = time.perf_counter() - started
+            self.processed += 1
+            self.busy_total += took
+            self.job_max = max(self.job_max, took)
+
+    def get_stats(self) -> dict:
+        return {
+            "depth": len(self.mailbox),
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_wait_ms": 1000 * self.wait_total / self.processed if self.processed else None,
+            "max_wait_ms": 1000 * self.wait_max,
+            "busy_ms": 1000 * self.busy_total,
+            "max_job_ms": 1000 * self.job_max,
+        }
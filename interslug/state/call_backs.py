@@ -5,20 +5,29 @@ from logging_config import get_logger
 if TYPE_CHECKING:
     from hgn_sip.sip_call import SIPCall
     from hgn_sip.sip_account import SIPAccount
-    from pjsua2 import CallInfo
+    from hgn_sip.sip_call_info import CallInfoSnapshot
 
 # Callback provided to the SIPAccount, triggered on CallState Changes
-def cs_cb_on_callstate_call_manager_update(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfo'):
+def cs_cb_on_callstate_call_manager_update(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfoSnapshot'):
     l = get_logger(f"cs_cb_on_callstate_call_manager_update[{call_info.callIdString}]")
 
     if call_info.callIdString not in global_call_manager.calls:
         l.debug("Call doesn't exist in global_call_manager yet, registering")
-        global_call_manager.add_call(call_info.callIdString, call)
+        if global_call_manager.add_call(call_info.callIdString, call, call_info) is None:
+            return
     
     global_call_manager.update_call_info(call_info.callIdString, call_info)
 
-def cb_on_endcall_remove_from_call_manager(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfo'):
+# Runs inline, in PJSIP's DISCONNECTED callback, while the call's media can still be detached from
+def cb_on_endcall_release_call_media(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfoSnapshot'):
+    global_call_manager.release_call_media(call_info.callIdString)
+
+def cb_on_endcall_remove_from_call_manager(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfoSnapshot'):
     l = get_logger(f"cb_on_endcall_remove_from_call_manager[{call_info.callIdString}]")
     l.debug("calling remove_call from global_call_manager")
     global_call_manager.remove_call(call_info.callIdString)
 
+
+# Callback provided to the SIPAccount, triggered when a call's media is (re)negotiated
+def cb_on_media_state_prepare_call_media(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'CallInfoSnapshot'):
+    global_call_manager.prepare_call_media(call_info.callIdString)
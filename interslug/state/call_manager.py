@@ -1,92 +1,156 @@
 import asyncio
+from collections import deque
 from dataclasses import asdict
-from threading import Lock, Thread, current_thread
+import time
+from weakref import WeakSet
 from typing import TYPE_CHECKING
 
-from hgn_sip.sip_media import get_audio_format
-from interslug.media_cookery.bridges import SIPAudioBridge, SIPToBrowserAudioTrack
+import av
+import pjsua2 as pj
+
+from hgn_sip.sip_threads import ensure_thread_registered
+from interslug.media_cookery.bridges import SIPToBrowserAudioTrack
+from interslug.media_cookery.dsp import AudioLevel
+from interslug.media_cookery.mixing import MixedAudioTrack
+from interslug.media_cookery.prompts import prompt_cache
+from interslug.media_cookery.queuing import queue_registry
 from interslug.messages.message_builder import message_to_str
 from interslug.rtc_handler import RTCHandler
 from interslug.state.browser_state import BrowserState
+from interslug.state.call_actor import CallActor
+from interslug.state.call_snapshot import CallSnapshot, merge_call_deltas
 from interslug.state.call_state import CallState, get_sip_call_info
+from interslug.state.locking import InstrumentedLock
 from interslug.state.message_emitter import SocketMessenger, MessageChannel
 from logging_config import get_logger
+from config import MEDIA_PREWARM, RECORD_CALLS, PROMPT_WAITING
 
 
 if TYPE_CHECKING:
     from hgn_sip.sip_call import SIPCall
     from hgn_sip.sip_account import SIPAccount
     from websockets.asyncio.server import ServerConnection
-    from pjsua2 import CallInfo, Endpoint
+    from hgn_sip.sip_call_info import CallInfoSnapshot
 
 class CallManager:
     def __init__(self):
         self.calls: dict[str, CallState]       = {}  # Maps Call ID -> CallState objects
         self.browsers: dict[str, BrowserState] = {}  # Maps WebSocket ID -> BrowserState objects
-        self.lock = Lock()  # To ensure thread-safe operations
+        self.lock = InstrumentedLock("calls")  # Only around adding/removing calls and browsers. Per call changes take the CallState's lock
         self.logger = get_logger("CallManager")
-        self.sip_endpoint: Endpoint = None
         self.messenger = SocketMessenger(self)
+        self.call_snapshot = CallSnapshot()  # What browsers are told about calls, kept up to date from the call state callbacks
+        self.loop: asyncio.AbstractEventLoop = None  # Loop the websockets/RTC live on
+        self.first_audio_latencies: deque[tuple[bool, float]] = deque(maxlen=100)  # (prewarmed, seconds) per answer
+        self.rtc_setups: deque[dict] = deque(maxlen=100)  # RTCHandler.get_stats() of each connection as it came up
+        # Everything ever registered, only weakly. Anything still in here after its browser's gone is a leak
+        self.live_browsers: WeakSet[BrowserState] = WeakSet()
+        self.live_rtc_handlers: WeakSet[RTCHandler] = WeakSet()
+        self.closed_browsers = 0
         """
             a CallState has:
              - The SIPCall (sip_call)
              - The AudioPort (audio_port), which is the PJSUA2 AudioMediaPort
              - A list of Listeners (listeners), which is a list of aiortc.AudioStreamTrack keyed by Websocket ID
+             - Its CallActor (actor). PJSIP's threads only post browser side work to it, so SIP state changes
+               never wait on a browser's signalling, and a slow renegotiation only holds up its own call
         """
 
-    def set_endpoint(self,sip_call: 'SIPCall'): 
-        if self.sip_endpoint is None:
-            self.sip_endpoint = sip_call.acc.ep
-    
-    def check_or_register_thread(self):
-        if self.sip_endpoint is None:
-            raise Exception
-        thread = current_thread()
-        thread_name = thread.getName()
-        if not self.sip_endpoint.libIsThreadRegistered():
-            self.logger.debug(f"Registering thread in SIPEndpoint. thread_name={thread_name}")
-            self.sip_endpoint.libRegisterThread(thread_name)
+    def set_loop(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.messenger.start(loop)
+        for call_state in list(self.calls.values()):
+            call_state.actor.loop = loop  # Calls that came in before the loop was up
 
     def get_call(self, call_id: str) -> CallState:
         """ Get a CallState object by call_id"""
         if call_id in self.calls:
             return self.calls[call_id]
     
-    def update_call_info(self, call_id: str, call_info: 'CallInfo'):
+    def update_call_info(self, call_id: str, call_info: 'CallInfoSnapshot'):
         # Update the info in the CallState itself first
         call = self.get_call(call_id)
+        if call is None:
+            return
         call.update_call_info(call_info)
 
-        # Broadcast to all Websocket listeners
-        
-        data = asdict(get_sip_call_info(call.sip_call))
-        msg = {
-            "type": "on_call_status",
-            "call": data
-        }
-        self.messenger.queueMessageAll(MessageChannel.SIP, msg)
+        if MEDIA_PREWARM and call_info.stateText in ("INCOMING", "EARLY"):
+            self.prewarm_call(call)
+
+        # Broadcast what changed to all Websocket listeners. Built from the CallInfo PJSIP just gave us
+        self._publish_call_delta(self.call_snapshot.update, call_id, asdict(get_sip_call_info(call.sip_call, call_info)))
+
+    def _publish_call_delta(self, change, call_id: str, *args) -> None:
+        # Held across the change and the post, so deltas are queued in seq order
+        with self.call_snapshot.lock:
+            msg = change(call_id, *args)
+            if msg is not None:
+                self.messenger.queueMessageAll(MessageChannel.SIP, msg, coalesce_key="call_delta", merge=merge_call_deltas)
 
     # Add a new SIP call
-    def add_call(self, call_id: str, sip_call: 'SIPCall') -> CallState:
+    # Returns None if the call's already disconnected, as happens when its callbacks are running behind
+    def add_call(self, call_id: str, sip_call: 'SIPCall', call_info: 'CallInfoSnapshot' = None) -> CallState:
         self.logger.debug(f"Adding call. call_id={call_id}")
-        self.set_endpoint(sip_call)
         with self.lock:
+            # Checked under the lock, release_call_media looks the call up under it after the flag's set
+            if sip_call.disconnected:
+                self.logger.debug(f"Call already disconnected, not adding. call_id={call_id}")
+                return None
             if call_id in self.calls:
                 raise ValueError(f"Call with ID {call_id} already exists.")
-            self.calls[call_id] = CallState(sip_call)
-            return self.calls[call_id]
+            call_state = CallState(sip_call, call_info)
+            call_state.on_audio_level = self._queue_audio_level
+            call_state.actor = CallActor(call_id, self.loop)
+            self.calls[call_id] = call_state
+            # Inside the lock, so remove_call's release_owner can only come after it
+            queue_registry.add_owner(call_id)
+            return call_state
     
-    # Remove a SIP call
+    # The call's disconnected. Runs inside PJSIP's callback, as the call's media is destroyed once it returns
+    def release_call_media(self, call_id: str) -> None:
+        with self.lock:
+            call_state = self.calls.get(call_id)
+        if call_state is None:
+            return
+        with call_state.lock:
+            call_state.terminated = True
+            call_state.release_media()
+
+    # Remove a SIP call. Called from the SIP callbacks, the media's torn down here and the browsers are told by the call's actor
     def remove_call(self, call_id: str) -> None:
         self.logger.debug(f"Removing call. call_id={call_id}")
         with self.lock:
-            if call_id in self.calls:
-                call_state = self.calls.pop(call_id)
+            call_state = self.calls.pop(call_id, None)
+        if call_state is not None:
+            with call_state.lock:
                 self.logger.debug(f"active listeners={len(call_state.listeners)}")
-                for id in call_state.listeners:
-                    self.logger.debug(f"Removing call from browser. websocket_id={id}")
-                    self.browser_leave_call(id)
+                call_state.terminated = True
+                listeners = list(call_state.listeners.items())
+                monitors = list(call_state.monitors)
+                prewarmed = list(call_state.prewarmed.items())
                 call_state.terminate()  # Terminate audio port and tracks
+            queue_registry.release_owner(call_id)
+            # Behind anything already underway for the call, e.g. a browser answering it
+            call_state.actor.post(self._release_call_browsers, call_state, listeners, monitors, prewarmed)
+        self._publish_call_delta(self.call_snapshot.remove, call_id)
+
+    def _release_call_browsers(self, call_state: CallState, listeners: list[tuple[str, SIPToBrowserAudioTrack]], monitors: list[str], prewarmed: list[tuple[str, SIPToBrowserAudioTrack]]) -> None:
+        for websocket_id, track in listeners:
+            browser_state = self.browsers.get(websocket_id)
+            if browser_state is None:
+                continue
+            self.logger.debug(f"Removing call from browser. websocket_id={websocket_id}")
+            if browser_state.rtc_handler is not None:
+                browser_state.rtc_handler.kill_audio_sender(track)
+            if browser_state.current_call is call_state:
+                browser_state.deregister_current_call()
+            self.messenger.queueMessage(browser_state, MessageChannel.SIP, {"type": "call_disconnected"})
+        for websocket_id in monitors:
+            browser_state = self.browsers.get(websocket_id)
+            if browser_state is not None and browser_state.mixed_track is not None:
+                browser_state.mixed_track.remove_source(call_state.call_id)
+        for websocket_id, track in prewarmed:
+            self._remove_prewarmed_track(websocket_id, track)
 
     
     # Add a new browser
@@ -95,72 +159,366 @@ class CallManager:
         with self.lock:
             if websocket_id in self.browsers:
                 raise ValueError(f"Browser with WebSocket ID {websocket_id} already exists.")
-            self.browsers[websocket_id] = BrowserState(websocket)
-            return self.browsers[websocket_id]
+            browser_state = BrowserState(websocket)
+            browser_state.outbox.start()
+            self.browsers[websocket_id] = browser_state
+            self.live_browsers.add(browser_state)
+            return browser_state
     
-    # Remove a browser
-    def remove_browser(self, websocket_id: str) -> None:
+    # Remove a browser, and tear down its peer connection, tracks and outbox
+    async def remove_browser(self, websocket_id: str) -> None:
         self.logger.debug(f"Removing Browser. websocket_id={websocket_id}")
         with self.lock:
-            if websocket_id in self.browsers:
-                browser_state = self.browsers.pop(websocket_id)
-                self._handle_browser_leaving_call(browser_state)
+            browser_state = self.browsers.pop(websocket_id, None)
+        if browser_state is None:
+            return
+        call_state = browser_state.current_call
+        if call_state is not None:
+            await call_state.actor.call(self._handle_browser_leaving_call, browser_state)
+        if browser_state.mixed_track is not None:
+            for call_id in list(browser_state.mixed_track.sources):
+                self._stop_monitoring(websocket_id, call_id, browser_state)
+        for call_state in list(self.calls.values()):
+            with call_state.lock:
+                call_state.prewarmed.pop(websocket_id, None)
+                call_state.pending_monitors.pop(websocket_id, None)
+        await browser_state.close()
+        self.closed_browsers += 1
 
     # Get a BrowserState by ID
     def get_browser(self, websocket_id: str) -> BrowserState:
         if websocket_id in self.browsers:
             return self.browsers[websocket_id]
         raise KeyError(websocket_id)
+
+    def get_rtc_handler(self, websocket_id: str) -> RTCHandler:
+        browser = self.browsers.get(websocket_id)
+        return browser.rtc_handler if browser is not None else None
     
 
     # Add an RTCHandler to browser object
     def browser_add_rtc_handler(self, websocket_id:str, rtc_handler: RTCHandler):
         self.logger.debug(f"Adding RTC Handler to browser. websocket_id={websocket_id}")
         browser = self.get_browser(websocket_id)
+        if browser.rtc_handler is not None and browser.rtc_handler is not rtc_handler:
+            self.logger.debug(f"Replacing RTC Handler, closing the old one. websocket_id={websocket_id}")
+            asyncio.ensure_future(browser.rtc_handler.close())
         browser.assign_new_rtc_handler(rtc_handler)
+        rtc_handler.emitter.on("connected", self._record_rtc_setup)
+        self.live_rtc_handlers.add(rtc_handler)
+
+    def _record_rtc_setup(self, rtc_handler: RTCHandler) -> None:
+        self.rtc_setups.append(rtc_handler.get_stats())
     
-    # Handle a browser joining a call
+    # Handle a browser joining a call. Runs on the call's actor, so it's in order with pre-warming and teardown
     async def browser_join_call(self, websocket_id: str, call_id: str) -> None:
         self.logger.debug(f"Joining browser to call. websocket_id={websocket_id}, call_id={call_id}")
-        with self.lock:
-            if websocket_id not in self.browsers or call_id not in self.calls:
-                raise ValueError(f"Invalid WebSocket ID {websocket_id} or Call ID {call_id}.")
-            
-            # Get Browser and Call
-            browser_state = self.browsers[websocket_id]
-            call_state = self.calls[call_id]
-
-            self.check_or_register_thread() # Make sure thread registed
-            # Avoid duplicating browser
-            if websocket_id in call_state.listeners:
-                return
+        answered_at = time.time()
+        browser_state = self.browsers.get(websocket_id)
+        call_state = self.get_call(call_id)
+        if browser_state is None or call_state is None:
+            raise ValueError(f"Invalid WebSocket ID {websocket_id} or Call ID {call_id}.")
+        await call_state.actor.call(self._join_call, browser_state, call_state, answered_at)
+
+    async def _join_call(self, browser_state: BrowserState, call_state: CallState, answered_at: float) -> None:
+        websocket_id = browser_state.websocket.id
+        call_id = call_state.call_id
+        # Avoid duplicating browser, or joining a call that ended while this was queued
+        if call_state.terminated or websocket_id in call_state.listeners:
+            return
+        ensure_thread_registered() # Make sure thread registed
 
-            # Add browser to call listeners
+        # Set the CurrentCall object to browserstate
+        browser_state.current_call = call_state
+
+        with call_state.lock:
+            audio_stream_track = call_state.prewarmed.pop(websocket_id, None)
+        prewarmed = audio_stream_track is not None
+        if prewarmed:
+            # Track's already on the peer connection, nothing to negotiate
+            self.logger.debug("Using pre-warmed track")
+        else:
+            # Each listener gets its own queue, the SIPAudioBridge fans frames out to all of them
             stream_queue_id = f"c-{call_id}_ws-{websocket_id}"
+            audio_stream_track = SIPToBrowserAudioTrack(stream_queue_id, call_state.get_audio_format(), call_id)  # Emit audio FROM queue TO browser
+            # No lock held, SIP carries on while the browser renegotiates
+            await self._register_audio_track_to_rtc(websocket_id, audio_stream_track)
 
-            # temporary till sort IDs
-            stream_queue_id = call_id
+        with call_state.lock:
+            joined = not call_state.terminated
+            if joined:
+                call_state.stop_prompt()
+                # Add browser to call listeners. First one in attaches the SIPAudioBridge to the call
+                call_state.add_listener(websocket_id, audio_stream_track)
+        if not joined:
+            # Hung up while the browser was renegotiating
+            self.logger.debug(f"Call ended before browser joined. websocket_id={websocket_id}, call_id={call_id}")
+            browser_state.rtc_handler.kill_audio_sender(audio_stream_track)
+            browser_state.deregister_current_call()
+            return
+        audio_stream_track.on_first_audio = lambda latency: self._record_first_audio(call_id, websocket_id, prewarmed, latency)
+        audio_stream_track.open_gate(call_state.get_audio_format(), answered_at)
 
-            audio_stream_track = SIPToBrowserAudioTrack(stream_queue_id)  # Emit audio FROM queue TO browser
-            call_state.listeners[websocket_id] = audio_stream_track
+        msg = {
+            "type": "call_answered",
+            "call": self.call_snapshot.get(call_id)
+        }
+        self.messenger.queueMessage(browser_state, MessageChannel.SIP, msg)
 
-            # Set the CurrentCall object to browserstate
-            browser_state.current_call = call_state
+    # Handle a browser listening to a set of calls, mixed into one track, without answering them
+    async def browser_listen_calls(self, websocket_id: str, call_ids: list[str], gains: dict[str, float] = None) -> None:
+        self.logger.debug(f"Browser listening to calls. websocket_id={websocket_id}, call_ids={call_ids}")
+        gains = gains or {}
+        # A browser's messages are handled one at a time, so only the per call changes need locking
+        browser_state = self.get_browser(websocket_id)
+        if browser_state.rtc_handler is None:
+            raise ValueError(f"Browser has no RTC connection. websocket_id={websocket_id}")
+        ensure_thread_registered()
 
-            await self._register_audio_track_to_rtc(websocket_id, audio_stream_track) 
+        track = browser_state.mixed_track
+        new_track = track is None
+        if new_track:
+            track = MixedAudioTrack(websocket_id)
+            browser_state.mixed_track = track
 
-            if not call_state.audio_port:
-                self._attach_audio_bridge_to_call(call_id) # Create track that will emit FROM SIP to Queue
-            
-            msg = {
-                "type": "call_answered",
-                "call": asdict(self.get_call(call_id).get_call_info())
-            }
-            self.messenger.queueMessage(browser_state, MessageChannel.SIP, msg)
+        for call_id in list(track.sources):
+            if call_id not in call_ids:
+                self._stop_monitoring(websocket_id, call_id, browser_state)
+        for call_state in list(self.calls.values()):
+            if call_state.call_id not in call_ids:
+                with call_state.lock:
+                    call_state.pending_monitors.pop(websocket_id, None)
+
+        for call_id in call_ids:
+            call_state = self.get_call(call_id)
+            if call_state is None:
+                self.logger.error(f"Can't listen to unknown call. call_id={call_id}")
+                continue
+            gain = float(gains.get(call_id, 1.0))
+            if call_id in track.sources:
+                track.set_gain(call_id, gain)
+                continue
+            with call_state.lock:
+                if call_state.terminated:
+                    continue
+                try:
+                    has_audio = call_state.sip_call.has_active_audio()
+                except Exception as e:
+                    self.logger.error(f"Can't get call's media. call_id={call_id}, error={e}")
+                    continue
+                if has_audio:
+                    call_state.pending_monitors.pop(websocket_id, None)
+                    self._add_monitor(websocket_id, track, call_state, gain)
+                else:
+                    # Ringing or on hold, prepare_call_media attaches it once there's audio to hear
+                    call_state.pending_monitors[websocket_id] = gain
+
+        if new_track:
+            # Only the first time, after that sources come and go without touching the peer connection
+            await self._register_audio_track_to_rtc(websocket_id, track)
+
+        self._send_listening_calls(websocket_id, browser_state)
+
+    # With the call's lock held and its media up. Adds the call to the browser's mix, undoing it if the call's media can't be attached
+    def _add_monitor(self, websocket_id: str, track: MixedAudioTrack, call_state: CallState, gain: float) -> bool:
+        source = track.add_source(call_state.call_id, call_state.get_audio_format(), gain)
+        try:
+            call_state.add_monitor(websocket_id, source)
+        except Exception as e:
+            track.remove_source(call_state.call_id)
+            self.logger.error(f"Can't monitor call. websocket_id={websocket_id}, call_id={call_state.call_id}, error={e}")
+            return False
+        return True
+
+    # Call's actor. Its media's just come up, attach the browsers that asked to listen while it was ringing
+    def _attach_pending_monitors(self, call_state: CallState) -> None:
+        ensure_thread_registered()
+        with call_state.lock:
+            if call_state.terminated:
+                return
+            pending = call_state.pending_monitors
+            call_state.pending_monitors = {}
+            browsers = {}
+            for websocket_id, gain in pending.items():
+                browser_state = self.browsers.get(websocket_id)
+                if browser_state is None or browser_state.mixed_track is None:
+                    continue
+                if call_state.call_id not in browser_state.mixed_track.sources:
+                    self._add_monitor(websocket_id, browser_state.mixed_track, call_state, gain)
+                browsers[websocket_id] = browser_state
+        for websocket_id, browser_state in browsers.items():
+            self._send_listening_calls(websocket_id, browser_state)
+
+    # Tell the browser which calls it's listening to, including the ones waiting for media
+    def _send_listening_calls(self, websocket_id: str, browser_state: BrowserState) -> None:
+        call_ids = list(browser_state.mixed_track.sources) if browser_state.mixed_track is not None else []
+        call_ids += [call_state.call_id for call_state in list(self.calls.values())
+                     if websocket_id in call_state.pending_monitors and call_state.call_id not in call_ids]
+        msg = {
+            "type": "listening_calls",
+            "call_ids": call_ids
+        }
+        self.messenger.queueMessage(browser_state, MessageChannel.SIP, msg)
+
+    # Play a prompt (e.g. a chime) to the panel on a call. Everything about it comes from the browser,
+    # so anything wrong with it is logged rather than raised into the browser's websocket handler
+    async def play_prompt(self, call_id: str, name: str) -> None:
+        call_state = self.get_call(call_id)
+        if call_state is None:
+            self.logger.error(f"Can't play prompt to unknown call. call_id={call_id}")
+            return
+        if not prompt_cache.has_prompt(name):
+            self.logger.error(f"Unknown prompt. call_id={call_id}, prompt={name}")
+            return
+        ensure_thread_registered()
+        try:
+            with call_state.lock:
+                if call_state.terminated or not call_state.sip_call.has_active_audio():
+                    self.logger.warning(f"Call has no audio to play prompt into. call_id={call_id}, prompt={name}")
+                    return
+                audio_format = call_state.get_audio_format()
+            frame_samples = int(audio_format.frameTimeUsec * 0.000001 * audio_format.clockRate)
+            # A prompt that's not cached at this rate yet has to be decoded and cut, keep that off the loop
+            frames = await asyncio.get_running_loop().run_in_executor(None, prompt_cache.get_frames, name, audio_format.clockRate, frame_samples)
+            with call_state.lock:
+                if call_state.terminated:
+                    return
+                call_state.play_prompt(name, frames=frames)
+        except (OSError, av.FFmpegError, pj.Error) as e:
+            self.logger.error(f"Unable to play prompt. call_id={call_id}, prompt={name}, error={e}")
+
+    def _stop_monitoring(self, websocket_id: str, call_id: str, browser_state: BrowserState = None) -> None:
+        browser_state = browser_state or self.browsers.get(websocket_id)
+        if browser_state is not None and browser_state.mixed_track is not None:
+            browser_state.mixed_track.remove_source(call_id)
+        call_state = self.get_call(call_id)
+        if call_state is not None:
+            with call_state.lock:
+                call_state.remove_monitor(websocket_id)
+                call_state.pending_monitors.pop(websocket_id, None)
+
+    # Pre-warm: get a gated track negotiated with every idle browser while the call is still ringing
+    def prewarm_call(self, call_state: CallState) -> None:
+        if call_state.prewarm_started or call_state.sip_call.is_outgoing or self.loop is None:
+            return
+        call_state.prewarm_started = True
+        self.logger.debug(f"Pre-warming call media. call_id={call_state.call_id}")
+        call_state.actor.post(self._prewarm_browsers, call_state)
+
+    # Media is up: start recording, play the waiting prompt and pre-warm the AudioPort now the call's codec is known
+    def prepare_call_media(self, call_id: str) -> None:
+        call_state = self.get_call(call_id)
+        if call_state is None:
+            return
+        with call_state.lock:
+            if call_state.terminated or call_state.sip_call.disconnected:
+                return
+            # The call as it is now, not as of the event. Held under the lock, so it can't disconnect underneath
+            has_audio = call_state.sip_call.has_active_audio()
+            if RECORD_CALLS and has_audio:
+                call_state.start_recording()
+            if PROMPT_WAITING and has_audio and not call_state.sip_call.is_outgoing and call_state.prompt_player is None and len(call_state.listeners) == 0:
+                # Let the visitor know someone's coming, until a browser answers
+                call_state.play_prompt(PROMPT_WAITING, loop=True)
+            if MEDIA_PREWARM and not call_state.sip_call.is_outgoing:
+                call_state.prepare_audio_port()
+            if has_audio and call_state.pending_monitors and call_state.actor is not None:
+                call_state.actor.post(self._attach_pending_monitors, call_state)
+
+    async def _prewarm_browsers(self, call_state: CallState) -> None:
+        for websocket_id, browser_state in list(self.browsers.items()):
+            if browser_state.rtc_handler is None or browser_state.current_call is not None:
+                continue
+            stream_queue_id = f"c-{call_state.call_id}_ws-{websocket_id}"
+            track = SIPToBrowserAudioTrack(stream_queue_id, call_id=call_state.call_id)
+            with call_state.lock:
+                # Once terminated, remove_call has already taken the pre-warmed tracks to clean up
+                if call_state.terminated:
+                    return
+                call_state.prewarmed[websocket_id] = track
+            await self._register_audio_track_to_rtc(websocket_id, track)
+
+    def _remove_prewarmed_track(self, websocket_id: str, track: SIPToBrowserAudioTrack) -> None:
+        browser_state = self.browsers.get(websocket_id)
+        if browser_state is None or browser_state.rtc_handler is None:
+            return
+        self.logger.debug(f"Removing unused pre-warmed track. websocket_id={websocket_id}")
+        browser_state.rtc_handler.kill_audio_sender(track)
+
+    def _record_first_audio(self, call_id: str, websocket_id: str, prewarmed: bool, latency: float) -> None:
+        self.logger.info(f"Answer to first audio. call_id={call_id}, websocket_id={websocket_id}, prewarmed={prewarmed}, latency={latency}s")
+        self.first_audio_latencies.append((prewarmed, latency))
+
+    # Levels come in on PJSIP's media thread, hand them to the loop for sending
+    def _queue_audio_level(self, call_id: str, level: AudioLevel) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._send_audio_level, call_id, level)
+
+    def _send_audio_level(self, call_id: str, level: AudioLevel) -> None:
+        call_state = self.get_call(call_id)
+        if call_state is None:
+            return
+        msg = {
+            "type": "audio_level",
+            "call_id": call_id,
+            "rms": level.rms_dbfs,
+            "peak": level.peak_dbfs,
+            "gain": level.gain_db,
+            "vad": level.voice,
+        }
+        for websocket_id in set(call_state.listeners) | set(call_state.monitors):
+            browser_state = self.browsers.get(websocket_id)
+            if browser_state is not None:
+                self.messenger.queueMessage(browser_state, MessageChannel.SIP, msg)
+
+    def get_stats(self) -> dict:
+        latencies = [latency for _, latency in self.first_audio_latencies]
+        connected = [setup["connected_sec"] for setup in self.rtc_setups]
+        ice_connected = [setup["ice_connected_sec"] for setup in self.rtc_setups if setup["ice_connected_sec"] is not None]
+        return {
+            "calls": len(self.calls),
+            "browsers": len(self.browsers),
+            "media_prewarm": MEDIA_PREWARM,
+            "queues": queue_registry.get_stats(),
+            "call_snapshot": self.call_snapshot.get_stats(),
+            "messages": self.messenger.get_stats(),
+            "locks": {
+                "calls": self.lock.get_stats(),
+                **{f"call-{call_id}": call_state.lock.get_stats() for call_id, call_state in self.calls.items()},
+            },
+            "call_actors": {call_id: call_state.actor.get_stats() for call_id, call_state in self.calls.items()},
+            "connections": {
+                "browsers": len(self.browsers),
+                "rtc_handlers": len([b for b in self.browsers.values() if b.rtc_handler is not None]),
+                "peer_connections_open": len([b for b in self.browsers.values() if b.rtc_handler is not None and b.rtc_handler.pc.connectionState != "closed"]),
+                "closed_browsers": self.closed_browsers,
+                "live_browser_objects": len(self.live_browsers),
+                "live_rtc_handler_objects": len(self.live_rtc_handlers),
+            },
+            "outboxes": {websocket_id: browser_state.outbox.get_stats() for websocket_id, browser_state in self.browsers.items()},
+            "prompts": prompt_cache.get_stats(),
+            "recordings": {call_id: call_state.recorder.get_stats() for call_id, call_state in self.calls.items() if call_state.recorder is not None},
+            "rtc_setup": {
+                "count": len(connected),
+                "last_sec": connected[-1] if connected else None,
+                "avg_sec": sum(connected) / len(connected) if connected else None,
+                "max_sec": max(connected) if connected else None,
+                "avg_ice_connected_sec": sum(ice_connected) / len(ice_connected) if ice_connected else None,
+                "avg_gathering_sec": sum(setup["gathering_sec"] or 0 for setup in self.rtc_setups) / len(connected) if connected else None,
+                "avg_remote_candidates": sum(setup["remote_candidates"] for setup in self.rtc_setups) / len(connected) if connected else None,
+            },
+            "answer_to_first_audio": {
+                "count": len(latencies),
+                "prewarmed_count": len([p for p, _ in self.first_audio_latencies if p]),
+                "last_sec": latencies[-1] if latencies else None,
+                "avg_sec": sum(latencies) / len(latencies) if latencies else None,
+                "max_sec": max(latencies) if latencies else None,
+            },
+        }
 
 
     # Handle a browser leaving a call
-    def browser_leave_call(self, websocket_id: str) -> None:
+    async def browser_leave_call(self, websocket_id: str) -> None:
         self.logger.debug(f"Browser leaving call. websocket_id={websocket_id}")
         # Check Browser is in BrowserList
         if websocket_id not in self.browsers:
@@ -169,42 +527,24 @@ class CallManager:
 
         # Get BrowserState
         browser_state = self.browsers[websocket_id]
-        # Call to remove browser from call
-        self._handle_browser_leaving_call(browser_state)
+        # Call to remove browser from call, in order with anything else happening to the call
+        call_state = browser_state.current_call
+        if call_state is not None:
+            await call_state.actor.call(self._handle_browser_leaving_call, browser_state)
+        else:
+            self._handle_browser_leaving_call(browser_state)
     
         msg = {
             "type": "call_disconnected"
         }
         self.messenger.queueMessage(browser_state, MessageChannel.SIP, msg)
 
-    def send_browser_call_list(self, websocket_id: str) -> None:
-        calls_obj = {}
-        if self.sip_endpoint is not None:
-            self.check_or_register_thread()
-            for call_id in self.calls:
-                call = self.calls[call_id]
-                calls_obj[call_id] = asdict(call.get_call_info())
-        
-        msg = {
-            "calls": calls_obj,
-            "type": "call_list"
-        }
+    # Send the call list from the snapshot. A browser passing the seq/epoch it got to only gets what's changed since
+    def send_browser_call_list(self, websocket_id: str, since: int = None, epoch: str = None) -> None:
         browser_state = self.browsers[websocket_id]
-        self.messenger.queueMessage(browser_state, MessageChannel.SIP, msg)
-
-    def _attach_audio_bridge_to_call(self, call_id):
-
-        call = self.get_call(call_id)
-        
-        # Create the port 
-        audio_port = SIPAudioBridge(call_id=call_id)
-        audio_port.createPort("WebsocketAudioPort", get_audio_format()) # Audio Format is set once
-        # Attach it to call's media
-        call_audio_media = call.sip_call.get_call_audio_media() # This is the incoming SIP audio stream
-        call_audio_media.startTransmit(audio_port)
-
-        # Attach it to CallState
-        call.audio_port = audio_port
+        with self.call_snapshot.lock:
+            msg = self.call_snapshot.resume_message(since, epoch)
+            self.messenger.queueMessage(browser_state, MessageChannel.SIP, msg)
 
     # Private method to add an AudioTrack to an existing RTC connection
     # This will trigger renegotiation
@@ -212,16 +552,24 @@ class CallManager:
         rtc_handler = self.get_browser(websocket_id).rtc_handler
         await rtc_handler.add_track(audio_track)
 
-    # Private method to clean up if a browser is removed
+    # Private method to clean up if a browser is removed. Runs on the call's actor
     def _handle_browser_leaving_call(self, browser_state: 'BrowserState') -> None:
         cid = browser_state.get_current_call_id()
         
         self.logger.debug(f"leaving call internal. current_call_id={cid}")
         if cid:
-            browser_state.rtc_handler.kill_audio_sender()
-            # Hang up call
+            websocket_id = browser_state.websocket.id
+            call_state = browser_state.current_call
+            # Stop listening, detaches the SIPAudioBridge if this was the last listener
+            with call_state.lock:
+                track = call_state.listeners.get(websocket_id)
+                call_state.remove_listener(websocket_id)
+            if track is not None and browser_state.rtc_handler is not None:
+                browser_state.rtc_handler.kill_audio_sender(track)
+            # Hang up call. Outside the lock, PJSIP can call remove_call from inside end_call
             call = self.get_call(cid)
             if call and call.sip_call:
+                ensure_thread_registered()
                 call.sip_call.end_call()
         
         browser_state.deregister_current_call()
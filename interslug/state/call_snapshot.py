@@ -0,0 +1,100 @@
+from collections import deque
+from threading import RLock
+import time
+
+from logging_config import get_logger
+from config import CALL_DELTA_LOG_SIZE
+
+def merge_call_deltas(older: dict, newer: dict) -> dict:
+    """ Fold two call_delta messages into one covering both, for coalescing. Field values are absolute, so newer wins """
+    calls = dict(older["calls"])
+    for call_id, changes in newer["calls"].items():
+        previous = calls.get(call_id)
+        calls[call_id] = {**previous, **changes} if previous is not None and changes is not None else changes
+    return {**newer, "from_seq": older["from_seq"], "calls": calls}
+
+class CallSnapshot():
+    """
+        The SIPCallInfo of every call, as of its last state callback, with a sequence number bumped on every change.
+        Browsers are sent just the fields that changed (call_delta, from_seq -> seq) and read the call list from here,
+        so neither goes back into PJSIP. The last CALL_DELTA_LOG_SIZE changes are kept, so a browser that reconnects
+        with the seq it got to is sent what it missed rather than the whole list.
+        The epoch changes every time the server starts, as seqs from a previous run mean nothing.
+        Callers hold .lock around a change and posting its message, so messages are queued in seq order.
+    """
+    def __init__(self, log_size: int = CALL_DELTA_LOG_SIZE):
+        self.logger = get_logger("CallSnapshot")
+        self.lock = RLock()
+        self.epoch = str(int(time.time() * 1000))
+        self.seq = 0
+        self.calls: dict[str, dict] = {}  # Maps Call ID -> SIPCallInfo as a dict
+        self.log: deque[tuple[int, str, dict]] = deque(maxlen=log_size)  # (seq, call_id, changed fields or None for removed)
+        self.resumes = 0
+        self.full_lists = 0
+
+    def get(self, call_id: str) -> dict:
+        with self.lock:
+            call = self.calls.get(call_id)
+            return dict(call) if call is not None else None
+
+    def update(self, call_id: str, call_info: dict) -> dict:
+        """ Record a call's latest info. Returns the call_delta message, or None if nothing changed """
+        with self.lock:
+            previous = self.calls.get(call_id, {})
+            changes = {field: value for field, value in call_info.items() if field not in previous or previous[field] != value}
+            if not changes:
+                return None
+            self.calls[call_id] = {**previous, **changes}
+            return self._record(call_id, changes)
+
+    def remove(self, call_id: str) -> dict:
+        with self.lock:
+            if self.calls.pop(call_id, None) is None:
+                return None
+            return self._record(call_id, None)
+
+    def _record(self, call_id: str, changes: dict) -> dict:
+        self.seq += 1
+        self.log.append((self.seq, call_id, changes))
+        return self._delta_message(self.seq - 1, {call_id: changes})
+
+    def _delta_message(self, from_seq: int, calls: dict) -> dict:
+        return {
+            "type": "call_delta",
+            "epoch": self.epoch,
+            "from_seq": from_seq,
+            "seq": self.seq,
+            "calls": calls,
+        }
+
+    def full_message(self) -> dict:
+        with self.lock:
+            self.full_lists += 1
+            return {
+                "type": "call_list",
+                "epoch": self.epoch,
+                "seq": self.seq,
+                "calls": {call_id: dict(call) for call_id, call in self.calls.items()},
+            }
+
+    def resume_message(self, since: int = None, epoch: str = None) -> dict:
+        """ What a browser that's seen up to `since` is missing. The full list if it's from another run or too far behind """
+        with self.lock:
+            oldest = self.log[0][0] if self.log else self.seq + 1
+            if since is None or epoch != self.epoch or since > self.seq or since < oldest - 1:
+                return self.full_message()
+            self.resumes += 1
+            message = self._delta_message(since, {})
+            for seq, call_id, changes in self.log:
+                if seq > since:
+                    message = merge_call_deltas(message, {**message, "calls": {call_id: changes}})
+            return message
+
+    def get_stats(self) -> dict:
+        return {
+            "seq": self.seq,
+            "calls": len(self.calls),
+            "log": len(self.log),
+            "resumes": self.resumes,
+            "full_lists": self.full_lists,
+        }
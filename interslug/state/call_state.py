@@ -1,10 +1,22 @@
 from dataclasses import dataclass
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Callable
+from hgn_sip.sip_media import get_audio_format
+from interslug.media_cookery.bridges import SIPAudioBridge
+from interslug.media_cookery.dsp import AudioDSPStage, AudioLevel
+from interslug.media_cookery.recording import CallRecorder
+from interslug.media_cookery.prompts import PromptPlayer, prompt_cache
+from interslug.media_cookery.queuing import Q_LIST_TYPE_SIP_TO_BROWSER, queue_registry
+from interslug.state.locking import InstrumentedLock
 from logging_config import get_logger
+from config import AUDIO_DSP_ENABLED, AUDIO_AGC_TARGET_DBFS, AUDIO_LEVEL_REPORT_MS
 
 if TYPE_CHECKING:
     from hgn_sip.sip_call import SIPCall
-    from interslug.media_cookery.bridges import SIPAudioBridge, SIPToBrowserAudioTrack
+    from hgn_sip.sip_call_info import CallInfoSnapshot
+    from interslug.media_cookery.bridges import SIPToBrowserAudioTrack
+    from interslug.media_cookery.mixing import MixSource
+    from interslug.media_cookery.queuing import Queue
+    from interslug.state.call_actor import CallActor
     import pjsua2 as pj
 
 @dataclass
@@ -23,14 +35,10 @@ class SIPCallInfo():
     connectedDuration: float = None
     totalDuration: float = None
 
-def get_sip_call_info(sip_call: 'SIPCall'):
-    call_info: pj.CallInfo = sip_call.getInfo()
-    connected_duration_obj: pj.TimeVal = call_info.connectDuration
-    connected_duration = float(connected_duration_obj.sec + (connected_duration_obj.msec / 1000))
-
-    total_duration_obj: pj.TimeVal = call_info.totalDuration
-    total_duration = float(total_duration_obj.sec + (total_duration_obj.msec / 1000))
-
+def get_sip_call_info(sip_call: 'SIPCall', call_info: 'CallInfoSnapshot' = None):
+    """ Pass the event's CallInfoSnapshot when a callback already has it, to save another getInfo() into PJSIP """
+    if call_info is None:
+        call_info = sip_call.get_info()
     info = SIPCallInfo(
         accIdInt = call_info.accId,
         callIdString = call_info.callIdString,
@@ -43,8 +51,8 @@ def get_sip_call_info(sip_call: 'SIPCall'):
         remoteContact = call_info.remoteContact,
         remAudioCount = call_info.remAudioCount,
         remVideoCount = call_info.remVideoCount,
-        connectedDuration = connected_duration,
-        totalDuration = total_duration
+        connectedDuration = float(call_info.connectDuration),
+        totalDuration = float(call_info.totalDuration)
     )
     return info
 
@@ -55,24 +63,41 @@ class CallState:
         - The SIPCall
         - The AudioPort which is receiving its incoming audio frames
         - A list of listeners
+        - A list of monitors, browsers hearing this call through their MixedAudioTrack without having answered it
+        - The CallRecorder, if the call is being recorded
+        - The PromptPlayer, once a prompt has been played to the panel
+        The AudioPort only exists while there's at least one listener or monitor (or a recording), so an idle call costs no media work.
+        .lock is held around any change to the listeners, monitors, pre-warmed tracks or media, from PJSIP's thread or the loop,
+        and never across an await. Once terminated is set nothing is added to the call again.
     """
-    def __init__(self, sip_call: 'SIPCall'):
+    def __init__(self, sip_call: 'SIPCall', sip_call_info: 'CallInfoSnapshot' = None):
         self.sip_call = sip_call  # SIPCall object
-        self.sip_call_info: pj.CallInfo
-        try:
-            # Set initial call info
-            self.sip_call_info = sip_call.get_info()
-        except:
-            self.sip_call_info = None
-            pass
+        self.sip_call_info: CallInfoSnapshot = sip_call_info
+        if self.sip_call_info is None:
+            try:
+                # Set initial call info
+                self.sip_call_info = sip_call.get_info()
+            except:
+                pass
         self.call_id: str = self.sip_call_info.callIdString if self.sip_call_info is not None else None
         self.audio_port: SIPAudioBridge = None  # PJSUA2.AudioMediaPort
+        self.audio_format: pj.MediaFormatAudio = None  # Bridge format, picked from the negotiated codec once media is up
         self.listeners: dict[str, SIPToBrowserAudioTrack] = {}  # Maps WebSocket ID -> AudioStreamTrack
+        self.monitors: dict[str, MixSource] = {}  # Maps WebSocket ID -> the browser's mix source for this call
+        self.pending_monitors: dict[str, float] = {}  # Maps WebSocket ID -> gain, for browsers listening in before the call's media is up
+        self.prewarmed: dict[str, SIPToBrowserAudioTrack] = {}  # Maps WebSocket ID -> gated AudioStreamTrack already negotiated with the browser
+        self.prewarm_started = False
+        self.recorder: CallRecorder = None
+        self.prompt_player: PromptPlayer = None  # Kept for the rest of the call once created
+        self.on_audio_level: Callable[[str, AudioLevel], None] = None  # Called from PJSIP's media thread with (call_id, level)
+        self.lock = InstrumentedLock(f"call-{self.call_id}")
+        self.terminated = False
+        self.actor: 'CallActor' = None  # Set by the CallManager, runs this call's browser side jobs in order
 
-        self.logger = get_logger(f"CallState[{sip_call.getInfo().callIdString}]")
+        self.logger = get_logger(f"CallState[{self.call_id}]")
         self.logger.debug("init new CallState")
     
-    def update_call_info(self, sip_call_info: 'pj.CallInfo'):
+    def update_call_info(self, sip_call_info: 'CallInfoSnapshot'):
         self.logger.debug(f"update_call_info. state={sip_call_info.stateText}")
         self.sip_call_info = sip_call_info
         if self.call_id is None:
@@ -80,15 +105,145 @@ class CallState:
     def get_call_info(self):
         return get_sip_call_info(self.sip_call)
 
+    def get_audio_format(self) -> 'pj.MediaFormatAudio':
+        # Negotiated once, the codec doesn't change for the life of the call
+        if self.audio_format is None:
+            audio_format = self.sip_call.get_call_audio_format(fallback=False)
+            if audio_format is None:
+                # Media's not up yet. Don't keep the default, or the call's stuck resampling to it
+                return get_audio_format()
+            self.audio_format = audio_format
+            self.logger.debug(f"Call audio format. clockRate={self.audio_format.clockRate}")
+        return self.audio_format
+
+    # Add a listener's track. The first listener attaches the AudioPort to the call
+    def add_listener(self, websocket_id: str, track: 'SIPToBrowserAudioTrack') -> None:
+        self.listeners[websocket_id] = track
+        self._add_queue(track.queue)
+
+    # Add a browser's mix source. Counts the same as a listener for keeping the AudioPort attached.
+    # Only once the call has active audio. If attaching fails the source's queue is released and nothing's kept,
+    # an unattached AudioPort is left as if it had been pre-warmed
+    def add_monitor(self, websocket_id: str, source: 'MixSource') -> None:
+        try:
+            self._add_queue(source.queue)
+        except Exception:
+            queue_registry.release_queue(Q_LIST_TYPE_SIP_TO_BROWSER, source.stream_queue_id)
+            raise
+        self.monitors[websocket_id] = source
+
+    # Pre-warm: create the AudioPort ahead of time so answering only has to connect it
+    def prepare_audio_port(self) -> None:
+        if self.audio_port is None:
+            self.logger.debug("Preparing audio port ahead of answer")
+            self._create_audio_port()
+
+    # Remove a listener's track. The last listener out detaches and destroys the AudioPort
+    def remove_listener(self, websocket_id: str) -> None:
+        track = self.listeners.pop(websocket_id, None)
+        if track is not None:
+            self._remove_queue(track.queue, track.stream_queue_id)
+
+    def remove_monitor(self, websocket_id: str) -> None:
+        source = self.monitors.pop(websocket_id, None)
+        if source is not None:
+            self._remove_queue(source.queue, source.stream_queue_id)
+
+    # Play a cached prompt to the panel, replacing whatever prompt is playing. frames if they've already been got from the cache
+    def play_prompt(self, name: str, loop: bool = False, frames: tuple = None) -> None:
+        audio_format = self.get_audio_format()
+        if self.prompt_player is None:
+            player = PromptPlayer(audio_format)
+            player.createPort("PromptPort", audio_format)
+            player.attach(self.sip_call.get_call_audio_media())
+            self.sip_call.ports.append(player)
+            self.prompt_player = player
+        if frames is None:
+            frames = prompt_cache.get_frames(name, audio_format.clockRate, self.prompt_player.frame_samples, loop)
+        self.logger.debug(f"Playing prompt. name={name}, loop={loop}, frames={len(frames)}")
+        self.prompt_player.play(frames, loop)
+
+    def stop_prompt(self) -> None:
+        if self.prompt_player is not None:
+            self.prompt_player.stop()
+
+    # Record the call. Keeps the AudioPort attached until the call ends, listeners or not
+    def start_recording(self) -> None:
+        if self.recorder is not None:
+            return
+        self.recorder = CallRecorder(self.call_id, self.get_audio_format().clockRate)
+        self.recorder.start()
+        if self.audio_port is not None:
+            self.audio_port.add_stage(self.recorder.downlink_tap, first=True)
+        if self.audio_port is None or self.audio_port.call_audio_media is None:
+            self._attach_audio_port()
+
+    def stop_recording(self) -> None:
+        if self.recorder is None:
+            return
+        if self.audio_port is not None:
+            self.audio_port.remove_stage(self.recorder.downlink_tap)
+        self.recorder.stop()
+        self.recorder = None
+
+    def _add_queue(self, queue: 'Queue') -> None:
+        if self.audio_port is None or self.audio_port.call_audio_media is None:
+            self._attach_audio_port()
+        self.audio_port.add_queue(queue)
+
+    def _remove_queue(self, queue: 'Queue', stream_queue_id: str) -> None:
+        if self.audio_port is not None:
+            self.audio_port.remove_queue(queue)
+        queue_registry.release_queue(Q_LIST_TYPE_SIP_TO_BROWSER, stream_queue_id)
+        if len(self.listeners) == 0 and len(self.monitors) == 0 and self.recorder is None:
+            self._detach_audio_port()
+
+    def _create_audio_port(self) -> None:
+        audio_port = SIPAudioBridge(call_id=self.call_id)
+        audio_port.createPort("WebsocketAudioPort", self.get_audio_format()) # Format matches the call's codec
+        if self.recorder is not None:
+            # Ahead of any processing, the recording is what the panel actually sent
+            audio_port.add_stage(self.recorder.downlink_tap)
+        if AUDIO_DSP_ENABLED:
+            audio_port.add_stage(AudioDSPStage(AUDIO_AGC_TARGET_DBFS, AUDIO_LEVEL_REPORT_MS, self._audio_level_received))
+        self.sip_call.ports.append(audio_port)
+        self.audio_port = audio_port
+
+    def _audio_level_received(self, level: AudioLevel) -> None:
+        if self.on_audio_level is not None:
+            self.on_audio_level(self.call_id, level)
+
+    def _attach_audio_port(self) -> None:
+        self.logger.debug("First listener, attaching audio port")
+        if self.audio_port is None:
+            self._create_audio_port()
+        self.audio_port.attach(self.sip_call.get_call_audio_media()) # This is the incoming SIP audio stream
+
+    def _detach_audio_port(self) -> None:
+        if self.audio_port is None:
+            return
+        self.logger.debug("No listeners left, detaching audio port")
+        self.audio_port.kill()
+        if self.audio_port in self.sip_call.ports:
+            self.sip_call.ports.remove(self.audio_port)
+        # Last reference to the port, PJSUA2 unregisters it from the conference bridge when it's collected
+        self.audio_port = None
+
     # Terminate the call state (clean up audio port and listeners)
     def terminate(self) -> None:
-        if self.audio_port:
-            # TODO: Stop Audio Port
-            self.logger.debug("Deleting audio_port")
-            self.audio_port = None
-        
-        # TODO: Terminate all listeners to the AudioPort (self.listeners)
-        # for listener_websocket_id, track in self.listeners.items():
-        #     self.logger.debug(f"Stopping audio track {track.id}")
-        #     track.stop()  # Terminate the track
-        # self.listeners.clear()
+        self.logger.debug(f"Terminating. listeners={len(self.listeners)}, monitors={len(self.monitors)}, prewarmed={len(self.prewarmed)}")
+        self.listeners.clear()
+        self.monitors.clear()
+        self.pending_monitors.clear()
+        self.prewarmed.clear()
+        self.release_media()
+
+    # Detach and drop everything hung off the call's media, leaving the listeners etc. for terminate. Safe to call twice
+    def release_media(self) -> None:
+        self.stop_recording()
+        if self.prompt_player is not None:
+            self.prompt_player.kill()
+            if self.prompt_player in self.sip_call.ports:
+                self.sip_call.ports.remove(self.prompt_player)
+            self.prompt_player = None
+        self._detach_audio_port()
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from logging_config import get_logger
+from config import LOCK_WARN_MS
+
+class InstrumentedLock():
+    """
+        A threading.Lock that keeps count of how long it's waited for and held, for get_stats.
+        Only ever held around plain dict/media changes, never across an await, so anything
+        held longer than warn_ms is logged as a bug.
+    """
+    def __init__(self, name: str, warn_ms: float = LOCK_WARN_MS):
+        self.name = name
+        self.logger = get_logger(f"InstrumentedLock[{name}]")
+        self.warn_sec = warn_ms / 1000
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.acquisitions = 0
+        self.contended = 0
+        self.long_holds = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        if not self._lock.acquire(blocking=False):
+            self._lock.acquire()
+            self.contended += 1
+        self._acquired_at = time.perf_counter()
+        waited = self._acquired_at - started
+        self.acquisitions += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        held = time.perf_counter() - self._acquired_at
+        self.hold_total += held
+        self.hold_max = max(self.hold_max, held)
+        long_hold = held > self.warn_sec
+        if long_hold:
+            self.long_holds += 1
+        self._lock.release()
+        if long_hold:
+            self.logger.warning(f"Lock held too long. held_ms={1000 * held:.1f}, thread={threading.current_thread().name}")
+        return False
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def get_stats(self) -> dict:
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "long_holds": self.long_holds,
+            "avg_wait_ms": 1000 * self.wait_total / self.acquisitions if self.acquisitions else None,
+            "max_wait_ms": 1000 * self.wait_max,
+            "avg_hold_ms": 1000 * self.hold_total / self.acquisitions if self.acquisitions else None,
+            "max_hold_ms": 1000 * self.hold_max,
+        }
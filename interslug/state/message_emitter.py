@@ -1,12 +1,16 @@
+import asyncio
+from collections import deque
 from enum import Enum
-from pyee.asyncio import AsyncIOEventEmitter
-from pyee import EventEmitter
+from threading import get_ident
+import time
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Callable
+
+from websockets.exceptions import ConnectionClosed
 
-from interslug.misc_garbage.run_async_as_sync import run_async_as_sync
 from logging_config import get_logger
 from interslug.messages.message_builder import message_to_str
+from config import MESSAGE_QUEUE_SIZE, MESSAGE_COALESCE_MS, BROWSER_OUTBOX_SIZE
 
 if TYPE_CHECKING:
     from interslug.state.browser_state import BrowserState
@@ -18,25 +22,223 @@ class MessageChannel(Enum):
     RTC = "RTC"
     SYS = "SYS"
 
+# Status messages a slow browser can afford to lose, as something newer supersedes them.
+# Maps message type -> what identifies "the same" status, so a queued one is replaced rather than sent stale.
+# Anything not listed here (RTC signalling, call_answered, call_list, call_delta...) is never dropped.
+# call_delta especially: the browser only notices a lost one when the next arrives, so losing the last one
+# leaves it showing stale calls. They're coalesced before they get to the outbox, so there aren't many.
+STALE_MESSAGE_KEYS: dict[str, Callable[[dict], str]] = {
+    "audio_level": lambda msg: f"audio_level_{msg['call_id']}",
+}
+
+class BrowserOutbox():
+    """
+        One browser's outbound messages, sent by its own writer task so a tablet on bad Wi-Fi only
+        holds up itself. Bodies arrive already encoded.
+        Bounded at max_queued: a status message replaces a queued one for the same thing, and when full
+        the oldest droppable status is dropped. Messages that can't be dropped are always queued, they're
+        rare (signalling and replies to the browser's own requests) so they can only go a little over.
+    """
+    def __init__(self, websocket: 'ServerConnection', max_queued: int = BROWSER_OUTBOX_SIZE):
+        self.websocket = websocket
+        self.logger = get_logger(f"BrowserOutbox[{websocket.id}]")
+        self.max_queued = max_queued
+        self.items: deque[list] = deque()  # [stale key, body, queued at, droppable]
+        self.keyed: dict[str, list] = {}   # Stale key -> its queued item
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task = None
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.replaced = 0
+        self.max_depth = 0
+        self.latencies: deque[float] = deque(maxlen=100)  # Queued to sent, seconds
+
+    def start(self):
+        """ Called on the loop """
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def close(self):
+        self.closed = True
+        self.items.clear()
+        self.keyed.clear()
+        if self.task is not None:
+            self.task.cancel()
+
+    def put(self, body: bytes, droppable: bool = False, stale_key: str = None):
+        """ Loop only. Never waits """
+        if self.closed:
+            return
+        if stale_key is not None and stale_key in self.keyed:
+            # Keeps its place (and queued time) in the queue, so the latency shows how stale status gets
+            self.keyed[stale_key][1] = body
+            self.replaced += 1
+            return
+        if len(self.items) >= self.max_queued and not self._drop_oldest_droppable():
+            if droppable:
+                self.dropped += 1
+                return
+        item = [stale_key, body, time.perf_counter(), droppable]
+        self.items.append(item)
+        if stale_key is not None:
+            self.keyed[stale_key] = item
+        self.max_depth = max(self.max_depth, len(self.items))
+        self.wakeup.set()
+
+    def _drop_oldest_droppable(self) -> bool:
+        for item in self.items:
+            if item[3]:
+                self.items.remove(item)
+                if item[0] is not None:
+                    self.keyed.pop(item[0], None)
+                self.dropped += 1
+                return True
+        return False
+
+    async def run(self):
+        while not self.closed:
+            if not self.items:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            stale_key, body, queued_at, _ = self.items.popleft()
+            if stale_key is not None:
+                self.keyed.pop(stale_key, None)
+            try:
+                await self.websocket.send(body, text=True)
+            except ConnectionClosed:
+                # Browser went away with messages still queued for it
+                self.logger.debug(f"Websocket closed, discarding queued messages. queued={len(self.items)}")
+                self.close()
+                return
+            except Exception as e:
+                self.logger.error(f"Unable to send message. error={e}")
+                continue
+            self.sent += 1
+            self.latencies.append(time.perf_counter() - queued_at)
+
+    def get_stats(self) -> dict:
+        latencies = list(self.latencies)
+        return {
+            "depth": len(self.items),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "replaced": self.replaced,
+            "avg_latency_ms": 1000 * sum(latencies) / len(latencies) if latencies else None,
+            "max_latency_ms": 1000 * max(latencies) if latencies else None,
+        }
+
 class SocketMessenger():
-    def __init__(self, call_manager: 'CallManager'):
+    """
+        Gets messages from any thread out to the browsers' websockets.
+        The websockets belong to the CallManager's loop, so queueMessage/queueMessageAll only ever post
+        onto that loop (call_soon_threadsafe from PJSIP's threads) into a bounded queue. A task on the loop
+        drains it into each browser's BrowserOutbox, which does the actual sends.
+        Posting never blocks or waits on the network, so it's safe from SIP callbacks.
+        If the queue fills (the loop's stalled), the oldest message is dropped.
+        Each message is JSON encoded once, however many browsers it goes to.
+        Broadcasts with a coalesce_key (e.g. a call's status) go out straight away, then at most once per
+        coalesce window per key, with only the latest message for the key sent at the end of the window.
+        Pass a merge function if held messages need folding together rather than the latest replacing them.
+    """
+    def __init__(self, call_manager: 'CallManager', max_queued: int = MESSAGE_QUEUE_SIZE, coalesce_ms: int = MESSAGE_COALESCE_MS):
         self.logger = get_logger("SocketMessenger")
         self.cm = call_manager
-        self.emitter = EventEmitter()
-        self.emitter.on("queue_message", self.sendMessage)
-    
-    def queueMessage(self, msg_dest: 'BrowserState', channel:str, msg_data):
-        self.emitter.emit("queue_message", msg_dest.websocket, channel, msg_data)
-
-    def queueMessageAll(self, channel:str, msg_data):
-        for browser_id in self.cm.browsers:
-            browser = self.cm.browsers[browser_id]
-            self.emitter.emit("queue_message", browser.websocket, channel, msg_data)
-
-    def sendMessage(self, msg_dest: 'ServerConnection', channel:MessageChannel, msg_data):
-        msg_body = message_to_str(msg_data, channel.value)
-        self.logger.debug(f"SendMessage. channel={channel} msg_data={msg_body}")
-        if not msg_dest:
-            self.logger.error(f"Error: Message destination invalid")
+        self.max_queued = max_queued
+        self.coalesce_sec = coalesce_ms / 1000
+        self.coalesce_timers: dict[str, asyncio.TimerHandle] = {}  # Keys sent within the window
+        self.coalesce_pending: dict[str, tuple] = {}  # Latest (or merged) message for a key, held until its window ends
+        self.loop: asyncio.AbstractEventLoop = None
+        self.loop_thread: int = None
+        self.queue: asyncio.Queue = None
+        self.task: asyncio.Task = None
+        self.posted = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """ Called on the loop itself, once it's running """
+        self.loop = loop
+        self.loop_thread = get_ident()
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        self.task = loop.create_task(self._drain())
+
+    def queueMessage(self, msg_dest: 'BrowserState', channel: MessageChannel, msg_data):
+        self._post(msg_dest, channel, msg_data)
+
+    def queueMessageAll(self, channel: MessageChannel, msg_data, coalesce_key: str = None, merge: Callable[[dict, dict], dict] = None):
+        # Browsers are looked up when it's sent, on the loop, rather than iterating them from this thread
+        self._post(None, channel, msg_data, coalesce_key, merge)
+
+    def _post(self, msg_dest: 'BrowserState', channel: MessageChannel, msg_data, coalesce_key: str = None, merge: Callable[[dict, dict], dict] = None):
+        if self.loop is None or self.loop.is_closed():
+            self.logger.debug(f"No loop to send on yet, dropping message. channel={channel}")
+            return
+        item = (msg_dest, channel, msg_data)
+        enqueue = self._enqueue if coalesce_key is None else self._enqueue_coalesced
+        args = (item,) if coalesce_key is None else (coalesce_key, item, merge)
+        if get_ident() == self.loop_thread:
+            enqueue(*args)
+        else:
+            self.loop.call_soon_threadsafe(enqueue, *args)
+
+    def _enqueue_coalesced(self, coalesce_key: str, item: tuple, merge: Callable[[dict, dict], dict] = None):
+        if coalesce_key in self.coalesce_timers:
+            held = self.coalesce_pending.get(coalesce_key)
+            if held is not None:
+                self.coalesced += 1
+                if merge is not None:
+                    msg_dest, channel, msg_data = item
+                    item = (msg_dest, channel, merge(held[2], msg_data))
+            self.coalesce_pending[coalesce_key] = item
             return
-        run_async_as_sync(msg_dest.send(msg_body))
+        self._enqueue(item)
+        self.coalesce_timers[coalesce_key] = self.loop.call_later(self.coalesce_sec, self._end_coalesce_window, coalesce_key)
+
+    def _end_coalesce_window(self, coalesce_key: str):
+        self.coalesce_timers.pop(coalesce_key, None)
+        item = self.coalesce_pending.pop(coalesce_key, None)
+        if item is not None:
+            # Starts a new window, so a steady stream still only goes out once per window
+            self._enqueue_coalesced(coalesce_key, item)
+
+    def _enqueue(self, item: tuple):
+        # Only ever runs on the loop, so the full check and put can't race the drain
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.logger.error(f"Message queue full, dropped oldest message. dropped={self.dropped}")
+        self.queue.put_nowait(item)
+        self.posted += 1
+
+    async def _drain(self):
+        while True:
+            msg_dest, channel, msg_data = await self.queue.get()
+            if msg_dest is None:
+                destinations = list(self.cm.browsers.values())
+            else:
+                destinations = [msg_dest]
+            if not destinations:
+                continue
+            msg_body = message_to_str(msg_data, channel.value).encode("utf-8")
+            self.logger.debug(f"SendMessage. channel={channel} destinations={len(destinations)} msg_data={msg_body}")
+            droppable, stale_key = self._stale_policy(channel, msg_data)
+            for browser in destinations:
+                browser.outbox.put(msg_body, droppable, stale_key)
+                self.sent += 1
+
+    def _stale_policy(self, channel: MessageChannel, msg_data) -> tuple[bool, str]:
+        if channel != MessageChannel.SIP or not isinstance(msg_data, dict) or msg_data.get("type") not in STALE_MESSAGE_KEYS:
+            return False, None
+        return True, STALE_MESSAGE_KEYS[msg_data["type"]](msg_data)
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "posted": self.posted,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
@@ -26,6 +26,7 @@ export class RTCHandler {
         this.pc = new RTCPeerConnection()
         this.addDefaultListeners()
         this.players = []
+        this.pendingCandidates = []
     }
 
     addDefaultListeners() {
@@ -40,33 +41,34 @@ export class RTCHandler {
         })
     }
     onICECandidate(event) {
-        console.log("onIceCandidate", event)
-        if (event.candidate) {
-            const ip = event.candidate.address
-            if(ip.indexOf("172") !== -1) {
-                console.log(`Ignoring candidate based on IP ip=${ip}`)
-                return
-            }
-            const cd = event.candidate
-            const log_str = `candidate received: ${cd.protocol}://${cd.address}:${cd.port}.\nfull_candidate=${cd.candidate}`
-            console.log(log_str)
-            const cd_obj = {
-                component: event.candidate.component,
-                foundation: event.candidate.foundation,
-                ip: event.candidate.address,
-                port: event.candidate.port,
-                priority: event.candidate.priority,
-                protocol: event.candidate.protocol,
-                type: event.candidate.type,
-                relatedAddress: event.candidate.relatedAddress,
-                relatedPort: event.candidate.relatedPort,
-                sdpMid: event.candidate.sdpMid,
-                sdpMLineIndex: event.candidate.sdpMLineIndex,
-                tcpType: event.candidate.tcpType 
-            }
-            sendMessage(this.socket, {type: "icecandidate",candidate: cd_obj}, "rtc")
+        /* Trickle each candidate as it's found, rather than waiting for gathering to finish */
+        if (!event.candidate) {
+            console.log("ICE gathering complete, sending end-of-candidates")
+            sendMessage(this.socket, {type: "icecandidate", candidate: null}, "rtc")
+            return
+        }
+        const cd = event.candidate
+        if(cd.address && cd.address.indexOf("172") !== -1) {
+            console.log(`Ignoring candidate based on IP ip=${cd.address}`)
+            return
+        }
+        console.log(`candidate found: ${cd.protocol}://${cd.address}:${cd.port}. full_candidate=${cd.candidate}`)
+        sendMessage(this.socket, {type: "icecandidate", candidate: cd.toJSON()}, "rtc")
+    }
+    async addRemoteCandidate(candidate) {
+        /* Server candidates are already in its SDP (aiortc can't trickle), but take them if they come */
+        if (!this.pc.remoteDescription) {
+            this.pendingCandidates.push(candidate)
+            return
+        }
+        await this.pc.addIceCandidate(candidate)
+    }
+    async flushPendingCandidates() {
+        const pending = this.pendingCandidates
+        this.pendingCandidates = []
+        for (const candidate of pending) {
+            await this.pc.addIceCandidate(candidate)
         }
-        
     }
     onNegotiationNeeded(event) {
         console.log("onNegotiationNeeded", event)
@@ -115,6 +117,7 @@ export class RTCHandler {
         const type = msg["type"]
         const rd = new RTCSessionDescription({type: type, sdp: sdp})
         await this.pc.setRemoteDescription(rd)
+        await this.flushPendingCandidates()
     }
     async updateLocalDescription(offer_answer) {
         await this.pc.setLocalDescription(offer_answer);
@@ -131,10 +134,12 @@ export class RTCHandler {
     async handleIncomingMsg(msg) {
         if (msg.type == "answer") {
             console.log("Processing answer response")
-            this.updateRemoteDescription(msg)
+            await this.updateRemoteDescription(msg)
         } else if (msg.type == "offer") {
             console.log("Responding to offer")
-            this.respondToOffer(msg)
+            await this.respondToOffer(msg)
+        } else if (msg.type == "icecandidate") {
+            await this.addRemoteCandidate(msg.candidate)
         }
     }
 }
\ No newline at end of file
@@ -77,9 +77,19 @@ export class SIPHandler {
         this.current_call = null
         this.incoming_call = null
         this.calls = {}
+        /* Last call_list/call_delta applied. Kept across reloads so the server only sends what's changed */
+        this.callSeq = null
+        this.callEpoch = null
+        this.restoreCallState()
         this.requestCallList()
         self = this
         this.callStatusElement = document.getElementById("callstatus")
+        this.audioLevelElement = document.getElementById("audio_level")
+        this.speakingElement = document.getElementById("speaking")
+        this.listeningCallIds = []
+        document.getElementById("listen_all").addEventListener("click", () => {
+            self.toggleListenAll()
+        })
 
         this.buttons = new PhoneButtons("incoming", () => {
             self.answerIncomingCall()
@@ -115,7 +125,57 @@ export class SIPHandler {
         return false
     }
     requestCallList() {
-        this.sendSIPMessage("get_call_list")
+        if (this.callSeq !== null) {
+            this.sendSIPMessage("get_call_list", {since: this.callSeq, epoch: this.callEpoch})
+        } else {
+            this.sendSIPMessage("get_call_list")
+        }
+    }
+    restoreCallState() {
+        const saved = sessionStorage.getItem("call_state")
+        if (!saved) {
+            return
+        }
+        const state = JSON.parse(saved)
+        this.calls = state.calls
+        this.callSeq = state.seq
+        this.callEpoch = state.epoch
+    }
+    saveCallState() {
+        sessionStorage.setItem("call_state", JSON.stringify({calls: this.calls, seq: this.callSeq, epoch: this.callEpoch}))
+    }
+    processCallDeltaMsg(msg) {
+        /* Only changed fields. null means the call's gone */
+        if (this.callSeq === null) {
+            return  // A call_list is on its way
+        }
+        if (msg.epoch !== this.callEpoch || msg.from_seq > this.callSeq) {
+            console.log(`Missed call updates, resyncing. seq=${this.callSeq}, from_seq=${msg.from_seq}`)
+            this.callSeq = null
+            this.requestCallList()
+            return
+        }
+        if (msg.seq <= this.callSeq) {
+            return  // Already covered by a call_list
+        }
+        for (const callId in msg.calls) {
+            const changes = msg.calls[callId]
+            const previous = this.calls[callId]
+            if (changes === null) {
+                delete this.calls[callId]
+                if (previous) {
+                    this.onCallDisconnected(previous)
+                }
+                continue
+            }
+            const call = {...previous, ...changes}
+            this.calls[callId] = call
+            if ("callStateString" in changes) {
+                this.processCallStatusMsg({call: call})
+            }
+        }
+        this.callSeq = msg.seq
+        this.saveCallState()
     }
     processCallStatusMsg(msg) {
         const call = msg.call
@@ -136,6 +196,9 @@ export class SIPHandler {
     processCallListMsg(msg) {
         console.log("Incoming call List", msg.calls)
         this.calls = msg.calls
+        this.callSeq = msg.seq
+        this.callEpoch = msg.epoch
+        this.saveCallState()
         for (const callId in this.calls) {
             if(this.incoming_call && this.incoming_call.callIdString == callId) {
                 this.incoming_call = this.calls[callId]
@@ -152,6 +215,32 @@ export class SIPHandler {
     }
     processCallDisconnected(msg) {
         this.onCallEndConfirmed()
+        this.resetAudioLevel()
+    }
+    processAudioLevel(msg) {
+        /* rms/peak are dBFS, vad is true while the panel end is talking */
+        this.audioLevelElement.value = Math.max(msg.rms, this.audioLevelElement.min)
+        this.speakingElement.textContent = msg.vad ? "Speaking" : ""
+    }
+    resetAudioLevel() {
+        this.audioLevelElement.value = this.audioLevelElement.min
+        this.speakingElement.textContent = ""
+    }
+    listenToCalls(call_ids, gains = {}) {
+        /* Hear several calls at once on a single mixed track, without answering them */
+        this.sendSIPMessage("listen_calls", {call_ids: call_ids, gains: gains})
+    }
+    toggleListenAll() {
+        if (this.listeningCallIds.length > 0) {
+            this.listenToCalls([])
+            return
+        }
+        const callIds = Object.keys(this.calls).filter(callId => this.calls[callId].callStateString !== "DISCONNECTED")
+        this.listenToCalls(callIds)
+    }
+    processListeningCalls(msg) {
+        this.listeningCallIds = msg.call_ids
+        document.getElementById("listen_all").textContent = msg.call_ids.length > 0 ? `Stop listening (${msg.call_ids.length})` : "Listen to all"
     }
     requestConnectToCall(call_id) {
         // Send answer message to server
@@ -203,13 +292,15 @@ export class SIPHandler {
 
     }
     async handleIncomingMsg(msg) {
-        console.log("SIP Message", msg.type)
+        if (msg.type !== "audio_level") {
+            console.log("SIP Message", msg.type)
+        }
         switch(msg.type) { 
             case "call_list":
                 this.processCallListMsg(msg)
                 break;
-            case "on_call_status":
-                this.processCallStatusMsg(msg)
+            case "call_delta":
+                this.processCallDeltaMsg(msg)
                 break;
             case "call_answered":
                 this.processCallAnswered(msg)
@@ -217,6 +308,12 @@ export class SIPHandler {
             case "call_disconnected":
                 this.processCallDisconnected(msg)
                 break;
+            case "audio_level":
+                this.processAudioLevel(msg)
+                break;
+            case "listening_calls":
+                this.processListeningCalls(msg)
+                break;
         }
     }
 }
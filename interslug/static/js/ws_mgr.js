@@ -27,7 +27,9 @@ export function sendMessage(socket, msg_body, msg_channel, attempts=0) {
 
 export class SocketHandler {
     constructor() {
-        this.ws = new WebSocket("wss://pi4b.localhost.direct:8765");
+        /* Signalling listens on every address the page is served from, so follow the page. The port's put on the page by the web interface */
+        const port = document.body.dataset.signallingPort || 8765;
+        this.ws = new WebSocket(`wss://${window.location.hostname}:${port}`);
         this.rtc = new RTCHandler(this.ws);
         this.sip = new SIPHandler(this.ws, this.rtc);
         this.addDefaultListeners();
@@ -54,7 +56,7 @@ export class SocketHandler {
         const socket = this.ws
         const msgBody = JSON.parse(ev.data);
         console.log(`incoming message channel=${msgBody.channel}`, msgBody.message);
-        switch (msgBody.channel) {
+        switch (msgBody.channel.toLowerCase()) {
             case ("rtc"):
                 await this.rtc.handleIncomingMsg(msgBody.message);
                 break;
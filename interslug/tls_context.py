@@ -0,0 +1,97 @@
+import logging
+import ssl
+import threading
+import time
+
+SESSION_STAT_KEYS = ("accept", "accept_good", "hits", "misses", "timeouts", "cache_full")
+
+class RotatingSSLContext(ssl.SSLContext):
+    """
+        The one server context for both the web interface and websocket signalling, so a tablet that
+        reconnects to either can resume its TLS session (tickets, or the session cache for TLS 1.2)
+        rather than doing a full handshake every time its Wi-Fi blips.
+        OpenSSL generates the ticket keys inside each context and Python can't set them, so rotating the
+        keys means building a new context. The servers keep hold of this object, and every connection
+        is handed to the current generation in wrap_bio. A new generation is built once the current one
+        is rotate_sec old (reloading the certificate as it goes), after which older tickets just fall back
+        to a full handshake.
+    """
+    def __new__(cls, certfile: str, keyfile: str, rotate_sec: float = 24 * 3600, num_tickets: int = 2):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_SERVER)
+
+    def __init__(self, certfile: str, keyfile: str, rotate_sec: float = 24 * 3600, num_tickets: int = 2):
+        self._logger: logging.Logger = None
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.rotate_sec = rotate_sec
+        self.ticket_count = num_tickets
+        self.rotate_lock = threading.Lock()
+        self.generation = 0
+        self.retired_stats = dict.fromkeys(SESSION_STAT_KEYS, 0)
+        self.current = self._build()
+        self.current_since = time.monotonic()
+        # Also usable as a plain context, e.g. by anything that inspects it rather than wrapping with it
+        self.load_cert_chain(certfile=certfile, keyfile=keyfile)
+
+    @property
+    def logger(self) -> logging.Logger:
+        # Built by config.py, which logging_config imports, so logging_config may only be half imported here.
+        # Until it can be, log through plain logging
+        if self._logger is None:
+            try:
+                from logging_config import get_logger
+            except ImportError:
+                return logging.getLogger("tls-context")
+            self._logger = get_logger("tls-context")
+        return self._logger
+
+    def _build(self) -> ssl.SSLContext:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = self.ticket_count
+        self.generation += 1
+        self.logger.debug(f"Built TLS context. generation={self.generation}")
+        return context
+
+    def _current(self) -> ssl.SSLContext:
+        if time.monotonic() - self.current_since < self.rotate_sec:
+            return self.current
+        with self.rotate_lock:
+            if time.monotonic() - self.current_since >= self.rotate_sec:
+                try:
+                    replacement = self._build()
+                except (OSError, ssl.SSLError) as e:
+                    # Keep serving with the old keys/cert rather than failing every connection
+                    self.logger.error(f"Unable to rotate TLS context, keeping the current one. error={e}")
+                    self.current_since = time.monotonic()
+                    return self.current
+                retiring = self.current.session_stats()
+                for key in SESSION_STAT_KEYS:
+                    self.retired_stats[key] += retiring[key]
+                self.current = replacement
+                self.current_since = time.monotonic()
+            return self.current
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        # asyncio's SSL transports (aiohttp and websockets both) come through here for every connection
+        return self._current().wrap_bio(incoming, outgoing, server_side=server_side, server_hostname=server_hostname, session=session)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        return self._current().wrap_socket(sock, *args, **kwargs)
+
+    def get_stats(self) -> dict:
+        current = self.current.session_stats()
+        totals = {key: self.retired_stats[key] + current[key] for key in SESSION_STAT_KEYS}
+        handshakes = totals["accept_good"]
+        return {
+            "generation": self.generation,
+            "generation_age_sec": time.monotonic() - self.current_since,
+            "handshakes": handshakes,
+            "resumed": totals["hits"],
+            "full_handshakes": handshakes - totals["hits"],
+            "failed_handshakes": totals["accept"] - handshakes,
+            "resumption_ratio": totals["hits"] / handshakes if handshakes else None,
+            "session_cache_misses": totals["misses"],
+            "session_cache_timeouts": totals["timeouts"],
+        }
@@ -1,98 +1,208 @@
 import asyncio
-import ssl
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
 import threading
-import websockets
-from flask import Flask, render_template, request, jsonify
+from aiohttp import web
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound, select_autoescape
 from logging_config import get_logger
-from service_helper import stop_event
 from typing import TYPE_CHECKING
+from hgn_sip import sip_threads
 from .intercom_handler import trigger_send_unlock_to_wallpanel
-from config import WALL_PANELS, HGN_SSL_CONTEXT
-from werkzeug.serving import make_server, BaseWSGIServer
+from .state.call_manager import global_call_manager
+from .tls_context import RotatingSSLContext
+from config import WALL_PANELS, HGN_SSL_CONTEXT, SIGNALLING_PORT
 
 from .web_sip_bridge_rtc import run_main
 if TYPE_CHECKING:
     from udp_handler import UDPHandler
     from .intercom_handler import IntercomSIPHandler
 
-# ChatGPT did all this
+WEB_ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(WEB_ROOT, "templates")
+STATIC_DIR = os.path.join(WEB_ROOT, "static")
+
+@dataclass
+class CachedResponse():
+    """ A response body held in memory, along with its gzipped copy and ETag """
+    body: bytes
+    gzipped: bytes
+    etag: str
+    content_type: str
+
+    @property
+    def version(self) -> str:
+        """ Short form of the ETag, for versioned URLs """
+        return self.etag.strip("\"")[:12]
+
+def build_cached_response(body: bytes, content_type: str) -> CachedResponse:
+    return CachedResponse(
+        body=body,
+        gzipped=gzip.compress(body, compresslevel=9),
+        etag=f"\"{hashlib.sha1(body).hexdigest()}\"",
+        content_type=content_type,
+    )
+
+def cached_response(request: web.Request, cached: CachedResponse, cache_control: str) -> web.Response:
+    """ 304 if the browser already has it, otherwise the gzipped body if it takes gzip """
+    headers = {"ETag": cached.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if request.headers.get("If-None-Match") == cached.etag:
+        return web.Response(status=304, headers=headers)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return web.Response(body=cached.gzipped, content_type=cached.content_type, headers=headers)
+    return web.Response(body=cached.body, content_type=cached.content_type, headers=headers)
+
 class WebInterface:
+    """
+        The control UI and its API, on aiohttp in the same loop as signalling.
+        Static files are read, gzipped and hashed once at startup. Templates and the panel list are rendered once
+        and kept until WALL_PANELS changes, so a tablet waking from sleep mostly gets 304s.
+        Static URLs from url_for carry the file's hash, so those can be cached as immutable, anything requested
+        without it (e.g. a module's own imports) is revalidated with its ETag instead.
+    """
     def __init__(self, udp_handler: 'UDPHandler', intercom_sip_handler: 'IntercomSIPHandler'):
         self.udp_handler = udp_handler
         self.sip_handler = intercom_sip_handler.sip_handler
         self.logger = get_logger("web-interface")
-        self.app = Flask(__name__, template_folder="templates")
-        self.app.debug = True
         self.wall_panels = WALL_PANELS
+        self.templates = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(["html"]))
+        self.templates.globals["url_for"] = self.url_for
+        self.static_files = self._load_static_files()
+        self.rendered: dict[str, tuple[tuple, CachedResponse]] = {}  # Template name -> (panels it was rendered with, response)
+        self.panels_list: tuple[tuple, CachedResponse] = None
+        # PJSIP/UDP actions block, so they run off the loop. One thread, so PJSIP only ever sees one web thread
+        self.action_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="web-action")
+        self.app = web.Application()
         self._setup_routes()
-        self.servers: list[BaseWSGIServer] = []
+        self.runner: web.AppRunner = None
+
+    def _load_static_files(self) -> dict[str, CachedResponse]:
+        static_files = {}
+        for root, _, names in os.walk(STATIC_DIR):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    body = f.read()
+                content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                static_files[os.path.relpath(path, STATIC_DIR).replace(os.sep, "/")] = build_cached_response(body, content_type)
+        self.logger.debug(f"Loaded static files. count={len(static_files)}")
+        return static_files
+
+    def url_for(self, endpoint: str, filename: str = None) -> str:
+        # Flask's url_for, as far as the templates use it
+        if endpoint != "static":
+            raise ValueError(f"Unknown endpoint {endpoint}")
+        cached = self.static_files.get(filename)
+        return f"/static/{filename}?v={cached.version}" if cached is not None else f"/static/{filename}"
+
+    def _panels_key(self) -> tuple:
+        return tuple((panel.ip, panel.name, panel.label, panel.sip_handle, panel.building) for panel in self.wall_panels)
+
+    def _render(self, template_name: str, **context) -> CachedResponse:
+        panels_key = self._panels_key()
+        entry = self.rendered.get(template_name)
+        if entry is None or entry[0] != panels_key:
+            body = self.templates.get_template(template_name).render(**context).encode("utf-8")
+            entry = (panels_key, build_cached_response(body, "text/html"))
+            self.rendered[template_name] = entry
+        return entry[1]
 
     def _setup_routes(self):
-        @self.app.route("/", methods=["GET"])
-        def control_panel_ui():
+        async def control_panel_ui(request: web.Request):
             # Pass wall panels to the template
-            return render_template("index.html", panels=self.wall_panels)
+            return cached_response(request, self._render("index.html", panels=self.wall_panels), "no-cache")
 
-        @self.app.route("/wsui", methods=["GET"])
-        def honkhonk_ws_ui_rtc():
-            # Pass wall panels to the template
-            return render_template("rtc.html")
-        
-        @self.app.route("/wsui3", methods=["GET"])
-        def honkhonk_ws_ui_rtc_ipadmini():
-            # Pass wall panels to the template
-            return render_template("rtc3.html")
-
-        @self.app.route("/api/list_panels", methods=["GET"])
-        def handle_panels_list():
-            panels_list = []
-            panel_ids = []
-            panel_labels = []
-            panels_dict = {}
-            for panel in WALL_PANELS:
-                panels_dict[f"{panel.label}"] = panel.name
-                panels_list.append({"key":panel.name, "label": f"{panel.label}"})
-                panel_ids.append(panel.name)
-                panel_labels.append(f"{panel.label}")
-            
-            return jsonify({"success":True, "panels": panels_list, "panel_ids": panel_ids, "panel_labels": panel_labels, "panels_dict":panels_dict})
-        @self.app.route("/api/action", methods=["POST"])
-        def handle_action():
-            data = request.json
+        async def honkhonk_ws_ui_rtc(request: web.Request):
+            return cached_response(request, self._render("rtc.html", signalling_port=SIGNALLING_PORT), "no-cache")
+
+        async def honkhonk_ws_ui_rtc_ipadmini(request: web.Request):
+            try:
+                return cached_response(request, self._render("rtc3.html", signalling_port=SIGNALLING_PORT), "no-cache")
+            except TemplateNotFound:
+                raise web.HTTPNotFound()
+
+        async def handle_static(request: web.Request):
+            cached = self.static_files.get(request.match_info["path"])
+            if cached is None:
+                raise web.HTTPNotFound()
+            versioned = request.query.get("v") == cached.version
+            return cached_response(request, cached, "public, max-age=31536000, immutable" if versioned else "no-cache")
+
+        async def handle_panels_list(request: web.Request):
+            panels_key = self._panels_key()
+            if self.panels_list is None or self.panels_list[0] != panels_key:
+                panels_list = []
+                panel_ids = []
+                panel_labels = []
+                panels_dict = {}
+                for panel in self.wall_panels:
+                    panels_dict[f"{panel.label}"] = panel.name
+                    panels_list.append({"key":panel.name, "label": f"{panel.label}"})
+                    panel_ids.append(panel.name)
+                    panel_labels.append(f"{panel.label}")
+                body = json.dumps({"success":True, "panels": panels_list, "panel_ids": panel_ids, "panel_labels": panel_labels, "panels_dict":panels_dict}).encode("utf-8")
+                self.panels_list = (panels_key, build_cached_response(body, "application/json"))
+            return cached_response(request, self.panels_list[1], "no-cache")
+
+        async def handle_stats(request: web.Request):
+            stats = global_call_manager.get_stats()
+            if self.sip_handler.account is not None:
+                stats["sip_callbacks"] = self.sip_handler.account.callback_executor.get_stats()
+            stats["sip_threads"] = {**self.sip_handler.get_stats(), **sip_threads.get_stats()}
+            if isinstance(HGN_SSL_CONTEXT, RotatingSSLContext):
+                stats["tls"] = HGN_SSL_CONTEXT.get_stats()
+            return web.json_response(stats)
+
+        async def handle_action(request: web.Request):
+            data = await request.json()
             action = data.get("action")
             destination = data.get("destination")
             message = ""
+            loop = asyncio.get_running_loop()
 
             if action == "call_elevator":
                 self.logger.info("Call Elevator action triggered")
-                self.udp_handler.elevator_request(3, 4)  # Adjust logic as needed
+                await loop.run_in_executor(self.action_executor, self.udp_handler.elevator_request, 3, 4)  # Adjust logic as needed
                 message = "Elevator request sent!"
             elif action == "trigger_intercom":
                 self.logger.info(f"Trigger Intercom action triggered for {destination}")
-                trigger_send_unlock_to_wallpanel(destination, self.sip_handler.account)
+                await loop.run_in_executor(self.action_executor, trigger_send_unlock_to_wallpanel, destination, self.sip_handler.account)
                 message = f"Intercom triggered for {destination}!"
             else:
                 self.logger.warning(f"Unknown action: {action}")
-                return jsonify({"message": "Unknown action", "success": False}), 400
-
-            return jsonify({"message": message, "success": True})
-
-    def run(self, host: str, port: int):
-        # Use a server that can be manually shut down
-        server = make_server(host, port, self.app, ssl_context=HGN_SSL_CONTEXT)
-        self.servers.append(server)
-        # Start the server and block until shutdown
-        self.logger.info(f"Starting Flask server on {host}:{port}")
-        server.serve_forever()
-    def shutdown_all(self):
-        for server in self.servers:
-            server.shutdown()
-     
-def start_webrtc_srv(host: str):
-    logger = get_logger("start_webrtc_srv")
-    logger.debug("Calling run_main")
-    # This function is called in a separate thread
-    asyncio.run(run_main(host))
+                return web.json_response({"message": "Unknown action", "success": False}, status=400)
+
+            return web.json_response({"message": message, "success": True})
+
+        self.app.router.add_get("/", control_panel_ui)
+        self.app.router.add_get("/wsui", honkhonk_ws_ui_rtc)
+        self.app.router.add_get("/wsui3", honkhonk_ws_ui_rtc_ipadmini)
+        self.app.router.add_get("/static/{path:.+}", handle_static)
+        self.app.router.add_get("/api/list_panels", handle_panels_list)
+        self.app.router.add_get("/api/stats", handle_stats)
+        self.app.router.add_post("/api/action", handle_action)
+
+    async def start(self, hosts: list[str], port: int):
+        """ Serve on every host. One that can't be bound is logged and skipped """
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        for host in hosts:
+            try:
+                await web.TCPSite(self.runner, host, port, ssl_context=HGN_SSL_CONTEXT).start()
+                self.logger.info(f"Starting web server on {host}:{port}")
+            except OSError as e:
+                self.logger.error(f"Unable to serve web interface. host={host}, port={port}, error={e}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        self.action_executor.shutdown(wait=False)
 
 
 class WebInterfaceWrapper:
@@ -100,24 +210,32 @@ class WebInterfaceWrapper:
         self.logger = get_logger("web-interface-wrapper")
         self.web_interface = web_interface
         self.threads: list[threading.Thread] = []
-    def run(self, host: str, port: int):
-        self.logger.info(f"Starting webserver for ip={host}, port={port}")
-        thread = threading.Thread(target=self._run_server, args=(host, port), daemon=True)
-        thread.start()
-        self.threads.append(thread)
-
-        self.logger.info(f"Starting websockets for ip={host} port={8765}")
-
-        # thread = threading.Thread(target=_start_server_thread, daemon=True)
-        thread = threading.Thread(target=start_webrtc_srv, args=[host], daemon=True)
+        self.loop: asyncio.AbstractEventLoop = None
+        self.stop_future: asyncio.Future = None
+    def run(self, hosts: list[str], port: int):
+        """ One thread and one loop for the web interface and websocket signalling on all the hosts, the CallManager's state lives on it """
+        self.logger.info(f"Starting webserver and websockets for ips={hosts}, port={port}, signalling_port={SIGNALLING_PORT}")
+        thread = threading.Thread(target=self._run, args=(hosts, port), name="thread-web", daemon=True)
         thread.start()
-        self.logger.info(f"Websockets Started")
         self.threads.append(thread)
-    def _run_server(self, host: str, port: int):
-        self.web_interface.run(host=host, port=port)
+    def _run(self, hosts: list[str], port: int):
+        asyncio.run(self._main(hosts, port))
+    async def _main(self, hosts: list[str], port: int):
+        self.loop = asyncio.get_running_loop()
+        self.stop_future = self.loop.create_future()
+        await self.web_interface.start(hosts, port)
+        try:
+            await run_main(hosts, SIGNALLING_PORT, self.stop_future)
+            await self.stop_future  # Keep the web interface up even if no signalling server could start
+        finally:
+            await self.web_interface.stop()
 
     def stop(self):
         self.logger.info("Shutting down servers")
-        self.web_interface.shutdown_all()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop)
         for thread in self.threads:
             thread.join()  # Ensure that all threads finish before exiting
+    def _stop(self):
+        if not self.stop_future.done():
+            self.stop_future.set_result(None)
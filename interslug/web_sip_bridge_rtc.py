@@ -1,95 +1,26 @@
 import asyncio
-from dataclasses import asdict, dataclass
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
 import json
 import pjsua2 as pj
 
 from websockets.asyncio.server import serve, ServerConnection
 from websockets.exceptions import ConnectionClosedOK
 
-from interslug.misc_garbage.run_async_as_sync import run_async_as_sync
-from interslug.state.call_state import get_sip_call_info
-
 from .rtc_handler import RTCHandler
-from interslug.media_cookery.bridges import SIPAudioBridge, SIPToBrowserAudioTrack
-from interslug.media_cookery.queuing import Q_LIST_TYPE_SIP_TO_BROWSER, Q_LIST_TYPE_BROWSER_TO_SIP, get_queue_list_by_type, get_queue_by_id
-from interslug.messages.message_builder import message_to_str
-from interslug.messages.notification_types import NotificationOnCallStatus
+from interslug.media_cookery.bridges import SIPToBrowserAudioTrack
 from logging_config import get_logger
-from config import HGN_SSL_CONTEXT
-
-from typing import TYPE_CHECKING
-from hgn_sip.sip_media import get_audio_format
+from config import HGN_SSL_CONTEXT, SIGNALLING_PORT
 
 from interslug.state.call_manager import global_call_manager
 
-if TYPE_CHECKING:
-    from hgn_sip.sip_call import SIPCall
-    from hgn_sip.sip_account import SIPAccount
-
-# PJSIP Call State
-websocket_clients = set()  # Tracks connected WebSocket clients
-rtcpc_clients = []
-
-rtc_connections: list[RTCHandler] = []
-
-get_queue_list_by_type(Q_LIST_TYPE_SIP_TO_BROWSER)
-get_queue_list_by_type(Q_LIST_TYPE_BROWSER_TO_SIP)
-
-
-def get_pc_for_wsid(wsid):
-    """ Return RPC for websocket UUID
-    """
-    for pc in rtcpc_clients:
-        if pc["uuid"] == wsid:
-            return pc["pc"]
-
-def attach_bridge_to_sip_call(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'pj.CallInfo'):
-    """ 
-        Attach the SIPAudioBridge as a listening port to the SIP Call, this will then receive the frames of audio to share downstream.
-    """ 
-    logger = get_logger("attach_bridge_to_sip_call")
-    # Get call audio media
-    # Attach this SIPAudioBridge to it 
-    logger.debug("Creating SIPAudioBridge")
-    audio_port = SIPAudioBridge(call_id=call_info.callIdString) # This gets audio FROM sip and adds to queue for RTC
-    logger.debug("Registering port with pre-defined PCM format")
-    audio_port.createPort("WebsocketAudioPort", get_audio_format()) # Audio Format is set once
-    call_audio_media = call.get_call_audio_media() # This is the incoming SIP audio stream
-    logger.debug("Triggering Transmit on existing call's audiomedia")
-    call_audio_media.startTransmit(audio_port)
-
-    call.ports.append(audio_port) # Store the AudioPort for future use
-
-def sip_call_cb_notify_ws(call: 'SIPCall', call_account: 'SIPAccount', call_info: 'pj.CallInfo'):
-    """ 
-        Callback triggered on call statuses from hgnsip.sip_call
-        Notifies the WS clients of the state
-    """
-    logger = get_logger("sip_call_cb_notify_ws")
-    data = asdict(get_sip_call_info(call))
-
-    msg = {
-        "type": "on_call_status",
-        "call": data
-    }
-    logger.debug(msg)
-    run_async_as_sync(global_call_manager.send_ws_message(msg))
-    # asyncio.run(global_call_manager.send_ws_message(msg))
-
-
-def get_rtc_connection_by_ws_id(ws_id):
-    for conn in rtc_connections:
-        if conn.ws_id == ws_id:
-            return conn
-
 async def process_rtc_msg(websocket: ServerConnection, message): 
     logger = get_logger(f"process-rtc-message[{websocket.id}]")
-    rtc_conn = get_rtc_connection_by_ws_id(websocket.id)
+    rtc_conn = global_call_manager.get_rtc_handler(websocket.id)
     if rtc_conn is None:
         logger.debug("No connection found, creating...")
-        rtc_conn = RTCHandler(websocket)
+        rtc_conn = RTCHandler(websocket, global_call_manager.get_browser(websocket.id).outbox)
         global_call_manager.browser_add_rtc_handler(websocket.id, rtc_conn)
-        rtc_connections.append(rtc_conn)
 
     msg_type = message["type"]
     # logger.debug(f"type={msg_type}")
@@ -97,7 +28,7 @@ async def process_rtc_msg(websocket: ServerConnection, message):
     if msg_type == "offer":
         answer = await rtc_conn.process_offer_and_form_answer(message)
         logger.debug("Responding with answer")
-        await websocket.send(message_to_str(answer, "rtc"))
+        await rtc_conn.send_message(answer)
     if msg_type == "answer":
         logger.debug("Processing new Answer")
         await rtc_conn.update_remote_description(message)
@@ -120,13 +51,21 @@ async def process_sip_msg(websocket: ServerConnection, message):
         target_call_id = message["call_id"]
         logger.debug(f"Wants to disconnect from call. callid={target_call_id}")
         await global_call_manager.browser_leave_call(websocket.id)
+    elif msg_type == "listen_calls":
+        # Browser wants to hear these calls (all at once, mixed) without answering them. Empty list stops listening
+        call_ids: list[str] = message.get("call_ids", [])
+        logger.debug(f"Wants to listen to calls. call_ids={call_ids}")
+        await global_call_manager.browser_listen_calls(websocket.id, call_ids, message.get("gains"))
+    elif msg_type == "play_prompt":
+        target_call_id = message["call_id"]
+        logger.debug(f"Wants to play prompt. callid={target_call_id}, prompt={message['prompt']}")
+        await global_call_manager.play_prompt(target_call_id, message["prompt"])
     elif msg_type == "get_call_list":
-        await global_call_manager.send_browser_call_list(websocket.id)
+        # since/epoch are the last call_delta/call_list the browser applied, to resume from
+        global_call_manager.send_browser_call_list(websocket.id, message.get("since"), message.get("epoch"))
 
 
 async def handle_signaling(websocket: ServerConnection):
-    global websocket_clients
-    websocket_clients.add(websocket)
     logger = get_logger(f"ws-handle-signalling[{websocket.id}]")
     logger.debug(f"New websocket client remote_address={websocket.remote_address}")
     browser_id = websocket.id
@@ -156,25 +95,32 @@ async def handle_signaling(websocket: ServerConnection):
             except ConnectionClosedOK as e:
                 should_run = False
                 logger.debug("Connection closed (ok)")
-                global_call_manager.remove_browser(browser_id)
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        global_call_manager.remove_browser(browser_id)
         raise
     finally:
-        if websocket is not None:
-            logger.debug(f"Connection from {websocket.remote_address} closed")
-            global_call_manager.remove_browser(browser_id)
-            pc = get_pc_for_wsid(websocket.id)
-            if pc is not None:
-                await pc.close()
-            websocket_clients.remove(websocket)
+        # Everything for this browser (peer connection, tracks, outbox) lives in the CallManager and goes with it
+        logger.debug(f"Connection from {websocket.remote_address} closed")
+        await global_call_manager.remove_browser(browser_id)
 
-async def run_main():
+async def run_main(hosts: list[str], port: int = SIGNALLING_PORT, stop: asyncio.Future = None):
+    """
+        Serve signalling on every bind address from this one loop, so browsers on the LAN and the tailnet
+        share the CallManager's state (and its loop) directly. An address that can't be bound is logged and
+        skipped rather than taking the others down with it.
+    """
     logger = get_logger("ws_server_main")
-    # Start WebSocket server with WSS
-    async with serve(
-        handle_signaling, "192.168.1.185", 8765, ssl=HGN_SSL_CONTEXT
-    ):
-        logger.info("WebRTC signaling server running on wss://192.168.1.185:8765")
-        await asyncio.Future()  # Run forever
+    global_call_manager.set_loop(asyncio.get_running_loop())
+    async with AsyncExitStack() as servers:
+        listening = []
+        for host in hosts:
+            try:
+                await servers.enter_async_context(serve(handle_signaling, host, port, ssl=HGN_SSL_CONTEXT))
+                listening.append(host)
+                logger.info(f"WebRTC signaling server running on wss://{host}:{port}")
+            except OSError as e:
+                logger.error(f"Unable to serve signaling. host={host}, port={port}, error={e}")
+        if not listening:
+            logger.error("No signaling servers running")
+            return
+        await (stop if stop is not None else asyncio.Future())  # Run until stopped
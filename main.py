@@ -48,9 +48,8 @@ def main():
             main_logger.info(f"Starting thread for UDPHandler.periodic_dhcp")
             threading.Thread(target=udp_handler.periodic_dhcp, name="thread-udphandler-periodic_dhcp", daemon=True).start()
         if SHOULD_RUN_WEB:
-            # Start Flask web listener
-            web_wrapper.run(LOCAL_WEB_BIND_IP_ADDRESS, 5000)
-            web_wrapper.run(TAILSCALE_BIND_IP_ADDRESS, 5000)
+            # Start the web interface and websocket signalling for both, on one loop so they share calls and browsers
+            web_wrapper.run([LOCAL_WEB_BIND_IP_ADDRESS, TAILSCALE_BIND_IP_ADDRESS], 5000)
         # threading.Thread(target=web_interface.run, args=("192.168.1.185", 5000), name="thread-web-interface", daemon=True).start()
         # threading.Thread(target=web_interface.run, args=(TAILSCALE_BIND_IP_ADDRESS, 5000), name="thread-web-interface-ts", daemon=True).start()
         print("Running... Press Ctrl+C to interrupt")
@@ -0,0 +1,104 @@
+from interslug.state.call_snapshot import CallSnapshot, merge_call_deltas
+
+def apply_delta(calls: dict, msg: dict) -> dict:
+    """ What sip_mgr.js does with a call_delta """
+    calls = {call_id: dict(call) for call_id, call in calls.items()}
+    for call_id, changes in msg["calls"].items():
+        if changes is None:
+            calls.pop(call_id, None)
+        else:
+            calls[call_id] = {**calls.get(call_id, {}), **changes}
+    return calls
+
+def test_update_sends_only_what_changed():
+    snapshot = CallSnapshot()
+    first = snapshot.update("c1", {"callStateString": "INCOMING", "remoteUri": "sip:1@panel"})
+    assert first["type"] == "call_delta"
+    assert (first["from_seq"], first["seq"]) == (0, 1)
+    assert first["calls"] == {"c1": {"callStateString": "INCOMING", "remoteUri": "sip:1@panel"}}
+
+    second = snapshot.update("c1", {"callStateString": "CONFIRMED", "remoteUri": "sip:1@panel"})
+    assert (second["from_seq"], second["seq"]) == (1, 2)
+    assert second["calls"] == {"c1": {"callStateString": "CONFIRMED"}}
+    assert snapshot.get("c1") == {"callStateString": "CONFIRMED", "remoteUri": "sip:1@panel"}
+
+def test_no_change_sends_nothing():
+    snapshot = CallSnapshot()
+    snapshot.update("c1", {"callStateString": "EARLY"})
+    assert snapshot.update("c1", {"callStateString": "EARLY"}) is None
+    assert snapshot.seq == 1
+
+def test_remove():
+    snapshot = CallSnapshot()
+    snapshot.update("c1", {"callStateString": "EARLY"})
+    msg = snapshot.remove("c1")
+    assert msg["calls"] == {"c1": None}
+    assert snapshot.get("c1") is None
+    assert snapshot.remove("c1") is None
+    assert snapshot.seq == 2
+
+def test_merge_newer_fields_win():
+    older = {"type": "call_delta", "epoch": "e", "from_seq": 3, "seq": 4, "calls": {"c1": {"a": 1, "b": 1}}}
+    newer = {"type": "call_delta", "epoch": "e", "from_seq": 4, "seq": 5, "calls": {"c1": {"b": 2}, "c2": {"a": 9}}}
+    merged = merge_call_deltas(older, newer)
+    assert (merged["from_seq"], merged["seq"]) == (3, 5)
+    assert merged["calls"] == {"c1": {"a": 1, "b": 2}, "c2": {"a": 9}}
+
+def test_merge_remove_and_readd():
+    added = {"from_seq": 0, "seq": 1, "calls": {"c1": {"a": 1, "b": 1}}}
+    removed = {"from_seq": 1, "seq": 2, "calls": {"c1": None}}
+    readded = {"from_seq": 2, "seq": 3, "calls": {"c1": {"a": 2}}}
+    assert merge_call_deltas(added, removed)["calls"] == {"c1": None}
+    # A removal then an add has to carry only the new call's fields, not the removed one's
+    assert merge_call_deltas(merge_call_deltas(added, removed), readded)["calls"] == {"c1": {"a": 2}}
+
+def test_merged_deltas_apply_the_same_as_each_in_turn():
+    snapshot = CallSnapshot()
+    messages = [
+        snapshot.update("c1", {"state": "INCOMING", "uri": "sip:1@p"}),
+        snapshot.update("c2", {"state": "INCOMING", "uri": "sip:2@p"}),
+        snapshot.update("c1", {"state": "CONFIRMED", "uri": "sip:1@p"}),
+        snapshot.remove("c2"),
+        snapshot.update("c2", {"state": "EARLY", "uri": "sip:3@p"}),
+    ]
+    one_by_one = {}
+    for msg in messages:
+        one_by_one = apply_delta(one_by_one, msg)
+    merged = messages[0]
+    for msg in messages[1:]:
+        merged = merge_call_deltas(merged, msg)
+    assert apply_delta({}, merged) == one_by_one == snapshot.full_message()["calls"]
+    assert (merged["from_seq"], merged["seq"]) == (0, snapshot.seq)
+
+def test_resume_sends_what_was_missed():
+    snapshot = CallSnapshot()
+    snapshot.update("c1", {"state": "INCOMING"})
+    seen = snapshot.seq
+    browser_calls = apply_delta({}, snapshot.full_message())
+    snapshot.update("c1", {"state": "CONFIRMED"})
+    snapshot.update("c2", {"state": "INCOMING"})
+    msg = snapshot.resume_message(seen, snapshot.epoch)
+    assert msg["type"] == "call_delta"
+    assert (msg["from_seq"], msg["seq"]) == (seen, snapshot.seq)
+    assert apply_delta(browser_calls, msg) == snapshot.full_message()["calls"]
+    assert snapshot.resumes == 1
+
+def test_resume_when_up_to_date_is_empty():
+    snapshot = CallSnapshot()
+    snapshot.update("c1", {"state": "INCOMING"})
+    msg = snapshot.resume_message(snapshot.seq, snapshot.epoch)
+    assert msg["type"] == "call_delta"
+    assert msg["calls"] == {}
+
+def test_resume_falls_back_to_the_full_list():
+    snapshot = CallSnapshot(log_size=2)
+    for i in range(5):
+        snapshot.update("c1", {"n": i})
+    assert snapshot.resume_message(None, snapshot.epoch)["type"] == "call_list"
+    # Another run's seqs mean nothing
+    assert snapshot.resume_message(snapshot.seq, "another-epoch")["type"] == "call_list"
+    # Ahead of us, i.e. from before a restart that happened to keep the epoch
+    assert snapshot.resume_message(snapshot.seq + 1, snapshot.epoch)["type"] == "call_list"
+    # Older than the log goes back
+    assert snapshot.resume_message(1, snapshot.epoch)["type"] == "call_list"
+    assert snapshot.resume_message(snapshot.seq - 2, snapshot.epoch)["type"] == "call_delta"
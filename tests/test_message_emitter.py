@@ -0,0 +1,178 @@
+import asyncio
+import json
+import threading
+
+from websockets.exceptions import ConnectionClosedOK
+
+from interslug.state.call_snapshot import merge_call_deltas
+from interslug.state.message_emitter import BrowserOutbox, SocketMessenger, MessageChannel
+
+class RecordingOutbox():
+    def __init__(self):
+        self.puts: list[tuple[dict, bool, str]] = []
+    def put(self, body: bytes, droppable: bool = False, stale_key: str = None):
+        self.puts.append((json.loads(body)["message"], droppable, stale_key))
+
+class FakeBrowser():
+    def __init__(self):
+        self.outbox = RecordingOutbox()
+
+class FakeCallManager():
+    def __init__(self, browsers: int = 1):
+        self.browsers = {f"ws-{i}": FakeBrowser() for i in range(browsers)}
+
+def delta(from_seq: int, calls: dict) -> dict:
+    return {"type": "call_delta", "epoch": "e", "from_seq": from_seq, "seq": from_seq + 1, "calls": calls}
+
+async def start_messenger(browsers: int = 1, coalesce_ms: int = 50) -> SocketMessenger:
+    messenger = SocketMessenger(FakeCallManager(browsers), max_queued=100, coalesce_ms=coalesce_ms)
+    messenger.start(asyncio.get_running_loop())
+    return messenger
+
+async def settle(seconds: float = 0):
+    await asyncio.sleep(seconds)
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_broadcast_is_encoded_once_for_every_browser():
+    async def run():
+        messenger = await start_messenger(browsers=3)
+        messenger.queueMessageAll(MessageChannel.SIP, {"type": "call_list", "calls": {}})
+        await settle()
+        return messenger
+    messenger = asyncio.run(run())
+    for browser in messenger.cm.browsers.values():
+        assert browser.outbox.puts == [({"type": "call_list", "calls": {}}, False, None)]
+    assert messenger.sent == 3
+
+def test_coalesced_burst_sends_first_then_one_merged():
+    async def run():
+        messenger = await start_messenger(coalesce_ms=50)
+        messenger.queueMessageAll(MessageChannel.SIP, delta(0, {"c1": {"state": "INCOMING"}}), coalesce_key="call_delta", merge=merge_call_deltas)
+        messenger.queueMessageAll(MessageChannel.SIP, delta(1, {"c1": {"state": "EARLY"}}), coalesce_key="call_delta", merge=merge_call_deltas)
+        messenger.queueMessageAll(MessageChannel.SIP, delta(2, {"c2": {"state": "INCOMING"}}), coalesce_key="call_delta", merge=merge_call_deltas)
+        await settle()
+        during = list(messenger.cm.browsers["ws-0"].outbox.puts)
+        await settle(0.1)
+        return messenger, during
+    messenger, during = asyncio.run(run())
+    puts = messenger.cm.browsers["ws-0"].outbox.puts
+    assert [msg["seq"] for msg, _, _ in during] == [1]
+    assert len(puts) == 2
+    merged = puts[1][0]
+    assert (merged["from_seq"], merged["seq"]) == (1, 3)
+    assert merged["calls"] == {"c1": {"state": "EARLY"}, "c2": {"state": "INCOMING"}}
+    assert messenger.coalesced == 1
+
+def test_coalesced_without_merge_keeps_the_latest():
+    async def run():
+        messenger = await start_messenger(coalesce_ms=50)
+        for n in range(5):
+            messenger.queueMessageAll(MessageChannel.SIP, {"type": "status", "n": n}, coalesce_key="status")
+        await settle(0.1)
+        return messenger
+    messenger = asyncio.run(run())
+    assert [msg["n"] for msg, _, _ in messenger.cm.browsers["ws-0"].outbox.puts] == [0, 4]
+
+def test_different_keys_dont_coalesce_together():
+    async def run():
+        messenger = await start_messenger(coalesce_ms=50)
+        messenger.queueMessageAll(MessageChannel.SIP, {"type": "status", "n": 1}, coalesce_key="a")
+        messenger.queueMessageAll(MessageChannel.SIP, {"type": "status", "n": 2}, coalesce_key="b")
+        await settle()
+        return messenger
+    messenger = asyncio.run(run())
+    assert [msg["n"] for msg, _, _ in messenger.cm.browsers["ws-0"].outbox.puts] == [1, 2]
+
+def test_posting_from_another_thread():
+    async def run():
+        messenger = await start_messenger()
+        thread = threading.Thread(target=messenger.queueMessageAll, args=(MessageChannel.SIP, {"type": "call_list", "calls": {}}))
+        thread.start()
+        thread.join()
+        await settle()
+        return messenger
+    messenger = asyncio.run(run())
+    assert len(messenger.cm.browsers["ws-0"].outbox.puts) == 1
+
+def test_only_status_messages_are_droppable():
+    async def run():
+        messenger = await start_messenger()
+        messenger.queueMessageAll(MessageChannel.SIP, {"type": "audio_level", "call_id": "c1", "rms_dbfs": -20})
+        messenger.queueMessageAll(MessageChannel.SIP, delta(0, {"c1": {"state": "EARLY"}}))
+        messenger.queueMessageAll(MessageChannel.RTC, {"type": "audio_level", "call_id": "c1"})
+        await settle()
+        return messenger
+    messenger = asyncio.run(run())
+    policies = [(droppable, stale_key) for _, droppable, stale_key in messenger.cm.browsers["ws-0"].outbox.puts]
+    assert policies == [(True, "audio_level_c1"), (False, None), (False, None)]
+
+class FakeWebsocket():
+    def __init__(self, closed: bool = False):
+        self.id = "ws-test"
+        self.sent: list[str] = []
+        self.closed = closed
+    async def send(self, body: bytes, text: bool = False):
+        if self.closed:
+            raise ConnectionClosedOK(None, None)
+        self.sent.append(body.decode())
+
+def queued(outbox: BrowserOutbox) -> list[str]:
+    return [item[1].decode() for item in outbox.items]
+
+def test_outbox_replaces_stale_status_in_place():
+    outbox = BrowserOutbox(FakeWebsocket(), max_queued=10)
+    outbox.put(b"level-1", droppable=True, stale_key="audio_level_c1")
+    outbox.put(b"signal")
+    outbox.put(b"level-2", droppable=True, stale_key="audio_level_c1")
+    assert queued(outbox) == ["level-2", "signal"]
+    assert outbox.replaced == 1
+
+def test_outbox_full_drops_oldest_droppable():
+    outbox = BrowserOutbox(FakeWebsocket(), max_queued=3)
+    outbox.put(b"signal-1")
+    outbox.put(b"level-a", droppable=True, stale_key="a")
+    outbox.put(b"level-b", droppable=True, stale_key="b")
+    outbox.put(b"signal-2")
+    assert queued(outbox) == ["signal-1", "level-b", "signal-2"]
+    assert outbox.dropped == 1
+    # Its key went with it, a new status for it queues again
+    outbox.put(b"level-a2", droppable=True, stale_key="a")
+    assert queued(outbox) == ["signal-1", "signal-2", "level-a2"]
+
+def test_outbox_never_drops_what_isnt_droppable():
+    outbox = BrowserOutbox(FakeWebsocket(), max_queued=2)
+    for n in range(4):
+        outbox.put(f"signal-{n}".encode())
+    outbox.put(b"level", droppable=True, stale_key="a")
+    assert queued(outbox) == ["signal-0", "signal-1", "signal-2", "signal-3"]
+    assert outbox.dropped == 1
+
+def test_outbox_sends_in_order():
+    async def run():
+        websocket = FakeWebsocket()
+        outbox = BrowserOutbox(websocket, max_queued=10)
+        outbox.start()
+        for n in range(3):
+            outbox.put(f"msg-{n}".encode())
+        await settle()
+        outbox.put(b"msg-3")
+        await settle()
+        outbox.close()
+        return websocket, outbox
+    websocket, outbox = asyncio.run(run())
+    assert websocket.sent == ["msg-0", "msg-1", "msg-2", "msg-3"]
+    assert outbox.sent == 4
+
+def test_outbox_closes_when_the_browser_has_gone():
+    async def run():
+        outbox = BrowserOutbox(FakeWebsocket(closed=True), max_queued=10)
+        outbox.start()
+        outbox.put(b"msg-0")
+        outbox.put(b"msg-1")
+        await settle()
+        outbox.put(b"msg-2")
+        return outbox
+    outbox = asyncio.run(run())
+    assert outbox.closed
+    assert queued(outbox) == []
@@ -0,0 +1,79 @@
+import wave
+
+import numpy as np
+import pjsua2 as pj
+import pytest
+
+from hgn_sip.sip_media import get_audio_format
+from interslug.media_cookery.prompts import PromptCache, PromptPlayer
+
+@pytest.fixture
+def cache(tmp_path):
+    source_dir = tmp_path / "prompts"
+    source_dir.mkdir()
+    with wave.open(str(source_dir / "chime.wav"), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(8000)
+        f.writeframes((np.arange(1000) % 100 * 100).astype(np.int16).tobytes())
+    return PromptCache(str(source_dir), str(tmp_path / "cache"))
+
+def joined(frames) -> np.ndarray:
+    return np.frombuffer(b"".join(bytes(frame) for frame in frames), dtype=np.int16)
+
+def pull(player: PromptPlayer, count: int) -> list:
+    bufs = []
+    for _ in range(count):
+        frame = pj.MediaFrame()
+        player.onFrameRequested(frame)
+        bufs.append(frame.buf)
+    return bufs
+
+def test_has_prompt_only_for_files_in_the_directory(cache):
+    assert cache.has_prompt("chime.wav")
+    assert not cache.has_prompt("missing.wav")
+    assert not cache.has_prompt("../prompts/chime.wav")
+    assert not cache.has_prompt(None)
+
+def test_frames_are_cut_once_and_shared(cache):
+    frames = cache.get_frames("chime.wav", 8000, 160)
+    assert cache.get_frames("chime.wav", 8000, 160) is frames
+    assert cache.decodes == 1
+    pcm = cache.get("chime.wav", 8000)
+    # The last frame's padded with silence
+    assert len(frames) == 7
+    assert np.array_equal(joined(frames)[:len(pcm)], pcm)
+    assert not np.any(joined(frames)[len(pcm):])
+
+@pytest.mark.parametrize("samples", [1000, 1600, 50])
+def test_looped_frames_wrap_without_a_gap(samples):
+    pcm = np.arange(samples, dtype=np.int16)
+    frames = PromptCache()._cut_frames(pcm, 160, loop=True)
+    # Round twice, it's the prompt over and over with nothing between
+    played = joined(frames * 2)
+    assert np.array_equal(played, np.resize(pcm, len(played)))
+
+def test_long_loops_restart_each_pass_without_silence():
+    cache = PromptCache(max_loop_frames=5)
+    pcm = np.arange(1, 1001, dtype=np.int16)
+    frames = cache._cut_frames(pcm, 160, loop=True)
+    assert len(frames) == 7
+    assert np.all(joined(frames) != 0)
+
+def test_player_hands_out_the_cached_frames(cache):
+    player = PromptPlayer(get_audio_format(8000))
+    frames = cache.get_frames("chime.wav", 8000, player.frame_samples)
+    player.play(frames)
+    bufs = pull(player, len(frames) + 1)
+    assert all(buf is frame for buf, frame in zip(bufs, frames))
+    assert bufs[-1] is player.silence
+    assert not player.is_playing()
+
+def test_player_loops_until_stopped(cache):
+    player = PromptPlayer(get_audio_format(8000))
+    frames = cache.get_frames("chime.wav", 8000, player.frame_samples, loop=True)
+    player.play(frames, loop=True)
+    bufs = pull(player, 2 * len(frames))
+    assert bufs[len(frames)] is frames[0]
+    player.stop()
+    assert pull(player, 1)[0] is player.silence
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import numpy as np
+
+from interslug.media_cookery.queuing import QueueRegistry, add_frame_to_queue, get_from_queue
+
+def test_create_is_idempotent_and_release_removes():
+    registry = QueueRegistry()
+    queue = registry.create_queue("T", "q1", owner_id="c1")
+    assert registry.create_queue("T", "q1", owner_id="c1") is queue
+    assert registry.get_queue("T", "q1") is queue
+    registry.release_queue("T", "q1")
+    registry.release_queue("T", "q1")
+    assert registry.get_queue("T", "q1") is None
+    stats = registry.get_stats()
+    assert (stats["created"], stats["released"]) == (1, 1)
+
+def test_release_owner_takes_all_its_queues():
+    registry = QueueRegistry()
+    registry.create_queue("A", "q1", owner_id="c1")
+    registry.create_queue("B", "q2", owner_id="c1")
+    keep = registry.create_queue("A", "q3", owner_id="c2")
+    assert registry.release_owner("c1") == 2
+    assert registry.get_stats()["live"] == {"A": 1, "B": 0}
+    assert registry.get_queue("A", "q3") is keep
+
+def test_idle_queues_of_calls_that_are_up_arent_evicted():
+    registry = QueueRegistry(idle_ttl_sec=60)
+    registry.add_owner("up")
+    held = registry.create_queue("T", "held", owner_id="up")
+    gone = registry.create_queue("T", "gone", owner_id="ended")
+    orphan = registry.create_queue("T", "orphan")
+    fresh = registry.create_queue("T", "fresh")
+    for queue in (held, gone, orphan):
+        queue.last_used = time.time() - 120
+    assert registry.evict_idle() == 2
+    assert sorted(registry.queues["T"]) == ["fresh", "held"]
+    assert registry.get_stats()["owners"] == 1
+    registry.release_owner("up")
+    assert registry.get_stats()["owners"] == 0
+    assert sorted(registry.queues["T"]) == ["fresh"]
+
+def test_frames_through_a_queue():
+    async def run():
+        registry = QueueRegistry()
+        queue = registry.create_queue("T", "q1")
+        add_frame_to_queue(np.full(160, 7, dtype=np.int16), queue)
+        frame = await get_from_queue(queue, max_age=1, expected_sample_size=160)
+        empty = await get_from_queue(queue, max_age=1, expected_sample_size=160)
+        add_frame_to_queue(np.full(160, 7, dtype=np.int16), queue)
+        queue.queue._queue[0].timestamp_added -= 5
+        stale = await get_from_queue(queue, max_age=1, expected_sample_size=160)
+        return registry, frame, empty, stale
+    registry, frame, empty, stale = asyncio.run(run())
+    assert not frame.is_zero_frame
+    assert np.all(frame.audio_data == 7)
+    assert registry.get_stats()["queued_frames"] == 0
+    # Nothing queued, or only frames too old to play, comes back as silence
+    for zero in (empty, stale):
+        assert zero.is_zero_frame
+        assert zero.samples == 160
@@ -0,0 +1,38 @@
+import os
+import time
+
+from interslug.media_cookery.recording import enforce_retention
+
+def make_recording(directory, name: str, size: int, age_sec: float) -> str:
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(bytes(size))
+    mtime = time.time() - age_sec
+    os.utime(path, (mtime, mtime))
+    return path
+
+def test_deletes_recordings_past_the_age_limit(tmp_path):
+    make_recording(tmp_path, "old.wav", 10, age_sec=7200)
+    make_recording(tmp_path, "new.wav", 10, age_sec=10)
+    assert enforce_retention(str(tmp_path), max_bytes=0, max_age_sec=3600) == 1
+    assert sorted(os.listdir(tmp_path)) == ["new.wav"]
+
+def test_deletes_oldest_until_under_the_size_limit(tmp_path):
+    make_recording(tmp_path, "a.wav", 100, age_sec=300)
+    make_recording(tmp_path, "b.ogg", 100, age_sec=200)
+    make_recording(tmp_path, "c.wav", 100, age_sec=100)
+    assert enforce_retention(str(tmp_path), max_bytes=150, max_age_sec=0) == 2
+    assert sorted(os.listdir(tmp_path)) == ["c.wav"]
+
+def test_looks_in_subdirectories_and_leaves_other_files(tmp_path):
+    day = tmp_path / "2026-10-19"
+    day.mkdir()
+    make_recording(day, "call.wav", 100, age_sec=7200)
+    make_recording(tmp_path, "notes.txt", 100, age_sec=7200)
+    assert enforce_retention(str(tmp_path), max_bytes=0, max_age_sec=3600) == 1
+    assert os.listdir(day) == []
+    assert (tmp_path / "notes.txt").exists()
+
+def test_no_limits_deletes_nothing(tmp_path):
+    make_recording(tmp_path, "a.wav", 100, age_sec=7200)
+    assert enforce_retention(str(tmp_path), max_bytes=0, max_age_sec=0) == 0
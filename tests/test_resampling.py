@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from interslug.media_cookery.resampling import PolyphaseResampler
+
+def tone_gain(in_rate: int, out_rate: int, freq: float, frame_ms: int = 20) -> float:
+    """ Steady-state gain of a tone through the resampler, fed a frame at a time like the bridges do """
+    resampler = PolyphaseResampler(in_rate, out_rate)
+    t = np.arange(in_rate) / in_rate
+    tone = (10000 * np.sin(2 * np.pi * freq * t)).astype(np.int16)
+    frame = in_rate * frame_ms // 1000
+    out = np.concatenate([resampler.process(tone[i:i + frame]) for i in range(0, len(tone), frame)]).astype(np.float64)
+    settled = out[len(out) // 2:]
+    return np.sqrt(2 * np.mean(settled ** 2)) / 10000
+
+def db(gain: float) -> float:
+    return 20 * np.log10(max(gain, 1e-9))
+
+@pytest.mark.parametrize("in_rate, out_rate", [(48000, 8000), (48000, 16000), (8000, 48000), (16000, 48000)])
+def test_passband_is_flat(in_rate, out_rate):
+    for freq in (300, 1000, 2000):
+        assert abs(db(tone_gain(in_rate, out_rate, freq))) < 0.5
+
+def test_48k_to_8k_stops_what_would_alias():
+    # 5kHz folds back to 3kHz at 8kHz, it has to be well below the voice band
+    assert db(tone_gain(48000, 8000, 3000)) - db(tone_gain(48000, 8000, 5000)) >= 40
+    for freq in (6000, 7000, 10000):
+        assert db(tone_gain(48000, 8000, freq)) < -40
+
+def test_48k_to_16k_stops_what_would_alias():
+    assert db(tone_gain(48000, 16000, 6000)) - db(tone_gain(48000, 16000, 10000)) >= 40
+    for freq in (11000, 14000):
+        assert db(tone_gain(48000, 16000, freq)) < -40
+
+@pytest.mark.parametrize("in_rate, out_rate", [(48000, 8000), (8000, 48000), (44100, 16000)])
+def test_output_length_matches_prediction(in_rate, out_rate):
+    resampler = PolyphaseResampler(in_rate, out_rate)
+    frame = np.zeros(in_rate // 100, dtype=np.int16)
+    total_in = total_out = 0
+    for _ in range(50):
+        expected = resampler.output_samples_for(len(frame))
+        out = resampler.process(frame)
+        assert len(out) == expected
+        total_in += len(frame)
+        total_out += len(out)
+    assert abs(total_out - total_in * out_rate / in_rate) <= 1
+
+def test_frames_match_one_block():
+    # State carries across process() calls, so frame by frame is the same as all at once
+    samples = (np.random.default_rng(1).standard_normal(4800) * 3000).astype(np.int16)
+    whole = PolyphaseResampler(48000, 8000).process(samples)
+    framed = PolyphaseResampler(48000, 8000)
+    pieces = np.concatenate([framed.process(samples[i:i + 480]) for i in range(0, len(samples), 480)])
+    assert np.array_equal(whole, pieces)
+
+def test_same_rate_is_passthrough():
+    samples = np.arange(160, dtype=np.int16)
+    assert PolyphaseResampler(8000, 8000).process(samples) is samples
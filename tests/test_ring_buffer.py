@@ -0,0 +1,46 @@
+import numpy as np
+
+from interslug.media_cookery.ring_buffer import AudioRingBuffer
+
+def read(ring: AudioRingBuffer, n: int) -> tuple[np.ndarray, int]:
+    out = np.full(n, -1, dtype=np.int16)
+    got = ring.read_into(out)
+    return out, got
+
+def test_reads_back_what_was_written_across_the_wrap():
+    ring = AudioRingBuffer(8)
+    ring.write(np.arange(6, dtype=np.int16))
+    out, got = read(ring, 4)
+    assert got == 4 and list(out) == [0, 1, 2, 3]
+    ring.write(np.arange(6, 12, dtype=np.int16))
+    out, got = read(ring, 8)
+    assert got == 8 and list(out) == [4, 5, 6, 7, 8, 9, 10, 11]
+    assert (ring.overrun_samples, ring.underrun_samples) == (0, 0)
+
+def test_underrun_pads_with_silence():
+    ring = AudioRingBuffer(8)
+    ring.write(np.array([5, 6], dtype=np.int16))
+    out, got = read(ring, 5)
+    assert got == 2 and list(out) == [5, 6, 0, 0, 0]
+    assert ring.underrun_samples == 3
+
+def test_overrun_drops_the_oldest():
+    ring = AudioRingBuffer(4)
+    ring.write(np.arange(3, dtype=np.int16))
+    ring.write(np.arange(3, 6, dtype=np.int16))
+    out, got = read(ring, 4)
+    assert list(out) == [2, 3, 4, 5]
+    assert ring.overrun_samples == 2
+
+def test_write_bigger_than_the_ring_keeps_the_newest():
+    ring = AudioRingBuffer(4)
+    ring.write(np.arange(10, dtype=np.int16))
+    out, _ = read(ring, 4)
+    assert list(out) == [6, 7, 8, 9]
+    assert ring.overrun_samples == 6
+
+def test_clear():
+    ring = AudioRingBuffer(4)
+    ring.write(np.arange(3, dtype=np.int16))
+    ring.clear()
+    assert read(ring, 2)[1] == 0
@@ -0,0 +1,58 @@
+import pjsua2 as pj
+import pytest
+
+from hgn_sip.sip_account import SIPAccount, normalise_uri
+
+class FakeCall():
+    def __init__(self, call_id: int):
+        self.call_id = call_id
+        self.call_info = None
+        self.remote_uri: str = None
+
+@pytest.fixture
+def account():
+    account = SIPAccount(pj.Endpoint.instance())
+    yield account
+    account.callback_executor.stop()
+
+@pytest.mark.parametrize("uri, expected", [
+    ("sip:1001@10.0.0.5", "sip:1001@10.0.0.5"),
+    ('"Panel 1" <sip:1001@10.0.0.5>;tag=abc', "sip:1001@10.0.0.5"),
+    ("<sip:1001@10.0.0.5;transport=udp>", "sip:1001@10.0.0.5"),
+    ("SIP:1001@Panel.Local", "sip:1001@panel.local"),
+    ("sip:1001@10.0.0.5:5060", "sip:1001@10.0.0.5"),
+    ("sip:1001@10.0.0.5:5080", "sip:1001@10.0.0.5:5080"),
+    ("sip:1001@10.0.0.5?subject=x", "sip:1001@10.0.0.5"),
+    ("sip:10.0.0.5", "sip:10.0.0.5"),
+    ("panel", "panel"),
+])
+def test_normalise_uri(uri, expected):
+    assert normalise_uri(uri) == expected
+
+def test_user_part_keeps_its_case():
+    assert normalise_uri("sip:Door@10.0.0.5") != normalise_uri("sip:door@10.0.0.5")
+
+def test_find_call_by_any_form_of_its_uri(account):
+    call = FakeCall(1)
+    account.add_call(call, '"Panel" <sip:1001@10.0.0.5:5060>;tag=x')
+    assert call.remote_uri == '"Panel" <sip:1001@10.0.0.5:5060>;tag=x'
+    assert account.find_call("sip:1001@10.0.0.5") is call
+    account.delete_call(1)
+    assert account.find_call("sip:1001@10.0.0.5") is None
+    assert account.calls == {}
+
+def test_deleting_an_older_call_leaves_the_newer_one_to_the_same_uri(account):
+    older, newer = FakeCall(1), FakeCall(2)
+    account.add_call(older, "sip:1001@10.0.0.5")
+    account.add_call(newer, "sip:1001@10.0.0.5")
+    account.delete_call(1)
+    assert account.find_call("sip:1001@10.0.0.5") is newer
+    account.delete_call(1)  # Twice is fine
+
+def test_already_disconnected_call_isnt_stored(account):
+    class Info():
+        stateText = "DISCONNECTED"
+    call = FakeCall(1)
+    call.call_info = Info()
+    account.add_call(call, "sip:1001@10.0.0.5")
+    assert account.calls == {}
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pjsua2 as pj
+
+from hgn_sip.sip_callback_executor import CallbackExecutor
+
+class Info():
+    def __init__(self, call_id: str):
+        self.callIdString = call_id
+
+class Recorder():
+    """ Stands in for a SIPCallCallback, recording what ran when. The tests pass a job number as the call """
+    def __init__(self, name: str = "recorder", delay: float = 0, fail: bool = False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.runs: list[tuple[str, int]] = []
+        self.running: dict[str, int] = {}
+        self.overlapped = False
+    def execute(self, call, call_info):
+        call_id, n = call_info.callIdString, call
+        with self.lock:
+            self.running[call_id] = self.running.get(call_id, 0) + 1
+            self.overlapped |= self.running[call_id] > 1
+        time.sleep(self.delay)
+        with self.lock:
+            self.runs.append((call_id, n))
+            self.running[call_id] -= 1
+        if self.fail:
+            raise pj.Error("failed")
+
+def test_each_calls_callbacks_run_in_order_one_at_a_time():
+    executor = CallbackExecutor(pj.Endpoint.instance(), num_threads=4)
+    recorder = Recorder(delay=0.001)
+    for n in range(20):
+        for call_id in ("c1", "c2", "c3"):
+            executor.submit(call_id, recorder, n, Info(call_id))
+    executor.stop()
+    for call_id in ("c1", "c2", "c3"):
+        assert [n for c, n in recorder.runs if c == call_id] == list(range(20))
+    assert not recorder.overlapped
+    assert executor.get_stats()["callbacks"]["recorder"]["runs"] == 60
+
+def test_a_slow_call_doesnt_hold_up_the_others():
+    executor = CallbackExecutor(pj.Endpoint.instance(), num_threads=2)
+    release = threading.Event()
+    class Blocker(Recorder):
+        def execute(self, call, call_info):
+            release.wait(5)
+            super().execute(call, call_info)
+    slow = Blocker(name="slow")
+    fast = Recorder(name="fast")
+    executor.submit("slow", slow, 0, Info("slow"))
+    for n in range(5):
+        executor.submit("fast", fast, n, Info("fast"))
+    deadline = time.monotonic() + 5
+    while len(fast.runs) < 5 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert [n for _, n in fast.runs] == list(range(5))
+    assert slow.runs == []
+    release.set()
+    executor.stop()
+    assert slow.runs == [("slow", 0)]
+
+def test_a_failing_callback_is_counted_and_the_call_carries_on():
+    executor = CallbackExecutor(pj.Endpoint.instance(), num_threads=1)
+    failing = Recorder(name="failing", fail=True)
+    after = Recorder(name="after")
+    executor.submit("c1", failing, 0, Info("c1"))
+    executor.submit("c1", after, 1, Info("c1"))
+    executor.stop()
+    stats = executor.get_stats()["callbacks"]
+    assert stats["failing"]["failures"] == 1
+    assert after.runs == [("c1", 1)]
+    assert executor.get_stats()["calls_pending"] == 0
+
+def test_inline_runs_on_the_calling_thread():
+    executor = CallbackExecutor(pj.Endpoint.instance(), num_threads=1)
+    threads = []
+    class ThreadRecorder(Recorder):
+        def execute(self, call, call_info):
+            threads.append(threading.current_thread())
+    executor.run_inline(ThreadRecorder(name="inline"), 0, Info("c1"))
+    executor.stop()
+    assert threads == [threading.current_thread()]
+    assert executor.get_stats()["callbacks"]["inline"]["inline"]
@@ -0,0 +1,36 @@
+from hgn_sip.sip_callbacks import SIPCallCallback, SIPCallCallbackTable
+
+def noop(call, call_account, call_info):
+    pass
+
+def test_call_state_callbacks_match_their_state_or_any():
+    on_any = SIPCallCallback("call_state", noop, on_state_text="ANY")
+    on_confirmed = SIPCallCallback("call_state", noop, on_state_text="CONFIRMED")
+    on_media = SIPCallCallback("call_media_state", noop)
+    table = SIPCallCallbackTable([on_any, on_confirmed, on_media])
+    assert table.get("call_state", "CONFIRMED") == (on_any, on_confirmed)
+    assert table.get("call_state", "EARLY") == (on_any,)
+
+def test_other_events_ignore_the_state():
+    on_media = SIPCallCallback("call_media_state", noop)
+    release = SIPCallCallback("end_call", noop, inline=True)
+    remove = SIPCallCallback("end_call", noop)
+    table = SIPCallCallbackTable([on_media, release, remove])
+    assert table.get("call_media_state", "CONFIRMED") == (on_media,)
+    assert table.get("end_call", "DISCONNECTED") == (release, remove)
+    assert table.get("call_state", "DISCONNECTED") == ()
+
+def test_a_state_not_known_up_front_is_matched_and_kept():
+    on_any = SIPCallCallback("call_state", noop, on_state_text="ANY")
+    table = SIPCallCallbackTable([on_any])
+    assert table.get("call_state", "SOMETHING_NEW") == (on_any,)
+    assert ("call_state", "SOMETHING_NEW") in table.table
+
+def test_table_keeps_its_own_copy_of_the_list():
+    callbacks = [SIPCallCallback("end_call", noop)]
+    table = SIPCallCallbackTable(callbacks)
+    callbacks.append(SIPCallCallback("end_call", noop))
+    assert len(table.get("end_call", "DISCONNECTED")) == 1
+
+def test_callback_name_comes_from_the_function():
+    assert SIPCallCallback("end_call", noop).name == "noop"